@@ -1,11 +1,6 @@
 import json 
-import jwt
-from users.models import AppUser
-from django.conf import settings
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-import redis.asyncio as redis
-from urllib.parse import parse_qs
+from lyncup.redis_pool import get_redis
 
 class GroupConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -13,37 +8,15 @@ class GroupConsumer(AsyncWebsocketConsumer):
 
         #connect to the Redis
         # self.redis = await aioredis.create_redis_pool(settings.REDIS_URL)
-        self.redis = redis.from_url(settings.REDIS_URL, decode_responses=True)
+        #the process-wide client, its pooled connections are shared with every other consumer
+        self.redis = get_redis()
 
-        #self.scope is a dict object which contains metadata about the incoming client connection such as headers, query string, path, etc . query_string is part of the metadata in self.scope. Since "query_string" is expected to be a byte string, the default value is also a byte string (b"") to maintain consistency.
+        #the ?token= JWT from the query string (e.g. "token=abcd1234") was already decoded by TokenAuthMiddleware (see lyncup/token_auth.py), which also set self.scope["user_id"]. token_user is None if the token was missing or invalid.
+        user = self.scope.get("token_user")
 
-# scope.get("key", default_value)
-# key: The key you want to retrieve (e.g., "query_string").
-# default_value: A fallback value to return if the key does not exist in the dictionary.
-        #decode so that it becomes string now for easier processing, this will need to be encded back later to bytes
-        query_string = self.scope.get("query_string", b"").decode("utf-8")
-        # print(f"Query string: {query_string}") 
+        if user:
 
-#example query_string: "token=abcd1234&room_name=general"
-
-        query_params = parse_qs(query_string)
-        # query_params will be:
-        # {
-        #     "token": ["abc123"],
-        # }
-        token = query_params.get("token", [None])[0]
-
-        if token:
-
-            #get user
             try:
-                user = await self.get_token_user(token)
-
-                if not user:
-                    print("Invalid user")
-                    await self.close(code=4123)
-                    return
-
                 #By setting self.scope["user"] = user, we are linking the authenticated user to this WebSocket connection. This makes it easy to access the user information later in the code for this connection. 
                 #self.scope is a buiklt in property of AsyncWebsocketConsumer
                 self.scope["user"] = user
@@ -80,7 +53,7 @@ class GroupConsumer(AsyncWebsocketConsumer):
                 await self.close(code=4123)
 
         else:
-            print("No token provided, closing connection")
+            print("No valid token provided, closing connection")
             await self.close(code=4123)
             return
 
@@ -97,9 +70,7 @@ class GroupConsumer(AsyncWebsocketConsumer):
 
             await self.remove_and_update_member_list()
 
-            #must close redis for this consumer instance
-            if self.redis:
-                await self.redis.aclose()
+            #self.redis is the shared client (see lyncup/redis_pool.py), it stays open for the other consumers
 
         except Exception as error:
             print(error)
@@ -247,25 +218,3 @@ class GroupConsumer(AsyncWebsocketConsumer):
         await self.send(text_data=json.dumps({
             'members': members
         }))
-
-
-    #the decorator converts sychronouse function to asynchronous, more suitable for WebSocket.
-    @database_sync_to_async
-    def get_token_user(self, token):
-
-        # print("entered get_token_user method")
-
-        try:
-
-            data = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-
-            self.scope["user_id"] = data['user_id']
-
-            return AppUser.objects.get(id=data['user_id'])
-
-        except jwt.ExpiredSignatureError:
-            print("Token has expired")
-            return None
-        except Exception as error:
-            print(error)
-            return None
\ No newline at end of file
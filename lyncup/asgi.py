@@ -23,6 +23,7 @@ from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 # from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
+from django.urls import re_path
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lyncup.settings")
 # Initialize Django ASGI application early to ensure the AppRegistry
@@ -32,20 +33,28 @@ django_asgi_app = get_asgi_application()
 # from chat.routing import websocket_urlpatterns
 
 # Import websocket_urlpatterns with aliases to prevent conflicts
+from lyncup.token_auth import TokenAuthMiddleware
 from chat.routing import websocket_urlpatterns as chat_websocket_urlpatterns
 from matching.routing import websocket_urlpatterns as matching_websocket_urlpatterns
 from direct_message.routing import websocket_urlpatterns as direct_message_websocket_urlpatterns
 
 
-combined_websocket_urlpatterns = chat_websocket_urlpatterns + matching_websocket_urlpatterns + direct_message_websocket_urlpatterns
+#wraps the consumer of every route in middleware, so a connection only runs the authentication its own consumer reads
+def with_middleware(middleware, urlpatterns):
+    return [re_path(route.pattern.regex.pattern, middleware(route.callback), name=route.name) for route in urlpatterns]
+
+#TokenAuthMiddleware decodes the ?token= JWT once per connection and puts the (cached) user into scope["token_user"], for the chat and queue consumers
+#the direct message consumer reads the session user from scope["user"], so only its route goes through AuthMiddlewareStack's cookie, session and user lookups
+combined_websocket_urlpatterns = (
+    with_middleware(TokenAuthMiddleware, chat_websocket_urlpatterns + matching_websocket_urlpatterns)
+    + with_middleware(AuthMiddlewareStack, direct_message_websocket_urlpatterns)
+)
 
 
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
-        "websocket": AuthMiddlewareStack(
-            URLRouter(combined_websocket_urlpatterns)
-        ),
+        "websocket": URLRouter(combined_websocket_urlpatterns),
     }
 )
 
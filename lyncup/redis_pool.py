@@ -0,0 +1,37 @@
+import asyncio
+import weakref
+import redis as sync_redis
+import redis.asyncio as redis
+from django.conf import settings
+
+
+#one async Redis client (with its connection pool) shared by all websocket consumers of the process, instead of every connection opening and closing a client of its own. A reconnect storm after a deploy then reuses a handful of pooled connections rather than making a TCP handshake per websocket.
+#asyncio connections belong to the event loop they were opened in, so there is one client per loop, created lazily the first time a consumer on that loop asks for it. Keyed weakly, so a closed loop (e.g. in tests) doesn't keep its client alive.
+#the pool blocks (up to REDIS_POOL_TIMEOUT seconds) rather than failing when all REDIS_POOL_MAX_CONNECTIONS are in use, and idle connections are health-checked before reuse.
+#consumers must not close the shared client on disconnect.
+clients = weakref.WeakKeyDictionary()
+
+def get_redis():
+    loop = asyncio.get_running_loop()
+    client = clients.get(loop)
+    if client is None:
+        pool = redis.BlockingConnectionPool.from_url(
+            settings.REDIS_URL,
+            decode_responses=True,
+            max_connections=settings.REDIS_POOL_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+        )
+        client = redis.Redis(connection_pool=pool)
+        clients[loop] = client
+    return client
+
+
+#sync client for code outside the event loop that only touches Redis now and then, e.g. signal handlers. Created on first use, redis-py's own pool makes it safe to share between threads.
+sync_client = None
+
+def get_sync_redis():
+    global sync_client
+    if sync_client is None:
+        sync_client = sync_redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return sync_client
@@ -99,6 +99,13 @@ REDIS_PORT = config("REDIS_PORT", default='6379')
 
 REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/0"
 
+#the Redis connection pool shared by the websocket consumers of a process (see lyncup/redis_pool.py): at most REDIS_POOL_MAX_CONNECTIONS connections, waiting up to REDIS_POOL_TIMEOUT seconds for a free one, idle ones checked every REDIS_HEALTH_CHECK_INTERVAL seconds
+REDIS_POOL_MAX_CONNECTIONS = config("REDIS_POOL_MAX_CONNECTIONS", default=50, cast=int)
+REDIS_POOL_TIMEOUT = config("REDIS_POOL_TIMEOUT", default=5.0, cast=float)
+REDIS_HEALTH_CHECK_INTERVAL = config("REDIS_HEALTH_CHECK_INTERVAL", default=30, cast=int)
+#how long the websocket auth middleware caches a user's fields in Redis (see lyncup/token_auth.py), saving the user invalidates it earlier
+TOKEN_USER_CACHE_SECONDS = config("TOKEN_USER_CACHE_SECONDS", default=300, cast=int)
+
 
 CHANNEL_LAYERS = {
     # a python dict of a configuration for using Redis as a kind of message board essentially it's going to hold all of the data that is all of the messages for each of the rooms. So we're just saying that we're going to use the channel's Redis package that we installed much earlier. And the configuration here, we're going to find Redis at local host, the local IP address and it's going to be running on its default port number 6379, so that when we come to update the app will have to start Redis.
@@ -162,6 +169,36 @@ CELERY_RESULT_BACKEND = REDIS_URL
 
 CELERY_RESULT_EXTENDED = True
 
+#matching: build_graph_annoy does incremental embedding refreshes in between, and a full node2vec rebuild at least this often
+EMBEDDING_FULL_REBUILD_HOURS = config("EMBEDDING_FULL_REBUILD_HOURS", default=24, cast=int)
+#"node2vec" or "spectral", see EMBEDDING_ENGINES in matching/build_graph_annoy.py
+EMBEDDING_ENGINE = config("EMBEDDING_ENGINE", default="node2vec")
+#the embeddings are split into about one cluster per this many users, each with its own annoy index and queue (see cluster_embeddings in matching/build_graph_annoy.py)
+MATCHING_USERS_PER_CLUSTER = config("MATCHING_USERS_PER_CLUSTER", default=20000, cast=int)
+#"queue" compares the queued users of a cluster with each other directly, "annoy" looks each of them up in the whole index (see run_batch_matching in matching/matching.py)
+MATCHING_MODE = config("MATCHING_MODE", default="annoy")
+#how the "queue" mode splits a cluster's queued users into groups, "agglomerative" or "greedy", and how many seconds it may spend on that per cluster (see matching/group_formation.py)
+MATCHING_GROUP_ENGINE = config("MATCHING_GROUP_ENGINE", default="agglomerative")
+MATCHING_GROUP_TIME_BUDGET = config("MATCHING_GROUP_TIME_BUDGET", default=2.0, cast=float)
+#seconds a run_matching_algo tick may spend matching before leaving the rest of the queue to the next tick (see matching/scheduler.py), keep it well below the task's 60 second lock
+MATCHING_TICK_BUDGET = config("MATCHING_TICK_BUDGET", default=20.0, cast=float)
+#memory budget for the annoy indexes each celery worker process keeps loaded between matching ticks (see matching/index_registry.py)
+MATCHING_INDEX_CACHE_MB = config("MATCHING_INDEX_CACHE_MB", default=1024, cast=int)
+#how many of the oldest queued users a run_matching_algo tick claims from Redis, and how many seconds a user must have waited to be claimed (see matching/redis_queue.py)
+MATCHING_CLAIM_LIMIT = config("MATCHING_CLAIM_LIMIT", default=10000, cast=int)
+MATCHING_MIN_WAIT = config("MATCHING_MIN_WAIT", default=0.0, cast=float)
+#match every cluster in its own celery task, in parallel across the worker pool, instead of all clusters in the one run_matching_algo task (see dispatch_matching_fanout in matching/tasks.py)
+MATCHING_FANOUT = config("MATCHING_FANOUT", default=False, cast=bool)
+#event-driven matching (see schedule_matching in matching/redis_queue.py): once MATCHING_TRIGGER_QUEUE_SIZE users are queued a run starts MATCHING_TRIGGER_DEBOUNCE seconds later, with fewer it starts at most MATCHING_TRIGGER_MAX_WAIT seconds later. The periodic run_matching_algo of celery beat still runs on top as a safety net.
+MATCHING_TRIGGER_QUEUE_SIZE = config("MATCHING_TRIGGER_QUEUE_SIZE", default=4, cast=int)
+MATCHING_TRIGGER_DEBOUNCE = config("MATCHING_TRIGGER_DEBOUNCE", default=2.0, cast=float)
+MATCHING_TRIGGER_MAX_WAIT = config("MATCHING_TRIGGER_MAX_WAIT", default=15.0, cast=float)
+#how many room assignments a tick sends to the channel layer at the same time (see matching/notify.py)
+MATCHING_NOTIFY_CONCURRENCY = config("MATCHING_NOTIFY_CONCURRENCY", default=100, cast=int)
+#a queued user's presence lease lasts QUEUE_LEASE_SECONDS and their QueueConsumer renews it every QUEUE_HEARTBEAT_SECONDS, users whose lease ran out are swept from the queue before each matching tick (see matching/redis_queue.py)
+QUEUE_LEASE_SECONDS = config("QUEUE_LEASE_SECONDS", default=30, cast=int)
+QUEUE_HEARTBEAT_SECONDS = config("QUEUE_HEARTBEAT_SECONDS", default=10, cast=int)
+
 
 TEMPLATES = [
     {
@@ -0,0 +1,103 @@
+import json
+from urllib.parse import parse_qs
+
+import jwt
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+
+from lyncup.redis_pool import get_redis, get_sync_redis
+
+
+#websocket authentication for the chat and queue consumers, done once per connection here rather than in each consumer.
+#the JWT from the ?token= query string is decoded, and the user is looked up in a short-lived Redis cache of the few fields the consumers use (TOKEN_USER_FIELDS), so a connect (and every reconnect when joining a room) normally costs one Redis GET on the shared async pool instead of a database query through a sync thread. Only on a cache miss is the database hit, and the result cached for TOKEN_USER_CACHE_SECONDS.
+#the cached entry is deleted whenever the user is saved or deleted (see users/signals.py), so changed names or a deactivated account show up on the next connect.
+#sets scope["token_user"] (a TokenUser, or None if the token is missing, invalid or expired, or the user doesn't exist) and scope["user_id"]. scope["user"] is left to AuthMiddlewareStack's session user.
+
+TOKEN_USER_FIELDS = ("id", "firstname", "lastname", "is_verified", "is_active")
+
+def token_user_key(user_id):
+    return f"token_user:{user_id}"
+
+
+#the cached fields of an AppUser, attribute access like the model
+class TokenUser:
+    __slots__ = TOKEN_USER_FIELDS
+
+    def __init__(self, **fields):
+        for field in TOKEN_USER_FIELDS:
+            setattr(self, field, fields[field])
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(**{field: getattr(user, field) for field in TOKEN_USER_FIELDS})
+
+    def to_json(self):
+        return json.dumps({field: getattr(self, field) for field in TOKEN_USER_FIELDS})
+
+    def __repr__(self):
+        return f"TokenUser({self.id})"
+
+
+#None if the token can't be used
+def decode_token(token):
+    try:
+        data = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+        return data["user_id"]
+    except jwt.ExpiredSignatureError:
+        print("Token has expired")
+    except Exception as error:
+        print(error)
+    return None
+
+@database_sync_to_async
+def load_token_user(user_id):
+    #imported here, the middleware module is imported while the app registry is still loading
+    from users.models import AppUser
+    user = AppUser.objects.filter(id=user_id).only(*TOKEN_USER_FIELDS).first()
+    return TokenUser.from_user(user) if user is not None else None
+
+async def get_token_user(user_id):
+    client = get_redis()
+    try:
+        cached = await client.get(token_user_key(user_id))
+        if cached is not None:
+            return TokenUser(**json.loads(cached))
+    except Exception as error:
+        #without the cache it still works, just with a database query
+        print(error)
+        client = None
+
+    user = await load_token_user(user_id)
+    if user is not None and client is not None:
+        try:
+            await client.set(token_user_key(user_id), user.to_json(), ex=settings.TOKEN_USER_CACHE_SECONDS)
+        except Exception as error:
+            print(error)
+    return user
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    async def __call__(self, scope, receive, send):
+        #scope is shared with the caller, so it is copied before adding to it
+        scope = dict(scope)
+        scope["token_user"] = None
+
+        query_params = parse_qs(scope.get("query_string", b"").decode("utf-8"))
+        token = query_params.get("token", [None])[0]
+        if token:
+            user_id = decode_token(token)
+            if user_id is not None:
+                scope["user_id"] = user_id
+                scope["token_user"] = await get_token_user(user_id)
+
+        return await super().__call__(scope, receive, send)
+
+
+#called from the signal handlers, outside the event loop
+def invalidate_token_user(user_id):
+    try:
+        get_sync_redis().delete(token_user_key(user_id))
+    except Exception as error:
+        #a failed delete only leaves the entry until it expires
+        print(error)
@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime, timezone
+
+
+#every index build writes its files (annoy indexes, maps) into its own directory under base_dir/versions/ and never touches it again afterwards. Once everything is written, a manifest is added and the base_dir/current symlink is swapped to point at the new version with os.replace, which is atomic. So a reader that resolves "current" always gets an index and a map from the same, fully written build, never a half-written file.
+#old versions are garbage collected, a reader that still has an old annoy file mmapped keeps working as the file only really goes away once it is unmapped.
+#layout:
+# base_dir/
+#     current -> versions/20250101T120000123456-ab12cd34
+#     versions/
+#         20250101T120000123456-ab12cd34/
+#             manifest.json
+#             cluster_global.ann
+#             user_clusters.npy
+#             cluster_0.ann, 0_user_ids.npy, 0_positions.npy, 0_index_users.npy
+#             cluster_1.ann, ...
+
+VERSIONS_DIR = "versions"
+CURRENT_LINK = "current"
+MANIFEST_FILE = "manifest.json"
+
+
+#creates a fresh, empty version directory to build into. Version names sort by creation time.
+def new_version_dir(base_dir):
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f") + "-" + uuid.uuid4().hex[:8]
+    version_dir = os.path.join(base_dir, VERSIONS_DIR, version)
+    os.makedirs(version_dir)
+    return version_dir
+
+#writes the manifest into version_dir and atomically points base_dir/current at it
+def publish_version(base_dir, version_dir, manifest):
+    version = os.path.basename(version_dir)
+    manifest = dict(manifest, version=version, created_at=time.time())
+
+    with open(os.path.join(version_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f)
+
+    #the symlink is created under a temporary name first, then renamed over "current". rename is atomic, so readers see either the old or the new version.
+    #relative target so the whole base_dir can be moved or mounted elsewhere
+    tmp_link = os.path.join(base_dir, f"{CURRENT_LINK}.{uuid.uuid4().hex}")
+    os.symlink(os.path.join(VERSIONS_DIR, version), tmp_link)
+    os.replace(tmp_link, os.path.join(base_dir, CURRENT_LINK))
+
+    return version
+
+#the directory readers should load from: the published version if there is one, otherwise base_dir itself (older builds wrote their files straight into base_dir, or base_dir may already be a version directory).
+#resolve this once and load every file of a run from the returned directory, so they all come from the same version.
+def resolve_version_dir(base_dir):
+    current = os.path.join(base_dir, CURRENT_LINK)
+    try:
+        return os.path.join(base_dir, os.readlink(current))
+    except OSError:
+        return base_dir
+
+#the manifest of version_dir, or None if it doesn't have one
+def load_manifest(version_dir):
+    try:
+        with open(os.path.join(version_dir, MANIFEST_FILE), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+#removes all but the newest keep versions, never the one "current" points to
+def collect_old_versions(base_dir, keep=3):
+    versions_root = os.path.join(base_dir, VERSIONS_DIR)
+    if not os.path.isdir(versions_root):
+        return []
+
+    current_version = os.path.basename(resolve_version_dir(base_dir))
+    versions = sorted(os.listdir(versions_root), reverse=True)
+
+    removed = []
+    for version in versions[keep:]:
+        if version == current_version:
+            continue
+        shutil.rmtree(os.path.join(versions_root, version), ignore_errors=True)
+        removed.append(version)
+
+    return removed
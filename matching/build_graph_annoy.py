@@ -1,16 +1,52 @@
-import pandas as pd
+import numpy as np
 import json
 from annoy import AnnoyIndex
-from scipy.sparse import csr_matrix
-from sklearn.cluster import KMeans
+from scipy.sparse import coo_matrix
+from sklearn.cluster import MiniBatchKMeans
 import os
-from node2vec import Node2Vec
-import networkx as nx
-
-#this function builds a directede graph from likes_df 
-#if there is a directed edge from user A to user B but no edge from user B to user A, the script creates that missing reverse edge and assigns it 0.5 of the original weight. This means if there’s no reciprocity (if user B didn’t like user A back), the algorithm weakens the link by adding only a fraction of the original weight in the reverse direction.
-
-def create_graph_from_likes(likes_df, reciprocal_weight=0.5):
+import tempfile
+import time
+from matching.random_walks import write_walk_files, WalkCorpus
+from matching.spectral_embedding import spectral_embeddings
+from matching.artifacts import new_version_dir, publish_version, collect_old_versions
+from matching.index_map import UserIndexMap, UserClusterTable
+from matching.group_formation import queue_candidates
+from gensim.models import Word2Vec
+
+#this function builds the like graph as a sparse adjacency matrix, vectorised with numpy rather than looping over likes_df.iterrows().
+#rows are the "from" nodes and columns the "to" nodes, node_ids[i] is the user id of row/column i (sorted ascending).
+#if there is a directed edge from user A to user B but no edge from user B to user A, the missing reverse edge is added with reciprocal_weight of the original weight. This means if there’s no reciprocity (if user B didn’t like user A back), the algorithm weakens the link by adding only a fraction of the original weight in the reverse direction.
+def build_like_adjacency(likes_df, reciprocal_weight=0.5):
+
+    user_from = likes_df["user_from"].to_numpy(dtype=np.int64)
+    user_to = likes_df["user_to"].to_numpy(dtype=np.int64)
+    like_count = likes_df["like_count"].to_numpy(dtype=np.float64)
+    num_likes = len(user_from)
+
+    #np.unique gives the sorted user ids and, with return_inverse, the position of every id in that sorted array, so both columns are relabelled to 0..n-1 in a single pass
+    node_ids, inverse = np.unique(np.concatenate([user_from, user_to]), return_inverse=True)
+    num_nodes = len(node_ids)
+    rows = inverse[:num_likes]
+    cols = inverse[num_likes:]
+
+    #encode every (from, to) pair as one int64 key so that "does v like u back?" becomes a single vectorised membership test instead of a python set lookup per row
+    forward_keys = rows * num_nodes + cols
+    reverse_keys = cols * num_nodes + rows
+    missing_back = ~np.isin(reverse_keys, forward_keys)
+
+    all_rows = np.concatenate([rows, cols[missing_back]])
+    all_cols = np.concatenate([cols, rows[missing_back]])
+    weights = np.concatenate([like_count, like_count[missing_back] * reciprocal_weight])
+
+    #converting from coo to csr sums duplicate (row, col) entries, which is the group-by that replaces the "increase weight if already exists" branch of the old loop
+    adjacency = coo_matrix((weights, (all_rows, all_cols)), shape=(num_nodes, num_nodes)).tocsr()
+    adjacency.sum_duplicates()
+
+    return adjacency, node_ids
+
+#optional adapter that turns the csr adjacency into a networkx DiGraph, only needed by code that still wants a networkx graph. networkx is imported here so the vectorised path doesn't depend on it.
+def adjacency_to_networkx(adjacency, node_ids):
+    import networkx as nx
 
     graph = nx.DiGraph()
 
@@ -21,39 +57,44 @@ def create_graph_from_likes(likes_df, reciprocal_weight=0.5):
     #     3: {}  
     # }
 
-    all_edges = set()
-    #iterrows() is from dataframe outputs (index, row) pairs.
-    #keep track of all forward edges
-    for i, row in likes_df.iterrows():
-        all_edges.add((row.user_from, row.user_to))
-
-    for i, row in likes_df.iterrows():
-        #from node
-        u = row.user_from
-        #to node
-        v = row.user_to
-        #weight
-        w = float(row.like_count)
-
-        #add edge, or increase weight if already exists
-        if graph.has_edge(u, v):
-            graph[u][v]['weight'] += w
-        else:
-            #this will also automatically create nodes
-            graph.add_edge(u, v, weight=w)
-
-        if (v,u) not in all_edges:
-            if graph.has_edge(v, u):
-                graph[v][u]['weight'] += w*reciprocal_weight
-            else:
-                graph.add_edge(v, u, weight=w*reciprocal_weight)
+    graph.add_nodes_from(node_ids.tolist())
+    coo = adjacency.tocoo()
+    graph.add_weighted_edges_from(zip(node_ids[coo.row].tolist(), node_ids[coo.col].tolist(), coo.data.tolist()))
 
     return graph
 
+#this function builds a directed networkx graph from likes_df, it is a thin wrapper around build_like_adjacency and adjacency_to_networkx so the result is identical to the old loop version.
+def create_graph_from_likes(likes_df, reciprocal_weight=0.5):
+    adjacency, node_ids = build_like_adjacency(likes_df, reciprocal_weight=reciprocal_weight)
+    return adjacency_to_networkx(adjacency, node_ids)
+
+#node2vec settings shared by the full build and the incremental refresh
+NODE2VEC_PARAMS = {
+    "walk_length": 40,
+    "num_walks": 80,
+    "p": 0.5,
+    "q": 10,
+}
+
+#the builder's own files stay directly in base_dir, only the index artifacts are versioned
+MODEL_FILE = "node2vec.model"
+BUILD_STATE_FILE = "build_state.json"
+
+#from this many users upwards annoy builds the index on disk instead of in RAM
+ON_DISK_BUILD_MIN_USERS = 500000
+
+#length of the precomputed neighbour list of every user (see write_neighbour_lists), match_in_cluster's default top_k
+NEIGHBOUR_LIST_SIZE = 50
+
+#target number of users per cluster, the embeddings are split into num_users // USERS_PER_CLUSTER clusters. Below that everyone stays in the single "global" cluster.
+USERS_PER_CLUSTER = 20000
+
 #embed_dimensions is the number of dimensions in the embedding space
 #num_trees is the number of trees in the Annoy index
-#this will build graph from likes_df, then run node2vec to get the embeddings and then builds a single annoy index (no clusters for now) and then save the annoy index and user_index_map for retrieval to base_dir Anooy folder.
-def create_node2vec_annoy(likes_df, base_dir=None, embed_dimensions=256, num_trees=50):
+#this will build graph from likes_df, then run the embedding engine to get the embeddings, split them into clusters (see cluster_embeddings) and then builds an annoy index and user index map per cluster and publish them for retrieval as a new version in the base_dir Anooy folder.
+#engine picks the embedding backend from EMBEDDING_ENGINES: "node2vec" (random walks + skip-gram, the default) or "spectral" (sparse matrix factorisation, much faster). Both write the same annoy and map files.
+#workers is the number of processes used for the walks and of gensim training threads, defaults to all cores.
+def create_node2vec_annoy(likes_df, base_dir=None, embed_dimensions=256, num_trees=50, workers=None, engine="node2vec", users_per_cluster=USERS_PER_CLUSTER):
 
     if likes_df.empty:
         print("likes_df is empty")
@@ -66,93 +107,260 @@ def create_node2vec_annoy(likes_df, base_dir=None, embed_dimensions=256, num_tre
     if not os.path.exists(base_dir):
         os.makedirs(base_dir, exist_ok=True)
 
-    graph = create_graph_from_likes(likes_df, reciprocal_weight=0.5)
-    print("graph created, now running node2vec")
+    adjacency, node_ids = build_like_adjacency(likes_df, reciprocal_weight=0.5)
+    print(f"graph created, now running the {engine} embedding")
 
-    node2vec = Node2Vec(
-        graph,
-        dimensions=embed_dimensions,
-        walk_length=40,
-        num_walks=80,
-        p=0.5,
-        q=10, 
-        weight_key="weight",
-        workers=1 #this can be increase for parallele processing
-    )
+    vectors = EMBEDDING_ENGINES[engine](adjacency, node_ids, embed_dimensions, base_dir, workers)
 
-    print("carrying out fitting skip-gram model")
-    model = node2vec.fit(window=5, min_count=1, batch_words=4)
+    publish_annoy_index(vectors, node_ids.tolist(), base_dir, embed_dimensions, num_trees, engine=engine, users_per_cluster=users_per_cluster)
 
-    user_list = sorted(graph.nodes())
-    num_users = len(user_list)
+#node2vec engine: parallel walks written to disk and streamed into skip-gram.
+#the trained skip-gram model is saved in base_dir so that refresh_node2vec_annoy can warm-start from it later.
+def node2vec_embeddings(adjacency, node_ids, embed_dimensions, base_dir, workers=None):
 
-    print(f"total users/nodes in the graph: {num_users}")
+    if workers is None:
+        workers = os.cpu_count() or 1
 
-    annoy_index = AnnoyIndex(embed_dimensions, metric="angular")
+    #the walk files only live for the duration of the training
+    with tempfile.TemporaryDirectory(dir=base_dir) as walk_dir:
+        walk_files = write_walk_files(adjacency, walk_dir, workers=workers, **NODE2VEC_PARAMS)
 
-    user_index_map = {}
-    index_user_map = {}
+        print("carrying out fitting skip-gram model")
+        #same skip-gram settings that node2vec.fit used (sg=1, workers defaulting to the walk workers)
+        model = Word2Vec(WalkCorpus(walk_files, node_ids), vector_size=embed_dimensions, window=5, min_count=1, batch_words=4, sg=1, workers=workers)
 
-    #add each user's embedding to Annoy 
-    for i, user_id in enumerate(user_list):
+    model.save(os.path.join(base_dir, MODEL_FILE))
 
-        #.wv stands for word vecotrs. it stores all the learned embeddings (vectors) for each node. embeddings/vectors are much like coordinates in the vector space. .wv is an object that stores all the learned embeddings and n2v_model.wv[str(user_id)] is how to retrieve a specific embedding from it. #Note: .wv is automatically created when run node2vec.fit(), therefore already exists.
+    #.wv stands for word vecotrs. it stores all the learned embeddings (vectors) for each node, keyed by the user id as a string. Indexing with a list returns them stacked in that order.
+    return model.wv[node_ids.astype(str).tolist()]
 
-        user_vector = model.wv[str(user_id)] #model keys are strings
-        annoy_index.add_item(i, user_vector)
+#spectral engine: no model to keep, so base_dir and workers are unused
+def spectral_engine_embeddings(adjacency, node_ids, embed_dimensions, base_dir, workers=None):
+    return spectral_embeddings(adjacency, embed_dimensions=embed_dimensions)
 
-        #note that annoy requires incremental index values to retrieve users.
+#every engine takes (adjacency, node_ids, embed_dimensions, base_dir, workers) and returns a (num_users, embed_dimensions) array aligned with node_ids
+EMBEDDING_ENGINES = {
+    "node2vec": node2vec_embeddings,
+    "spectral": spectral_engine_embeddings,
+}
 
-        #record the user_id that maps to the index
-        user_index_map[str(user_id)] = int(i)
-        #record the reverse, the index that maps to user_id
-        index_user_map[str(i)] = int(user_id)
+#incremental version of create_node2vec_annoy. Instead of retraining from scratch, it only regenerates walks in the neighbourhood (up to hops away) of changed_user_ids, i.e. users whose likes changed since the last build, and continues training the previously saved skip-gram model on those walks. The annoy index is then rebuilt from the updated vectors of every user.
+#returns False if there is no previous model to warm-start from, so the caller can fall back to a full build.
+def refresh_node2vec_annoy(likes_df, changed_user_ids, base_dir=None, num_trees=50, hops=2, workers=None, users_per_cluster=USERS_PER_CLUSTER):
 
-    print("building annoy index...")
-    annoy_index.build(num_trees)
+    if base_dir is None:
+        base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Annoy")
+
+    model_path = os.path.join(base_dir, MODEL_FILE)
+    if likes_df.empty or not os.path.exists(model_path):
+        print("no previous node2vec model found, a full build is needed")
+        return False
+
+    model = Word2Vec.load(model_path)
+    embed_dimensions = model.wv.vector_size
+
+    adjacency, node_ids = build_like_adjacency(likes_df, reciprocal_weight=0.5)
+
+    #collect the neighbourhood around the changed users, ignoring edge direction as a like in either direction affects both users
+    undirected = (adjacency + adjacency.T).tocsr()
+    changed_user_ids = np.fromiter(changed_user_ids, dtype=np.int64)
+    positions = np.searchsorted(node_ids, changed_user_ids)
+    positions = positions[(positions < len(node_ids)) & (node_ids[np.minimum(positions, len(node_ids) - 1)] == changed_user_ids)]
 
-    #save files
-    annoy_file_path = os.path.join(base_dir, "cluster_global.ann")
-    #save the annoy file to Annoy folder
-    annoy_index.save(annoy_file_path)
+    in_neighbourhood = np.zeros(len(node_ids), dtype=bool)
+    in_neighbourhood[positions] = True
+    frontier = in_neighbourhood.copy()
+    for _ in range(hops):
+        #one sparse matrix-vector product expands the frontier by one hop
+        frontier = (undirected @ frontier.astype(np.float64)) > 0
+        frontier &= ~in_neighbourhood
+        in_neighbourhood |= frontier
 
-    map_info = {
-        "user_index_map": user_index_map,
-        "index_user_map": index_user_map,
-        "embed_dimensions": int(embed_dimensions)
-    }
+    local_nodes = np.flatnonzero(in_neighbourhood)
+    if not local_nodes.size:
+        print("none of the changed users are in the graph, nothing to refresh")
+        return True
 
-    with open(f"{base_dir}/global_map.json", "w") as f:
-            json.dump(map_info, f)
+    print(f"refreshing embeddings around {len(local_nodes)} of {len(node_ids)} users")
 
-    print(f"global annoy and map info created in {base_dir}.")
+    if workers is None:
+        workers = os.cpu_count() or 1
 
+    with tempfile.TemporaryDirectory(dir=base_dir) as walk_dir:
+        #walks start only from the neighbourhood but may wander through the whole graph
+        walk_files = write_walk_files(adjacency, walk_dir, start_nodes=local_nodes, workers=workers, **NODE2VEC_PARAMS)
+        corpus = WalkCorpus(walk_files, node_ids)
 
+        #update=True adds any brand new users to the existing vocabulary without resetting the vectors already learned
+        model.workers = workers
+        model.build_vocab(corpus, update=True)
+        model.train(corpus, total_examples=model.corpus_count, epochs=model.epochs)
 
+    model.save(model_path)
 
+    publish_annoy_index(model.wv[node_ids.astype(str).tolist()], node_ids.tolist(), base_dir, embed_dimensions, num_trees, users_per_cluster=users_per_cluster)
+    return True
 
-    
+#splits the users into clusters of similar embeddings so each cluster gets its own, smaller annoy index and can be matched on its own.
+#returns (labels, cluster_ids): labels[i] is the position in cluster_ids of the cluster of vectors[i]. With fewer than 2 * users_per_cluster users this is the single "global" cluster, otherwise clusters are named "0", "1", ...
+#the vectors are normalised first so KMeans' euclidean distance follows the angular distance annoy uses. MiniBatchKMeans only looks at batch_size vectors per step, so it stays fast and flat on memory for millions of users.
+def cluster_embeddings(vectors, users_per_cluster=USERS_PER_CLUSTER, seed=0):
+    num_users = len(vectors)
+    num_clusters = num_users // users_per_cluster if users_per_cluster else 1
 
-    
+    if num_clusters < 2:
+        return np.zeros(num_users, dtype=np.int64), ["global"]
 
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit_vectors = vectors / np.where(norms > 0, norms, 1.0)
 
+    kmeans = MiniBatchKMeans(n_clusters=num_clusters, batch_size=4096, n_init=3, random_state=seed)
+    labels = kmeans.fit_predict(unit_vectors)
 
+    #empty clusters would leave gaps, relabel to the clusters actually used
+    used, labels = np.unique(labels, return_inverse=True)
+    return labels, [str(cluster) for cluster in range(len(used))]
 
-        
-        
-        
+#writes the annoy index and map of every cluster plus the user -> cluster routing table into a new version directory under base_dir and publishes it atomically (see matching/artifacts.py), then removes old versions. vectors[i] is the embedding of user_list[i].
+#on_disk_build makes annoy build the index straight into its file instead of in RAM, which keeps the builder's memory bounded for big indexes. By default it is used from ON_DISK_BUILD_MIN_USERS users upwards.
+def publish_annoy_index(vectors, user_list, base_dir, embed_dimensions, num_trees, engine="node2vec", on_disk_build=None, keep_versions=3, users_per_cluster=USERS_PER_CLUSTER, neighbour_list_size=NEIGHBOUR_LIST_SIZE):
 
- 
+    vectors = np.asarray(vectors)
+    user_list = np.asarray(user_list, dtype=np.int64)
 
+    labels, cluster_ids = cluster_embeddings(vectors, users_per_cluster=users_per_cluster)
 
+    version_dir = new_version_dir(base_dir)
+    for code, cluster_id in enumerate(cluster_ids):
+        members = np.flatnonzero(labels == code)
+        cluster_on_disk = len(members) >= ON_DISK_BUILD_MIN_USERS if on_disk_build is None else on_disk_build
+        write_annoy_index(vectors[members], user_list[members], version_dir, embed_dimensions, num_trees, on_disk_build=cluster_on_disk, cluster_id=cluster_id, neighbour_list_size=neighbour_list_size)
 
+    UserClusterTable.from_labels(user_list, labels, cluster_ids).save(version_dir)
 
+    version = publish_version(base_dir, version_dir, {
+        "embed_dimensions": int(embed_dimensions),
+        "clusters": cluster_ids,
+        "cluster_sizes": np.bincount(labels, minlength=len(cluster_ids)).tolist(),
+        "num_users": len(user_list),
+        "neighbour_list_size": int(neighbour_list_size),
+        "engine": engine,
+    })
+    collect_old_versions(base_dir, keep=keep_versions)
 
+    print(f"published index version {version} with {len(cluster_ids)} clusters in {base_dir}.")
+    return version_dir
 
+#adds each user's vector to a fresh annoy index and saves it to out_dir as cluster_{cluster_id}.ann together with the cluster's user <-> index map, precomputed neighbour lists and the vectors themselves. vectors[i] is the embedding of user_list[i].
+def write_annoy_index(vectors, user_list, out_dir, embed_dimensions, num_trees, on_disk_build=False, cluster_id="global", neighbour_list_size=NEIGHBOUR_LIST_SIZE):
 
+    num_users = len(user_list)
+
+    print(f"total users/nodes in cluster {cluster_id}: {num_users}")
 
-        
+    annoy_index = AnnoyIndex(embed_dimensions, metric="angular")
 
+    annoy_file_path = os.path.join(out_dir, f"cluster_{cluster_id}.ann")
+    if on_disk_build:
+        #must be called before any item is added, build() then writes the index into this file and no save() is needed
+        annoy_index.on_disk_build(annoy_file_path)
 
+    #add each user's embedding to Annoy 
+    #note that annoy requires incremental index values to retrieve users, user_list[i] is stored at index i.
+    for i in range(num_users):
 
+        #embeddings/vectors are much like coordinates in the vector space
+        annoy_index.add_item(i, vectors[i])
+
+    print("building annoy index...")
+    annoy_index.build(num_trees)
 
+    if not on_disk_build:
+        #save the annoy file to the version folder
+        annoy_index.save(annoy_file_path)
+
+    #record which user sits at which index, in the binary format (see matching/index_map.py)
+    UserIndexMap.from_user_list(user_list).save(out_dir, cluster_id)
+
+    #{cluster_id}_vectors.npy, float32 (num_users, embed_dimensions), row i is the vector of annoy index i. The "queue" matching mode memory-maps it and reads all queued users' vectors with one array index instead of an annoy call per user
+    np.save(os.path.join(out_dir, f"{cluster_id}_vectors.npy"), np.asarray(vectors, dtype=np.float32))
+
+    if neighbour_list_size:
+        write_neighbour_lists(vectors, out_dir, cluster_id, neighbour_list_size)
+
+    print(f"{cluster_id} annoy and map info created in {out_dir}.")
+
+#finds every user's nearest neighbours once at build time, so the matcher reads them with a single array slice instead of an annoy query per popped user per tick.
+#they are the exact cosine neighbours, computed from the embedding matrix in blocks of block_size users with queue_candidates (see matching/group_formation.py) rather than one annoy query per user. That is still O(num_users²) work per cluster, a few seconds for a cluster of USERS_PER_CLUSTER users, which is what splitting into clusters keeps bounded.
+#writes {cluster_id}_neighbours.npy, int32 (num_users, k) annoy indices of each user's k nearest neighbours, closest first, without the user itself and padded with -1 for clusters smaller than k + 1. vectors[i] is the embedding of annoy index i.
+def write_neighbour_lists(vectors, out_dir, cluster_id, k=NEIGHBOUR_LIST_SIZE, block_size=1024):
+    started = time.perf_counter()
+    neighbours = queue_candidates(np.asarray(vectors, dtype=np.float32), k, block_size).astype(np.int32)
+    np.save(os.path.join(out_dir, f"{cluster_id}_neighbours.npy"), neighbours)
+    print(f"neighbour lists of {len(neighbours)} users in cluster {cluster_id} computed in {time.perf_counter() - started:.1f}s")
+
+#the build state records the Like.last_like_date watermark of the last build and when the last full build happened, so the task can decide between an incremental refresh and a full rebuild.
+def load_build_state(base_dir):
+    try:
+        with open(os.path.join(base_dir, BUILD_STATE_FILE), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_build_state(base_dir, state):
+    with open(os.path.join(base_dir, BUILD_STATE_FILE), "w") as f:
+        json.dump(state, f)
+
+#comparison mode: builds embeddings with each engine on the same likes and reports how long it took and how good they are for matching.
+#a random holdout fraction of the likes is hidden from the build. Quality is the fraction of those hidden likes (user_from -> user_to) where user_to shows up among user_from's top_k most similar users, i.e. whether the embedding would have put people who go on to like each other close together. Evaluated on at most max_eval_users users so it stays cheap on big data.
+def compare_embedding_engines(likes_df, engines=("node2vec", "spectral"), embed_dimensions=128, holdout=0.1, top_k=10, max_eval_users=1000, workers=None, seed=0):
+    rng = np.random.default_rng(seed)
+
+    is_test = rng.random(len(likes_df)) < holdout
+    train_df = likes_df[~is_test]
+    test_df = likes_df[is_test]
+
+    adjacency, node_ids = build_like_adjacency(train_df, reciprocal_weight=0.5)
+
+    #only held-out likes between users the engines have seen can be scored
+    known = np.isin(test_df["user_from"].to_numpy(), node_ids) & np.isin(test_df["user_to"].to_numpy(), node_ids)
+    test_df = test_df[known]
+    eval_users = test_df["user_from"].unique()
+    if len(eval_users) > max_eval_users:
+        eval_users = rng.choice(eval_users, size=max_eval_users, replace=False)
+    test_df = test_df[test_df["user_from"].isin(eval_users)]
+
+    report = {}
+    for engine in engines:
+        with tempfile.TemporaryDirectory() as engine_dir:
+            started = time.perf_counter()
+            vectors = EMBEDDING_ENGINES[engine](adjacency, node_ids, embed_dimensions, engine_dir, workers)
+            build_seconds = time.perf_counter() - started
+
+        report[engine] = {
+            "build_seconds": build_seconds,
+            "recall_at_k": heldout_recall_at_k(vectors, node_ids, test_df, top_k),
+            "num_users": len(node_ids),
+            "num_heldout_likes": len(test_df),
+        }
+        print(f"{engine}: {report[engine]}")
+
+    return report
+
+#fraction of the likes in test_df whose user_to is among the top_k nearest neighbours (cosine) of user_from
+def heldout_recall_at_k(vectors, node_ids, test_df, top_k=10):
+    if test_df.empty:
+        return 0.0
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit_vectors = vectors / np.where(norms > 0, norms, 1.0)
+
+    hits = 0
+    for user_from, group in test_df.groupby("user_from"):
+        position = np.searchsorted(node_ids, user_from)
+        similarities = unit_vectors @ unit_vectors[position]
+        similarities[position] = -np.inf
+        neighbours = node_ids[np.argpartition(-similarities, min(top_k, len(node_ids) - 1))[:top_k]]
+        hits += int(np.isin(group["user_to"].to_numpy(), neighbours).sum())
+
+    return hits / len(test_df)
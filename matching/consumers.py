@@ -1,45 +1,27 @@
 import json 
-import jwt
-from users.models import AppUser
+import asyncio
 from django.conf import settings
-from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-import redis.asyncio as redis
-from urllib.parse import parse_qs
+from lyncup.redis_pool import get_redis
 from .tasks import run_matching_algo
+from .redis_queue import join_queue, leave_queue, schedule_matching, register_channel, unregister_channel, refresh_lease
 
 class QueueConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         # print("entered connect method")
 
-        #assign queue name
-
-        self.queue = "queue"
-
         #connect to the Redis
 
-        self.redis = redis.from_url(settings.REDIS_URL, decode_responses=True)
-        query_string = self.scope.get("query_string", b"").decode("utf-8")
-        # print(f"Query string: {query_string}") 
+        #the process-wide client, its pooled connections are shared with every other consumer
+        self.redis = get_redis()
+        self.heartbeat_task = None
+        #the ?token= JWT was already decoded by TokenAuthMiddleware (see lyncup/token_auth.py), which also set self.scope["user_id"]. token_user is None if the token was missing or invalid.
+        user = self.scope.get("token_user")
 
-        query_params = parse_qs(query_string)
-        # query_params will be:
-        # {
-        #     "token": ["abc123"],
-        # }
-        token = query_params.get("token", [None])[0]
+        if user:
 
-        if token:
-
-            #get user
             try:
-                user = await self.get_token_user(token)
-
-                if not user:
-                    print("Invalid user")
-                    await self.close(code=4123)
-                    return
-
 
                 #By setting self.scope["user"] = user, we are linking the authenticated user to this WebSocket connection. This makes it easy to access the user information later in the code for this connection. 
                 #self.scope is a buiklt in property of AsyncWebsocketConsumer
@@ -48,29 +30,29 @@ class QueueConsumer(AsyncWebsocketConsumer):
                 self.scope["firstname"] = user.firstname
                 self.scope["lastname"] = user.lastname
 
-                #saved in Redis for user matching
-                await self.redis.sadd(
-                    self.queue,
-                    self.scope["user_id"],   
-                )
+                #register this connection's channel under the user's id, so the matcher can send the room id straight to it (see matching/notify.py) instead of through a one-member group, whose add, discard and send each cost channels_redis extra sorted-set operations
+                #channel_name is automatically generated by Django Channels for each WebSocket connection
+                #registered before joining the queue, so a match can't come before the channel is known. If the user connects again (e.g. a second tab), the newest connection gets the room id
+                await register_channel(self.redis, self.scope["user_id"], self.channel_name)
 
+                #the user only stays queued while their presence lease keeps being renewed, taken before joining so nobody is queued without one
+                await refresh_lease(self.redis, self.scope["user_id"], settings.QUEUE_LEASE_SECONDS)
 
-                await self.channel_layer.group_add(
-                    #the layer group name will be the user's id, for easy identifying and procesing in task.py
-                    f'user_queue_{self.scope["user_id"]}',
-                    self.channel_name 
-                    #channel_name is automatically generated by Django Channels for each WebSocket connection
-                    #this is like: take this specific WebSocket connection (self.channel_name) and add it to the group (self.groupname).
-                )
+                #saved in Redis for user matching, scored by the time the user joined so the matcher serves the longest waiting first (see matching/redis_queue.py)
+                await join_queue(self.redis, self.scope["user_id"])
+                #start a matching run soon if one is due, rather than waiting for the next beat
+                await self.request_matching()
 
                 await self.accept()
 
+                self.heartbeat_task = asyncio.create_task(self.heartbeat())
+
             except Exception as error:
                 print(error)
                 await self.close(code=4123)
 
         else:
-            print("No token provided, closing connection")
+            print("No valid token provided, closing connection")
             await self.close(code=4123)
             return
 
@@ -81,29 +63,19 @@ class QueueConsumer(AsyncWebsocketConsumer):
 
         try:
 
-            await self.channel_layer.group_discard(
-                f'user_queue_{self.scope["user_id"]}',
-                self.channel_name
-            )
+            if self.heartbeat_task:
+                self.heartbeat_task.cancel()
 
+            #only removes the entry if it is still this connection's
+            await unregister_channel(self.redis, self.scope["user_id"], self.channel_name)
 
-            if await self.redis.exists(self.queue):
-                await self.redis.srem(self.queue, self.scope["user_id"])
 
-            #check what's left in Redis
-            membersSet = await self.redis.smembers(self.queue)
-            # print("whats left in Redis queue:")
-            # print(membersSet)
+            #also takes the user out of a running matching tick's claimed batch, so the matcher drops any group they were put into
+            await leave_queue(self.redis, self.scope["user_id"])
 
-            # #if no one is left in the group, we must delete the groupname from Redis user tracking
-            # if not membersSet:
-            #     await self.redis.delete(self.groupname)
 
 
-
-            #must close redis for this consumer instance
-            if self.redis:
-                await self.redis.aclose()
+            #self.redis is the shared client (see lyncup/redis_pool.py), it stays open for the other consumers
 
         except Exception as error:
             print(error)
@@ -124,23 +96,21 @@ class QueueConsumer(AsyncWebsocketConsumer):
 
 
 
-    #the decorator converts sychronouse function to asynchronous, more suitable for websocket.
-    @database_sync_to_async
-    def get_token_user(self, token):
-
-        # print("entered get_token_user method")
+    #renews the presence lease while the connection is open. If this process dies, or the disconnect below never runs, the renewals stop and the matcher sweeps the user out of the queue once the lease runs out (see sweep_expired in redis_queue.py)
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(settings.QUEUE_HEARTBEAT_SECONDS)
+            try:
+                await refresh_lease(self.redis, self.scope["user_id"], settings.QUEUE_LEASE_SECONDS)
+            except Exception as error:
+                print(error)
 
+    #see schedule_matching in redis_queue.py, a failure here only means the user waits for the periodic run
+    async def request_matching(self):
         try:
-
-            data = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-
-            self.scope["user_id"] = data['user_id']
-
-            return AppUser.objects.get(id=data['user_id'])
-
-        except jwt.ExpiredSignatureError:
-            print("Token has expired")
-            return None
+            countdown = await schedule_matching(self.redis, settings.MATCHING_TRIGGER_QUEUE_SIZE, settings.MATCHING_TRIGGER_DEBOUNCE, settings.MATCHING_TRIGGER_MAX_WAIT)
+            if countdown is not None:
+                #publishing to the broker is blocking I/O, so it runs in a thread
+                await sync_to_async(run_matching_algo.apply_async)(countdown=float(countdown))
         except Exception as error:
             print(error)
-            return None
\ No newline at end of file
@@ -10,19 +10,22 @@ def distribute_rooms(grouped_users: Dict[str, List['UserEntry']], redis_client
     matched_groups = []
     users_in_matched_groups = []
 
-    #no need try catch block with .incr() as it will create the key if it does not exist, won't throw error. incr() already returns an int, so int(...) is redundant.
+    num_groups = sum(len(groups_in_cluster) for groups_in_cluster in grouped_users.values())
+    if num_groups == 0:
+        return matched_groups, users_in_matched_groups
+
+    #room ids for the whole tick are reserved with one atomic INCRBY instead of one INCR per group, so a tick costs one Redis round trip however many groups formed. If "last_room_id" doesn't exist, Redis creates it with value 0 first.
+    #INCRBY returns the new value, so this tick owns the ids last_room_id - num_groups + 1 up to last_room_id and no other tick can get any of them.
     #note "last_room_id" is stored in a Redis string, not a set, list, hash, or anything else, unlike what we have done with the queue. 
-    #if last_room_id doesn't already exist, it will be 0 automatically
-    last_room_id = redis_client.incr("last_room_id")
+    last_room_id = redis_client.incrby("last_room_id", num_groups)
+    new_room_id = last_room_id - num_groups
 
-    #keep getting a room id not being used now
     for cluster_id, groups_in_cluster in grouped_users.items():
         # if cluster_id == "leftover":
         #     continue
 
         for group in groups_in_cluster:
-            # atomic counter to prevent race conditions. If "last_room_id" doesn’t exist in Redis, Redis will create it with value 0, then increment result to 1, if "last_room_id" already exists, Redis increments the existing integer by 1.
-            new_room_id = redis_client.incr("last_room_id")  
+            new_room_id += 1
 
             matched_group = {"room_id": new_room_id, "user_ids": []}
             
@@ -0,0 +1,313 @@
+import heapq
+import time
+import numpy as np
+
+
+#group-formation engines: split a batch of queued users into groups of 3 to 4.
+#every engine takes (unit_vectors, candidates, deadline):
+# unit_vectors  (num_users, d) normalised embeddings of the queued users, so a dot product is their cosine similarity
+# candidates    (num_users, k) positions of each user's most similar queued users, most similar first, -1 padded (see queue_candidates)
+# deadline      time.perf_counter() value by which the engine must return, None for no limit
+#and returns (groups, unassigned): groups is a list of lists of positions, unassigned the positions that didn't get a group (they go to the leftover queue).
+#the quality of a grouping is its total intra-group similarity, the sum of the cosine similarities of every pair of users in the same group.
+
+MIN_GROUP_SIZE = 3
+MAX_GROUP_SIZE = 4
+
+#how many of each user's candidates are used as merge edges. More edges cost time and rarely change the result, the best partners are at the front of the list.
+AGGLOMERATION_NEIGHBOURS = 10
+
+#how often (in loop iterations) the deadline is checked. A check is a perf_counter call, far cheaper than the iterations it covers
+DEADLINE_CHECK_EVERY = 64
+
+#rows of similarities computed at once by queue_candidates and completion
+QUEUE_BLOCK_SIZE = 1024
+
+def past(deadline):
+    return deadline is not None and time.perf_counter() > deadline
+
+
+#the current algorithm: go through the users in queue order, give each one the (up to 3) most similar users that are still free, and send users who can't get at least 2 partners to the leftover queue. Kept as the baseline for the benchmark (tests/matching_algo_eval/benchmark_group_formation.py).
+def greedy_groups(unit_vectors, candidates, deadline=None):
+    num_users = len(unit_vectors)
+    assigned = np.zeros(num_users, dtype=bool)
+    groups = []
+    unassigned = []
+
+    for position in range(num_users):
+        if position % DEADLINE_CHECK_EVERY == 0 and past(deadline):
+            unassigned.extend(np.flatnonzero(~assigned).tolist())
+            break
+        if assigned[position]:
+            continue
+        assigned[position] = True
+
+        matched = [candidate for candidate in candidates[position].tolist() if candidate >= 0 and not assigned[candidate]][:MAX_GROUP_SIZE - 1]
+        if len(matched) < MIN_GROUP_SIZE - 1:
+            unassigned.append(position)
+            continue
+
+        assigned[matched] = True
+        groups.append([position] + matched)
+
+    return groups, unassigned
+
+
+#global optimiser, in three steps:
+# 1. agglomeration: every user starts as their own group, and the two groups with the highest average similarity between them (as long as together they have at most 4 users) are merged, again and again, using a max-heap of candidate edges.
+# 2. completion: groups that are still too small are merged with each other the same way, now along edges between their centroids, and the remaining single users join the 3-user group they fit best.
+# 3. refinement: local search that swaps two users between groups, or moves a user from a 4-group to a 3-group, whenever that raises the total intra-group similarity, until nothing improves or the deadline.
+#whatever step the deadline hits, the groups formed so far are valid and returned, users not yet in a full group are unassigned.
+def agglomerative_groups(unit_vectors, candidates, deadline=None):
+    num_users = len(unit_vectors)
+    if num_users < MIN_GROUP_SIZE:
+        return [], list(range(num_users))
+
+    grouping = Grouping(unit_vectors)
+    #the candidate search may already have used up the budget
+    if past(deadline):
+        return grouping.result()
+
+    neighbours = candidates[:, :AGGLOMERATION_NEIGHBOURS]
+    rows = np.repeat(np.arange(num_users), neighbours.shape[1])
+    cols = neighbours.ravel()
+    valid = cols >= 0
+    grouping.agglomerate(rows[valid], cols[valid], deadline)
+
+    if not past(deadline):
+        grouping.complete(deadline)
+    if not past(deadline):
+        grouping.refine(neighbours, deadline)
+
+    return grouping.result()
+
+
+#the engines run_batch_matching can pick from
+GROUP_FORMATION_ENGINES = {
+    "greedy": greedy_groups,
+    "agglomerative": agglomerative_groups,
+}
+
+
+#groups as member lists plus the sum of their members' unit vectors. With unit vectors the total pairwise similarity inside a group g is (|sum_g|^2 - |g|) / 2 and the similarity of user u to the rest of g is u . sum_g - 1, so every merge, move or swap is scored from the sums without looking at pairs.
+class Grouping:
+    def __init__(self, unit_vectors):
+        self.unit_vectors = unit_vectors
+        num_users = len(unit_vectors)
+        self.group_of = np.arange(num_users)
+        self.members = [[position] for position in range(num_users)]
+        self.sizes = np.ones(num_users, dtype=np.int64)
+        self.sums = unit_vectors.astype(np.float64)
+        #groups touched by refinement moves in the current pass
+        self.changed = set()
+
+    def size(self, group):
+        return self.sizes[group]
+
+    #average similarity between the users of group a and those of group b
+    def linkage(self, a, b):
+        return float(self.sums[a] @ self.sums[b]) / (self.size(a) * self.size(b))
+
+    def merge(self, a, b):
+        if self.size(a) < self.size(b):
+            a, b = b, a
+        self.group_of[self.members[b]] = a
+        self.members[a].extend(self.members[b])
+        self.members[b] = []
+        self.sizes[a] += self.sizes[b]
+        self.sizes[b] = 0
+        self.sums[a] += self.sums[b]
+        self.sums[b] = 0.0
+        return a
+
+    #lazy greedy average-linkage merging along the given edges (pairs of users, any of whose groups may be merged). A popped edge whose linkage changed since it was pushed goes back on the heap with its current value.
+    def agglomerate(self, users_a, users_b, deadline):
+        if not len(users_a):
+            return
+        similarities = np.einsum("ij,ij->i", self.unit_vectors[users_a], self.unit_vectors[users_b])
+        heap = list(zip((-similarities).tolist(), users_a.tolist(), users_b.tolist()))
+        heapq.heapify(heap)
+
+        steps = 0
+        while heap:
+            steps += 1
+            if steps % DEADLINE_CHECK_EVERY == 0 and past(deadline):
+                return
+            negative_score, user_a, user_b = heapq.heappop(heap)
+            a, b = self.group_of[user_a], self.group_of[user_b]
+            if a == b or self.size(a) + self.size(b) > MAX_GROUP_SIZE:
+                continue
+
+            score = self.linkage(a, b)
+            if score < -negative_score - 1e-9:
+                heapq.heappush(heap, (-score, user_a, user_b))
+                continue
+            self.merge(a, b)
+
+    def groups_of_size(self, sizes):
+        return [group for group, members in enumerate(self.members) if len(members) in sizes]
+
+    #every step checks the deadline, so whatever is merged when it hits stays valid and the rest is left unassigned
+    def complete(self, deadline):
+        #small groups merge with each other along their most similar centroids
+        small = self.groups_of_size(range(1, MIN_GROUP_SIZE))
+        if len(small) > 1:
+            centroids = self.sums[small]
+            centroid_candidates = queue_candidates(centroids, top_k=AGGLOMERATION_NEIGHBOURS, deadline=deadline)
+            if past(deadline):
+                return
+            rows = np.repeat(np.arange(len(small)), centroid_candidates.shape[1])
+            cols = centroid_candidates.ravel()
+            valid = cols >= 0
+            #any member represents its group in an edge
+            representatives = np.array([self.members[group][0] for group in small])
+            self.agglomerate(representatives[rows[valid]], representatives[cols[valid]], deadline)
+
+        #single users left join the 3-user group they are most similar to, best fits first
+        singles = [self.members[group][0] for group in self.groups_of_size({1})]
+        open_groups = self.groups_of_size({MIN_GROUP_SIZE})
+        if not singles or not open_groups:
+            return
+
+        #each single's best group, scored block_size singles at a time so neither memory nor the time between deadline checks grows with the queue
+        centroids = self.sums[open_groups] / MIN_GROUP_SIZE
+        best = np.empty(len(singles), dtype=np.int64)
+        best_scores = np.empty(len(singles))
+        for start in range(0, len(singles), QUEUE_BLOCK_SIZE):
+            if past(deadline):
+                return
+            scores = self.unit_vectors[singles[start:start + QUEUE_BLOCK_SIZE]] @ centroids.T
+            best[start:start + QUEUE_BLOCK_SIZE] = scores.argmax(axis=1)
+            best_scores[start:start + QUEUE_BLOCK_SIZE] = scores.max(axis=1)
+
+        for single in np.argsort(-best_scores, kind="stable").tolist():
+            if past(deadline):
+                return
+            group = open_groups[best[single]]
+            if self.size(group) >= MAX_GROUP_SIZE:
+                #the best group filled up meanwhile, take the best one still open
+                remaining = [index for index, open_group in enumerate(open_groups) if self.size(open_group) < MAX_GROUP_SIZE]
+                if not remaining:
+                    return
+                group = open_groups[remaining[int(np.argmax(centroids[remaining] @ self.unit_vectors[singles[single]]))]]
+            self.merge(group, self.group_of[singles[single]])
+
+    #local search over moves and swaps with the groups of each user's candidates. The first pass looks at every user, later passes only at the members of groups that changed in the pass before, as nothing else can have become improvable.
+    def refine(self, neighbours, deadline, max_passes=5):
+        users = range(len(self.unit_vectors))
+        for _ in range(max_passes):
+            self.changed = set()
+            for step, user in enumerate(users):
+                if step % DEADLINE_CHECK_EVERY == 0 and past(deadline):
+                    return
+                self.try_improve(user, neighbours[user])
+            if not self.changed:
+                return
+            users = sorted(user for group in self.changed for user in self.members[group])
+
+    def try_improve(self, user, user_neighbours):
+        a = self.group_of[user]
+        size_a = self.size(a)
+        if size_a < MIN_GROUP_SIZE:
+            return False
+
+        others = user_neighbours[user_neighbours >= 0]
+        other_groups = self.group_of[others]
+        keep = (other_groups != a) & (self.sizes[other_groups] >= MIN_GROUP_SIZE)
+        others = others[keep]
+        other_groups = other_groups[keep]
+        if not others.size:
+            return False
+
+        vector = self.unit_vectors[user]
+        sum_a = self.sums[a]
+        user_to_a = vector @ sum_a - 1.0
+
+        #swap user with other: user joins other's group and other joins user's group
+        user_to_b = self.sums[other_groups] @ vector
+        others_to_a = self.unit_vectors[others] @ sum_a
+        others_to_b = np.einsum("ij,ij->i", self.unit_vectors[others], self.sums[other_groups])
+        user_other = self.unit_vectors[others] @ vector
+        swap_gains = user_to_b - user_to_a + others_to_a - others_to_b - 2.0 * user_other + 1.0
+
+        #move user into a 3-group, only from a 4-group so both stay valid
+        if size_a == MAX_GROUP_SIZE:
+            movable = self.sizes[other_groups] == MIN_GROUP_SIZE
+            move_gains = np.where(movable, user_to_b - user_to_a, -np.inf)
+        else:
+            move_gains = np.full(len(others), -np.inf)
+
+        best_swap = int(np.argmax(swap_gains))
+        best_move = int(np.argmax(move_gains))
+        if max(swap_gains[best_swap], move_gains[best_move]) <= 1e-9:
+            return False
+
+        if move_gains[best_move] >= swap_gains[best_swap]:
+            self.move(user, a, other_groups[best_move])
+        else:
+            other = int(others[best_swap])
+            b = other_groups[best_swap]
+            self.move(user, a, b)
+            self.move(other, b, a)
+        return True
+
+    def move(self, user, from_group, to_group):
+        self.members[from_group].remove(user)
+        self.members[to_group].append(user)
+        self.sizes[from_group] -= 1
+        self.sizes[to_group] += 1
+        self.group_of[user] = to_group
+        self.changed.update((from_group, to_group))
+        self.sums[from_group] -= self.unit_vectors[user]
+        self.sums[to_group] += self.unit_vectors[user]
+
+    def result(self):
+        groups = [members for members in self.members if len(members) >= MIN_GROUP_SIZE]
+        unassigned = [user for members in self.members if 0 < len(members) < MIN_GROUP_SIZE for user in members]
+        return groups, unassigned
+
+
+#for every row of vectors the positions of its top_k most cosine-similar other rows, most similar first, padded with -1 when there are fewer than top_k other rows.
+#similarities are computed block_size rows at a time, so memory stays at block_size * len(vectors) floats however long the queue gets.
+#the deadline (a time.perf_counter() value, None for no limit) is checked before every block, and rows not reached by then keep only -1, so the engines leave those users unassigned.
+#with a deadline the first block is a short one to measure the rate, and every later block is cut down to the rows that fit in what is left of the budget at that rate.
+def queue_candidates(vectors, top_k=50, block_size=QUEUE_BLOCK_SIZE, deadline=None):
+    num_users = len(vectors)
+    k = min(top_k, num_users - 1)
+    candidates = np.full((num_users, top_k), -1, dtype=np.int64)
+    if k < 1:
+        return candidates
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit_vectors = vectors / np.where(norms > 0, norms, 1.0)
+
+    rows = block_size if deadline is None else min(block_size, 64)
+    start = 0
+    while start < num_users:
+        if past(deadline):
+            break
+        end = min(start + rows, num_users)
+        block_started = time.perf_counter()
+        similarities = unit_vectors[start:end] @ unit_vectors.T
+        #a user is never their own candidate
+        similarities[np.arange(end - start), np.arange(start, end)] = -np.inf
+
+        #argpartition finds the top k in linear time, only those k are then sorted
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1, kind="stable")
+        candidates[start:end, :k] = np.take_along_axis(top, order, axis=1)
+
+        if deadline is not None:
+            seconds_per_row = (time.perf_counter() - block_started) / (end - start)
+            rows = int(min(block_size, max(1.0, (deadline - time.perf_counter()) / seconds_per_row)))
+        start = end
+
+    return candidates
+
+#total intra-group similarity of groups, the quantity the engines try to maximise
+def grouping_similarity(unit_vectors, groups):
+    total = 0.0
+    for group in groups:
+        group_sum = unit_vectors[group].sum(axis=0)
+        total += (float(group_sum @ group_sum) - len(group)) / 2.0
+    return total
@@ -0,0 +1,128 @@
+import json
+import os
+import numpy as np
+
+
+#binary replacement for the {cluster_id}_map.json user <-> annoy index maps.
+#three flat int64 arrays per cluster, saved as .npy so they can be memory-mapped instead of parsed:
+# {cluster_id}_user_ids.npy     sorted user ids
+# {cluster_id}_positions.npy    annoy index of user_ids[i]
+# {cluster_id}_index_users.npy  user id of annoy index j
+#user id -> index is a binary search (np.searchsorted) and index -> user id a plain array lookup, both vectorised for whole batches of users. That is 24 bytes per user, loaded near instantly, instead of two string-keyed json dicts.
+class UserIndexMap:
+    def __init__(self, user_ids, positions, index_users):
+        self.user_ids = user_ids
+        self.positions = positions
+        self.index_users = index_users
+
+    #user_list[i] is the user stored at annoy index i
+    @classmethod
+    def from_user_list(cls, user_list):
+        index_users = np.asarray(user_list, dtype=np.int64)
+        order = np.argsort(index_users, kind="stable")
+        return cls(index_users[order], order.astype(np.int64), index_users)
+
+    def save(self, out_dir, cluster_id):
+        np.save(os.path.join(out_dir, f"{cluster_id}_user_ids.npy"), self.user_ids)
+        np.save(os.path.join(out_dir, f"{cluster_id}_positions.npy"), self.positions)
+        np.save(os.path.join(out_dir, f"{cluster_id}_index_users.npy"), self.index_users)
+
+    #memory-maps the arrays by default. Falls back to the old {cluster_id}_map.json for index versions built before the binary format. Raises FileNotFoundError if neither exists.
+    @classmethod
+    def load(cls, base_dir, cluster_id, mmap=True):
+        user_ids_path = os.path.join(base_dir, f"{cluster_id}_user_ids.npy")
+        if not os.path.exists(user_ids_path):
+            return cls.load_legacy_json(base_dir, cluster_id)
+
+        mmap_mode = "r" if mmap else None
+        return cls(
+            np.load(user_ids_path, mmap_mode=mmap_mode),
+            np.load(os.path.join(base_dir, f"{cluster_id}_positions.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(base_dir, f"{cluster_id}_index_users.npy"), mmap_mode=mmap_mode),
+        )
+
+    @classmethod
+    def load_legacy_json(cls, base_dir, cluster_id):
+        with open(os.path.join(base_dir, f"{cluster_id}_map.json"), "r") as f:
+            map_data = json.load(f)
+        index_user_map = map_data["index_user_map"]
+        return cls.from_user_list([index_user_map[str(i)] for i in range(len(index_user_map))])
+
+    @staticmethod
+    def exists(base_dir, cluster_id):
+        return os.path.exists(os.path.join(base_dir, f"{cluster_id}_user_ids.npy")) or os.path.exists(os.path.join(base_dir, f"{cluster_id}_map.json"))
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        return self.index_of(user_id) is not None
+
+    #annoy index of user_id, or None if the user is not in the index
+    def index_of(self, user_id):
+        slot = int(np.searchsorted(self.user_ids, user_id))
+        if slot < len(self.user_ids) and self.user_ids[slot] == user_id:
+            return int(self.positions[slot])
+        return None
+
+    #vectorised index_of for a batch of users, -1 where a user is not in the index
+    def indices_of(self, user_ids):
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        if not len(self.user_ids):
+            return np.full(len(user_ids), -1, dtype=np.int64)
+        slots = np.minimum(np.searchsorted(self.user_ids, user_ids), len(self.user_ids) - 1)
+        found = self.user_ids[slots] == user_ids
+        return np.where(found, self.positions[slots], -1)
+
+    def user_of(self, index):
+        return int(self.index_users[index])
+
+    #vectorised user_of for a batch of annoy indices
+    def users_of(self, indices):
+        return self.index_users[np.asarray(indices, dtype=np.int64)]
+
+
+#user id -> cluster routing table written next to the per-cluster indexes as user_clusters.npy.
+#user ids are the AppUser primary keys, which are small dense integers, so the table is a flat int16 array indexed directly by user id holding the position of the user's cluster in cluster_ids (-1 for users that aren't in any index). Looking a user up is a single memory-mapped array read, O(1) whatever the number of users, at 2 bytes per user id.
+#the cluster names themselves live in the version manifest ("clusters"), the table only stores their positions.
+USER_CLUSTERS_FILE = "user_clusters.npy"
+
+class UserClusterTable:
+    def __init__(self, codes, cluster_ids):
+        self.codes = codes
+        self.cluster_ids = list(cluster_ids)
+
+    #labels[i] is the position in cluster_ids of the cluster user_list[i] belongs to
+    @classmethod
+    def from_labels(cls, user_list, labels, cluster_ids):
+        user_ids = np.asarray(user_list, dtype=np.int64)
+        size = int(user_ids.max()) + 1 if len(user_ids) else 0
+        codes = np.full(size, -1, dtype=np.int16)
+        codes[user_ids] = np.asarray(labels, dtype=np.int16)
+        return cls(codes, cluster_ids)
+
+    def save(self, out_dir):
+        np.save(os.path.join(out_dir, USER_CLUSTERS_FILE), self.codes)
+
+    #None if the version has no routing table (index versions built before clustering only have the "global" cluster)
+    @classmethod
+    def load(cls, base_dir, cluster_ids, mmap=True):
+        path = os.path.join(base_dir, USER_CLUSTERS_FILE)
+        if not os.path.exists(path):
+            return None
+        return cls(np.load(path, mmap_mode="r" if mmap else None), cluster_ids)
+
+    #cluster id of user_id, or None if the user is not in any index
+    def cluster_of(self, user_id):
+        if not 0 <= user_id < len(self.codes):
+            return None
+        code = int(self.codes[user_id])
+        return self.cluster_ids[code] if code >= 0 else None
+
+    #vectorised cluster_of, returns the cluster position of every user (-1 where the user is not in any index)
+    def codes_of(self, user_ids):
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        in_range = (user_ids >= 0) & (user_ids < len(self.codes))
+        codes = np.full(len(user_ids), -1, dtype=np.int16)
+        codes[in_range] = self.codes[user_ids[in_range]]
+        return codes
@@ -0,0 +1,163 @@
+import json
+import os
+import numpy as np
+from collections import OrderedDict
+from annoy import AnnoyIndex
+from matching.artifacts import resolve_version_dir, load_manifest
+from matching.index_map import UserIndexMap, UserClusterTable
+
+
+#per-process registry of loaded cluster indexes, so a matching tick doesn't open, load or parse anything that an earlier tick in the same worker process already loaded.
+#annoy indexes and user index maps are memory-mapped, keeping them loaded costs address space and page cache rather than heap, but it is still bounded: entries are kept in least recently used order and the oldest are unloaded once the total size of the loaded files goes over max_bytes.
+#entries are keyed by the resolved version directory, so publishing a new version (see matching/artifacts.py) naturally misses the cache. Entries of older versions are dropped the first time a newer version is asked for. For builds without versions (files straight in base_dir) the annoy file's mtime is checked instead.
+
+#default memory budget for the loaded indexes of one process
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+#neighbours are the precomputed neighbour lists written at build time (see write_neighbour_lists in build_graph_annoy.py), vectors the users' embeddings by annoy index. Either is None for versions built without them
+class LoadedCluster:
+    def __init__(self, annoy_index, index_map, embed_dimensions, mtime, size_bytes, neighbours=None, vectors=None):
+        self.annoy_index = annoy_index
+        self.index_map = index_map
+        self.embed_dimensions = embed_dimensions
+        self.neighbours = neighbours
+        self.vectors = vectors
+        self.mtime = mtime
+        self.size_bytes = size_bytes
+
+    def unload(self):
+        self.annoy_index.unload()
+
+
+class IndexRegistry:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.clusters = OrderedDict()
+        self.cluster_tables = {}
+        self.manifests = {}
+        self.total_bytes = 0
+
+    #the loaded index of cluster_id in version_dir (an already resolved version directory), or None if its files are missing
+    def get(self, version_dir, cluster_id):
+        key = (version_dir, cluster_id)
+        ann_file = os.path.join(version_dir, f"cluster_{cluster_id}.ann")
+        try:
+            mtime = os.stat(ann_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        cluster = self.clusters.get(key)
+        if cluster is not None and cluster.mtime == mtime:
+            self.clusters.move_to_end(key)
+            return cluster
+
+        if cluster is not None:
+            #same path but the file was rewritten (unversioned builds only)
+            self.evict(key)
+
+        self.drop_other_versions(version_dir)
+
+        try:
+            cluster = self.load(version_dir, cluster_id, ann_file, mtime)
+        except (FileNotFoundError, OSError):
+            return None
+
+        self.clusters[key] = cluster
+        self.total_bytes += cluster.size_bytes
+        self.shrink(keep=key)
+        return cluster
+
+    #manifest of version_dir, read once per version. Versions are never modified after publishing, so it can't go stale.
+    def get_manifest(self, version_dir):
+        if version_dir not in self.manifests:
+            self.manifests = {version_dir: load_manifest(version_dir)}
+        return self.manifests[version_dir]
+
+    #user -> cluster routing table of version_dir (None if the version has none), loaded once per version
+    def get_cluster_table(self, version_dir, cluster_ids):
+        if version_dir not in self.cluster_tables:
+            self.cluster_tables = {version_dir: UserClusterTable.load(version_dir, cluster_ids)}
+        return self.cluster_tables[version_dir]
+
+    def load(self, version_dir, cluster_id, ann_file, mtime):
+        index_map = UserIndexMap.load(version_dir, cluster_id)
+        manifest = self.get_manifest(version_dir)
+        if manifest is not None:
+            embed_dimensions = manifest["embed_dimensions"]
+        else:
+            #index versions built before manifests keep it in the json map
+            embed_dimensions = load_legacy_embed_dimensions(version_dir, cluster_id)
+
+        annoy_index = AnnoyIndex(embed_dimensions, 'angular')
+        #load() memory-maps the file rather than reading it, so all worker processes share the same pages through the OS page cache
+        annoy_index.load(ann_file)
+
+        neighbours = load_neighbour_lists(version_dir, cluster_id)
+        vectors = load_vectors(version_dir, cluster_id)
+
+        size_bytes = os.path.getsize(ann_file) + index_map.user_ids.nbytes + index_map.positions.nbytes + index_map.index_users.nbytes
+        if neighbours is not None:
+            size_bytes += neighbours.nbytes
+        if vectors is not None:
+            size_bytes += vectors.nbytes
+        print(f"loaded cluster {cluster_id} index from {version_dir} ({size_bytes} bytes)")
+        return LoadedCluster(annoy_index, index_map, embed_dimensions, mtime, size_bytes, neighbours, vectors)
+
+    def evict(self, key):
+        cluster = self.clusters.pop(key)
+        self.total_bytes -= cluster.size_bytes
+        cluster.unload()
+
+    def drop_other_versions(self, version_dir):
+        for key in [key for key in self.clusters if key[0] != version_dir]:
+            self.evict(key)
+
+    #unloads least recently used clusters until the budget is met, never the one that was just loaded
+    def shrink(self, keep=None):
+        for key in list(self.clusters):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key != keep:
+                self.evict(key)
+
+    def clear(self):
+        for key in list(self.clusters):
+            self.evict(key)
+        self.cluster_tables = {}
+        self.manifests = {}
+
+    #loads every published cluster of base_dir up front (as far as the budget allows), e.g. when a worker process starts, so the first matching tick doesn't pay for it
+    def warm_up(self, base_dir):
+        version_dir = resolve_version_dir(base_dir)
+        manifest = self.get_manifest(version_dir)
+        cluster_ids = manifest.get("clusters", ["global"]) if manifest is not None else ["global"]
+
+        self.get_cluster_table(version_dir, cluster_ids)
+        loaded = 0
+        for cluster_id in cluster_ids:
+            if self.get(version_dir, cluster_id) is not None:
+                loaded += 1
+        return loaded
+
+
+#memory-mapped precomputed neighbour lists of the cluster, None if the version has none
+def load_neighbour_lists(version_dir, cluster_id):
+    neighbours_path = os.path.join(version_dir, f"{cluster_id}_neighbours.npy")
+    if not os.path.exists(neighbours_path):
+        return None
+    return np.load(neighbours_path, mmap_mode="r")
+
+#memory-mapped embeddings of the cluster's users, None if the version has none
+def load_vectors(version_dir, cluster_id):
+    vectors_path = os.path.join(version_dir, f"{cluster_id}_vectors.npy")
+    if not os.path.exists(vectors_path):
+        return None
+    return np.load(vectors_path, mmap_mode="r")
+
+def load_legacy_embed_dimensions(version_dir, cluster_id):
+    with open(os.path.join(version_dir, f"{cluster_id}_map.json"), "r") as f:
+        return json.load(f)["embed_dimensions"]
+
+
+#the registry of this process
+registry = IndexRegistry()
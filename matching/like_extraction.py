@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+from itertools import islice
+from users.models import Like
+
+
+#streams (user_from_id, user_to_id, like_count) out of Postgres into preallocated numpy arrays, chunk by chunk, and returns them as a likes_df ready for create_node2vec_annoy.
+#.iterator(chunk_size=...) makes Django use a server-side cursor on Postgres, so only chunk_size rows ever exist as python tuples at any one time. values_list skips model instances entirely and there is no select_related join, we only need the two foreign key ids which are already columns of the Like table.
+#queryset can be passed in to restrict the rows (e.g. filter on last_like_date), otherwise the whole Like table is read.
+def load_likes_df(queryset=None, chunk_size=50000):
+
+    if queryset is None:
+        queryset = Like.objects.all()
+
+    #order_by() with no args drops any default ordering, which would otherwise force Postgres to sort the whole table before streaming
+    queryset = queryset.order_by()
+
+    #count first so the arrays can be allocated once. rows inserted between the count and the read are handled by growing the arrays below.
+    capacity = queryset.count()
+    user_from = np.empty(capacity, dtype=np.int64)
+    user_to = np.empty(capacity, dtype=np.int64)
+    like_count = np.empty(capacity, dtype=np.int32)
+    filled = 0
+
+    rows = queryset.values_list("user_from_id", "user_to_id", "like_count").iterator(chunk_size=chunk_size)
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        #one (k, 3) int64 block per chunk, then copied into the preallocated columns
+        block = np.array(chunk, dtype=np.int64)
+        end = filled + len(block)
+
+        if end > len(user_from):
+            new_capacity = max(end, 2 * len(user_from))
+            user_from = np.resize(user_from, new_capacity)
+            user_to = np.resize(user_to, new_capacity)
+            like_count = np.resize(like_count, new_capacity)
+
+        user_from[filled:end] = block[:, 0]
+        user_to[filled:end] = block[:, 1]
+        like_count[filled:end] = block[:, 2]
+        filled = end
+
+    #rows deleted between the count and the read leave unused slots at the end
+    return pd.DataFrame({
+        "user_from": user_from[:filled],
+        "user_to": user_to[:filled],
+        "like_count": like_count[:filled],
+    }, copy=False)
@@ -0,0 +1,82 @@
+import numpy as np
+from matching.redis_queue import acquire_lock
+
+
+#Redis bitmap of the users who may be matched (active and verified), bit user_id set for each of them. AppUser ids are small dense integers, so the bitmap is about one bit per user ever created: 125KB per million.
+#run_matching_algo checks a whole claimed batch against it with one pipelined round trip instead of a database query per tick.
+#kept up to date by the AppUser post_save/post_delete signals (see users/signals.py), and rebuilt from the database by rebuild_matchable_users_task (schedule it periodically in celery beat) to repair anything the signals missed, e.g. bulk updates, which don't send signals.
+MATCHABLE_KEY = "matchable_users"
+#a rebuild reads the database and then replaces the whole bitmap, which would undo any bit set in between. While REBUILDING_KEY exists (a lock held by the rebuild), set_matchable also logs every change to CHANGES_KEY (user id -> bit), and the rebuild applies them on top of what it read (see rebuild_matchable)
+REBUILDING_KEY = f"{MATCHABLE_KEY}:rebuilding"
+CHANGES_KEY = f"{MATCHABLE_KEY}:changes"
+#seconds; a rebuild that takes longer stops having its changes logged, see rebuild_matchable
+REBUILD_TTL = 600
+
+#KEYS: bitmap, rebuilding, changes. ARGV: user id, bit. Returns the old bit
+SET_MATCHABLE_SCRIPT = """
+local old = redis.call('SETBIT', KEYS[1], ARGV[1], ARGV[2])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+end
+return old
+"""
+
+#KEYS: bitmap, rebuilding, changes. ARGV: bitmap bytes, rebuild lock token. Replaces the bitmap and applies the changes logged since the rebuild started.
+#returns 1, or 0 if the rebuild outlived REBUILD_TTL: changes after that weren't logged, and if a newer rebuild has started meanwhile the bitmap is left to it
+FINISH_REBUILD_SCRIPT = """
+local holder = redis.call('GET', KEYS[2])
+if holder and holder ~= ARGV[2] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1])
+local changes = redis.call('HGETALL', KEYS[3])
+for i = 1, #changes, 2 do
+    redis.call('SETBIT', KEYS[1], changes[i], changes[i + 1])
+end
+redis.call('DEL', KEYS[2], KEYS[3])
+if holder then
+    return 1
+end
+return 0
+"""
+
+
+def is_matchable(user):
+    return user.is_active and user.is_verified
+
+#works on a pipeline too, the script then runs with the pipeline
+def set_matchable(redis_client, user_id, matchable):
+    return redis_client.register_script(SET_MATCHABLE_SCRIPT)(keys=[MATCHABLE_KEY, REBUILDING_KEY, CHANGES_KEY], args=[user_id, 1 if matchable else 0])
+
+#the matchable users among user_ids, or None if the bitmap hasn't been built yet (then the caller has to ask the database)
+def matchable_of(redis_client, user_ids):
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.exists(MATCHABLE_KEY)
+    for user_id in user_ids:
+        pipeline.getbit(MATCHABLE_KEY, user_id)
+    results = pipeline.execute()
+    if not results[0]:
+        return None
+    return {user_id for user_id, bit in zip(user_ids, results[1:]) if bit}
+
+#bitmap bytes for the given ids. Redis numbers bits from the most significant bit of the first byte, which is np.packbits' default order
+def build_bitmap(user_ids):
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    if not len(user_ids):
+        return b""
+    bits = np.zeros(int(user_ids.max()) + 1, dtype=bool)
+    bits[user_ids] = True
+    return np.packbits(bits).tobytes()
+
+#replaces the bitmap with one built from the ids read_user_ids returns. It is only called once changes are being logged, so any bit set while it reads the database is applied again after the bitmap is replaced. The replacement is one script, so readers never see a half-built bitmap.
+#returns None if another rebuild is already running, otherwise whether every change was logged (False if the rebuild took longer than REBUILD_TTL, the next rebuild repairs what was missed)
+def rebuild_matchable(redis_client, read_user_ids):
+    token = acquire_lock(redis_client, REBUILDING_KEY, REBUILD_TTL)
+    if token is None:
+        return None
+    #changes left over by a rebuild that died are already in the database
+    redis_client.delete(CHANGES_KEY)
+
+    bitmap = build_bitmap(read_user_ids())
+    #an empty string would delete the key, a single zero byte keeps it existing
+    return bool(redis_client.register_script(FINISH_REBUILD_SCRIPT)(keys=[MATCHABLE_KEY, REBUILDING_KEY, CHANGES_KEY], args=[bitmap or b"\x00", token]))
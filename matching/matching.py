@@ -1,30 +1,72 @@
-import json
-from annoy import AnnoyIndex
 import os
+import time
+import numpy as np
 from typing import Dict, Tuple, List
 from matching.queue_manager import UserEntry
-
-
-#this function will load the cluster_{id}.ann and cluster_{id}_map.json files and pop up to batch_size users from the queue to form groups of 4 with greedy algo. Users who are leftovers (can't form a group) will be placed in a cluster queue, if still unmatched, will be placed in the global leftover queue. The batch_size represents the number to pop from this cluster’s queue.
+from matching.artifacts import resolve_version_dir
+from matching.index_map import UserIndexMap
+from matching.index_registry import registry
+from matching.group_formation import queue_candidates, GROUP_FORMATION_ENGINES
+
+
+#the clusters of the published index version, older versions without a manifest only have "global"
+def published_clusters(base_dir):
+    manifest = registry.get_manifest(base_dir)
+    if manifest is None:
+        return ["global"]
+    return manifest.get("clusters", ["global"])
+
+#true if base_dir holds a complete index: an annoy file and a user index map for every cluster
+def index_is_ready(base_dir):
+    return all(
+        os.path.exists(f"{base_dir}/cluster_{cluster_id}.ann") and UserIndexMap.exists(base_dir, cluster_id)
+        for cluster_id in published_clusters(base_dir)
+    )
+
+#puts every queued user straight into the queue of the cluster their embedding belongs to, using the user -> cluster table written by the build (see UserClusterTable). Users that are in no index (e.g. new users without likes) go to the leftover queue for random matching.
+#versions built before clustering have no table, then everyone goes to "global" like before.
+#joined_at (optional, one per user) is kept on the queue entries, pass the users oldest first so pop_oldest serves them in that order.
+def route_users(queue_manager, user_ids, base_dir, joined_at=None):
+    if joined_at is None:
+        joined_at = [None] * len(user_ids)
+    cluster_ids = published_clusters(base_dir)
+    table = registry.get_cluster_table(base_dir, cluster_ids)
+    if table is None:
+        for user_id, user_joined_at in zip(user_ids, joined_at):
+            queue_manager.add("global", int(user_id), user_joined_at)
+        return
+
+    for user_id, user_joined_at, code in zip(user_ids, joined_at, table.codes_of(user_ids).tolist()):
+        if code < 0:
+            queue_manager.add("leftover", int(user_id), user_joined_at)
+        else:
+            queue_manager.add(cluster_ids[code], int(user_id), user_joined_at)
+
+#the annoy indices of user_index's top_k nearest neighbours in the cluster, closest first.
+#read from the neighbour lists precomputed at build time when the version has them (a single slice of a memory-mapped array, the same cost however long the user has been queued), otherwise annoy is queried.
+def candidate_indices(cluster, user_index, top_k):
+    if cluster.neighbours is not None and top_k <= cluster.neighbours.shape[1]:
+        row = cluster.neighbours[user_index, :top_k]
+        return row[row >= 0].tolist()
+
+    #when annoy is queried, the returned indices also include the queried item. So to mitigate that, have to to k+1 and exclude the first item. This returns a list.
+    return cluster.annoy_index.get_nns_by_item(user_index, top_k+1)
+
+#this function will load the cluster_{id}.ann and the cluster's user <-> index map and pop up to batch_size users from the queue to form groups of 4 with greedy algo. Users who are leftovers (can't form a group) will be placed in a cluster queue, if still unmatched, will be placed in the global leftover queue. The batch_size represents the number to pop from this cluster’s queue.
 #the batch size controls the max number of users that can be processed in one matching cycle
 def match_in_cluster(cluster_id, queue_manager, base_dir=None, batch_size=50, top_k=50) -> List[List[UserEntry]]:
     if base_dir is None:
         base_dir = os.path.join(os.path.dirname(__file__), "Annoy")
 
-    try:
-        with open(f"{base_dir}/{cluster_id}_map.json", "r") as f:
-            map_data = json.load(f)
-        embed_dimensions = map_data["embed_dimensions"]
-        user_index_map = map_data["user_index_map"]
-        index_user_map = map_data["index_user_map"]
+    #load from the currently published index version (see matching/artifacts.py), so the map and the index always come from the same build
+    base_dir = resolve_version_dir(base_dir)
 
-        cluster_file = f"{base_dir}/cluster_{cluster_id}.ann"
-        annoy_index = AnnoyIndex(embed_dimensions, 'angular')
-        annoy_index.load(cluster_file)
-
-    except FileNotFoundError:
+    #the annoy index and user index map stay loaded in this process between ticks (see matching/index_registry.py), they are only loaded here the first time or after a new version was published
+    cluster = registry.get(base_dir, cluster_id)
+    if cluster is None:
         print(f"Cluster {cluster_id} not found or Annoy files missing.")
         return []
+    index_map = cluster.index_map
     
     groups_formed = []
 
@@ -32,31 +74,30 @@ def match_in_cluster(cluster_id, queue_manager, base_dir=None, batch_size=50, to
     processed = 0
 
     while queue_manager.get_cluster_size(cluster_id) > 0 and processed < batch_size:
-        user_entry = queue_manager.pop_random(cluster_id)
+        #longest waiting first, so nobody is left in the queue tick after tick
+        user_entry = queue_manager.pop_oldest(cluster_id)
         if not user_entry:
             break
         processed += 1
         user_id = user_entry.user_id
 
-        #try to get top-k from Annoy. if not in user_index map, then skip this user
-        #important: dumping map into JSON will alays turn the key into string, even though it was first saved as int! Therefore, to search in the user_index_map, we need to convert it to str!
-        if str(user_id) not in user_index_map:
+        #try to get top-k from Annoy. if not in the index map, then skip this user
+        user_index = index_map.index_of(user_id)
+        if user_index is None:
             #if user not in map, then push to leftover queue. When a new user has just signed up, they will not have any data in the Likes table, so they will not be in the map. So we need to push them to the leftover queue for random matching.
-            queue_manager.add("leftover", user_id)
+            queue_manager.add("leftover", user_id, user_entry.joined_at)
             continue
 
-        user_index = user_index_map[str(user_id)]
-
-        #when annoy is queried, the returned indices also include the queried item. So to mitigate that, have to to k+1 and exclude the first item. This returns a list.
-        neigh_indices = annoy_index.get_nns_by_item(user_index, top_k+1)
+        neigh_indices = candidate_indices(cluster, user_index, top_k)
+        #translate all neighbour indices to user ids in one go
+        neigh_ids = index_map.users_of(neigh_indices)
 
         matched_entries = []
-        while len(matched_entries) < 3 and neigh_indices:
-            neigh_index = neigh_indices.pop(0)
+        for neigh_index, neigh_id in zip(neigh_indices, neigh_ids.tolist()):
+            if len(matched_entries) >= 3:
+                break
             if neigh_index == user_index:
                 continue
-            #get the neighbour id
-            neigh_id = int(index_user_map[str(neigh_index)])
 
             #get and pop this specific neighbour from the queue
             neigh_entry = queue_manager.get_remove(cluster_id, neigh_id)
@@ -78,9 +119,9 @@ def match_in_cluster(cluster_id, queue_manager, base_dir=None, batch_size=50, to
         #if still fail to find from cluster and no matches at all are found or only 1 other match is found (too few), then push the user and the other matched user to the leftover queue for further matching. We allow matching of total 3 to 4 people.
         if len(matched_entries) < 2:
             #push all leftover users to global queue
-            queue_manager.add("leftover", user_id)
+            queue_manager.add("leftover", user_id, user_entry.joined_at)
             for entry in matched_entries:
-                queue_manager.add("leftover", entry.user_id)
+                queue_manager.add("leftover", entry.user_id, entry.joined_at)
             
             continue
 
@@ -95,8 +136,72 @@ def match_in_cluster(cluster_id, queue_manager, base_dir=None, batch_size=50, to
     return groups_formed
 
 
-                
-def run_batch_matching(queue_manager, base_dir=None, batch_size=50) -> Dict[str, List[List[UserEntry]]]:
+#queue-restricted alternative to match_in_cluster. match_in_cluster looks up each popped user's nearest neighbours in the whole index and then drops all those who aren't queued, so with a few hundred queued users out of many thousands indexed almost every candidate is wasted and in-queue partners beyond top_k are never seen.
+#here only the queued users are compared with each other: their embeddings are taken from the annoy index, and their pairwise cosine similarities computed with one matrix product (in blocks of block_size rows for large queues). Every user's top_k most similar queued users are kept, so no in-queue partner is ever missed, and group_engine (see GROUP_FORMATION_ENGINES in matching/group_formation.py) then splits the batch into groups of 3 to 4 within time_budget seconds. Users it leaves without a group go to the leftover queue.
+def match_queue_in_cluster(cluster_id, queue_manager, base_dir=None, batch_size=50, top_k=50, block_size=1024, group_engine="agglomerative", time_budget=None) -> List[List[UserEntry]]:
+    if base_dir is None:
+        base_dir = os.path.join(os.path.dirname(__file__), "Annoy")
+
+    base_dir = resolve_version_dir(base_dir)
+
+    cluster = registry.get(base_dir, cluster_id)
+    if cluster is None:
+        print(f"Cluster {cluster_id} not found or Annoy files missing.")
+        return []
+
+    #pop the batch, longest waiting first. Users missing from the index go to the leftover queue like in match_in_cluster
+    batch = []
+    while queue_manager.get_cluster_size(cluster_id) > 0 and len(batch) < batch_size:
+        user_entry = queue_manager.pop_oldest(cluster_id)
+        if not user_entry:
+            break
+        batch.append(user_entry)
+
+    user_indices = cluster.index_map.indices_of([entry.user_id for entry in batch])
+    entries = []
+    for user_entry, user_index in zip(batch, user_indices.tolist()):
+        if user_index < 0:
+            queue_manager.add("leftover", user_entry.user_id, user_entry.joined_at)
+        else:
+            entries.append(user_entry)
+    user_indices = user_indices[user_indices >= 0]
+
+    if not entries:
+        return []
+
+    deadline = time.perf_counter() + time_budget if time_budget is not None else None
+
+    if cluster.vectors is not None:
+        #all queued users' vectors in one read of the memory-mapped embeddings
+        vectors = np.asarray(cluster.vectors[user_indices], dtype=np.float32)
+    else:
+        #versions built without the vectors file
+        vectors = np.array([cluster.annoy_index.get_item_vector(user_index) for user_index in user_indices.tolist()], dtype=np.float32)
+    #the candidate search counts against the budget too, the engine gets what is left of it
+    candidates = queue_candidates(vectors, top_k, block_size, deadline)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit_vectors = vectors / np.where(norms > 0, norms, 1.0)
+
+    groups, unassigned = GROUP_FORMATION_ENGINES[group_engine](unit_vectors, candidates, deadline)
+
+    for position in unassigned:
+        queue_manager.add("leftover", entries[position].user_id, entries[position].joined_at)
+
+    return [[entries[position] for position in group] for group in groups]
+
+#mode "annoy" matches a cluster with match_in_cluster, "queue" with match_queue_in_cluster (which takes group_engine and time_budget)
+def match_cluster_batch(cluster_id, queue_manager, base_dir, batch_size, mode="annoy", group_engine="agglomerative", time_budget=None) -> List[List[UserEntry]]:
+    if mode == "queue":
+        return match_queue_in_cluster(cluster_id, queue_manager, base_dir, batch_size, group_engine=group_engine, time_budget=time_budget)
+    return match_in_cluster(cluster_id, queue_manager, base_dir, batch_size)
+
+def run_batch_matching(queue_manager, base_dir=None, batch_size=50, mode="annoy", group_engine="agglomerative", time_budget=None) -> Dict[str, List[List[UserEntry]]]:
+
+    if base_dir is None:
+        base_dir = os.path.join(os.path.dirname(__file__), "Annoy")
+
+    #resolve the published version once, so every cluster of this run is matched against the same build even if a new one is published meanwhile
+    base_dir = resolve_version_dir(base_dir)
 
     res = {}
     clusters = queue_manager.get_all_clusters()
@@ -104,10 +209,16 @@ def run_batch_matching(queue_manager, base_dir=None, batch_size=50) -> Dict[str,
         #skip tghlobal cluster and match the global only after the others are matched
         if cluster_id == "leftover":
             continue
-        groups = match_in_cluster(cluster_id, queue_manager, base_dir, batch_size)
-        res[cluster_id] = groups
+        #no need to load the index of a cluster nobody is queued in
+        if not queue_manager.get_cluster_size(cluster_id):
+            continue
+        res[cluster_id] = match_cluster_batch(cluster_id, queue_manager, base_dir, batch_size, mode, group_engine, time_budget)
 
-    #match the leftover cluster, this will be the leftovers failed to matched previously. That's why we're only matching now as we had to collect them.
+    res["leftover"] = group_leftovers(queue_manager)
+    return res
+
+#match the leftover cluster, this will be the leftovers failed to matched previously. That's why we're only matching now as we had to collect them.
+def group_leftovers(queue_manager) -> List[List[UserEntry]]:
     groups_formed = []
     group = []
     i = 0
@@ -127,8 +238,7 @@ def run_batch_matching(queue_manager, base_dir=None, batch_size=50) -> Dict[str,
         groups_formed.append(group)
 
     # groups = match_in_cluster("leftover", queue_manager, base_dir, batch_size)
-    res["leftover"] = groups_formed
-    return res
+    return groups_formed
 
 
 
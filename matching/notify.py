@@ -0,0 +1,37 @@
+import asyncio
+
+
+#tells every member of the matched groups their room, all of a tick's sends running concurrently in one event loop instead of one async_to_sync hop (and its own set of Redis round trips) per user.
+#at most concurrency sends are in flight at a time, so a big tick doesn't open more Redis connections than the channel layer's pool is meant to handle.
+#channels maps user ids to the channel name their QueueConsumer registered (see register_channel in redis_queue.py), those users are sent to directly with channel_layer.send. Only users without an entry (e.g. connected before registering existed) go through their one-member user_queue_{user_id} group, which costs channels_redis extra sorted-set operations per send.
+#returns (succeeded, failed): the user ids that were sent to, and (user_id, error) for each failed send. A failed send doesn't affect the others.
+async def notify_room_assignments(channel_layer, matched_groups, concurrency=100, channels=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    if channels is None:
+        channels = {}
+
+    async def send(user_id, room_id):
+        #Note: When Celery task sends a message via the channel layer, it doesn't need direct access to the consumer or its methods. Instead, it uses the channel layer as an intermediary to deliver messages to the consumer's channel (or the consumers subscribed to a group).
+        message = {
+            "type": "send_room_id",
+            "room_id": room_id,
+        }
+        async with semaphore:
+            channel_name = channels.get(user_id)
+            if channel_name:
+                await channel_layer.send(channel_name, message)
+            else:
+                await channel_layer.group_send(f'user_queue_{user_id}', message)
+
+    sends = [(user_id, group["room_id"]) for group in matched_groups for user_id in group["user_ids"]]
+    #return_exceptions so one failing user shows up in the results instead of cancelling everyone else
+    results = await asyncio.gather(*(send(user_id, room_id) for user_id, room_id in sends), return_exceptions=True)
+
+    succeeded = []
+    failed = []
+    for (user_id, _), result in zip(sends, results):
+        if isinstance(result, BaseException):
+            failed.append((user_id, result))
+        else:
+            succeeded.append(user_id)
+    return succeeded, failed
@@ -1,10 +1,15 @@
 import time
+import random
+from array import array
 
 class UserEntry:
-    def __init__(self, user_id):
+    #__slots__ drops the per-object __dict__, entries are only created when a user is taken off a queue anyway
+    __slots__ = ("user_id", "joined_at")
+
+    def __init__(self, user_id, joined_at=None):
         self.user_id = user_id
 
-        self.joined_at = time.time()
+        self.joined_at = time.time() if joined_at is None else joined_at
 
     #define __eq__ and __hash__ to compare UserEntry objects by user_id, rather than requiring the same object reference (memory address).
 
@@ -14,37 +19,128 @@ class UserEntry:
     #making sure the unique identifier hash
     def __hash__(self):
         return hash(self.user_id)
-    
-#we will push UserEntry objects into it and pop them based on priority.
+
+    def __repr__(self):
+        return f"UserEntry({self.user_id})"
+
+
+#one cluster's queue, kept in arrival order in two flat arrays (user id and join time, 16 bytes per user) plus a user id -> slot dict, instead of a set of UserEntry objects.
+# - membership and removal are a dict lookup: a removed user's slot is only marked dead (a tombstone), nothing is shifted
+# - oldest-first pops move a head pointer forward past dead slots
+# - random pops draw slots between the head and the end until they hit a live one
+#once the dead slots outnumber the live ones the arrays are compacted (keeping the order), which keeps all of the above O(1) amortised and random draws hitting a live slot at least half the time.
+class ClusterQueue:
+    __slots__ = ("user_ids", "joined_at", "alive", "slots", "head")
+
+    def __init__(self):
+        self.user_ids = array("q")
+        self.joined_at = array("d")
+        self.alive = bytearray()
+        self.slots = {}
+        self.head = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, user_id):
+        return user_id in self.slots
+
+    #live entries, oldest first
+    def __iter__(self):
+        for slot in range(self.head, len(self.user_ids)):
+            if self.alive[slot]:
+                yield UserEntry(self.user_ids[slot], self.joined_at[slot])
+
+    def __repr__(self):
+        return f"ClusterQueue({len(self)} users)"
+
+    #adding a user who is already queued keeps their original place, like adding an equal entry to a set did
+    def add(self, user_id, joined_at=None):
+        if user_id in self.slots:
+            return
+        self.slots[user_id] = len(self.user_ids)
+        self.user_ids.append(user_id)
+        self.joined_at.append(time.time() if joined_at is None else joined_at)
+        self.alive.append(1)
+
+    def remove(self, user_id):
+        slot = self.slots.pop(user_id, None)
+        if slot is None:
+            return None
+        return self.take(slot)
+
+    def pop_oldest(self):
+        if not self.slots:
+            return None
+        while not self.alive[self.head]:
+            self.head += 1
+        slot = self.head
+        del self.slots[self.user_ids[slot]]
+        return self.take(slot)
+
+    def pop_random(self):
+        if not self.slots:
+            return None
+        while True:
+            slot = random.randrange(self.head, len(self.user_ids))
+            if self.alive[slot]:
+                break
+        del self.slots[self.user_ids[slot]]
+        return self.take(slot)
+
+    #marks slot dead and returns its entry
+    def take(self, slot):
+        self.alive[slot] = 0
+        entry = UserEntry(self.user_ids[slot], self.joined_at[slot])
+        if len(self.user_ids) > 2 * len(self.slots) + 32:
+            self.compact()
+        return entry
+
+    def compact(self):
+        live = [slot for slot in range(self.head, len(self.user_ids)) if self.alive[slot]]
+        self.user_ids = array("q", (self.user_ids[slot] for slot in live))
+        self.joined_at = array("d", (self.joined_at[slot] for slot in live))
+        self.alive = bytearray(b"\x01") * len(live)
+        self.slots = {user_id: slot for slot, user_id in enumerate(self.user_ids)}
+        self.head = 0
+
+
+#we will push users into it and pop them based on priority.
+#pop_oldest serves whoever has been waiting longest, so long waiters are matched first and the time-to-match stays bounded however busy the queue gets. Users should therefore be added oldest first (or with their joined_at).
 class ClusterQueueManager:
     def __init__(self):
-        #the cluster id maps to the respective priority queue, implemented in list form.
-        self.cluster_queues = {"global": set(), "leftover": set()}
+        #the cluster id maps to the respective queue
+        self.cluster_queues = {"global": ClusterQueue(), "leftover": ClusterQueue()}
 
-    def add(self, cluster_id, user_id):
+    def add(self, cluster_id, user_id, joined_at=None):
         if cluster_id not in self.cluster_queues:
-            self.cluster_queues[cluster_id] = set()
-        user_entry = UserEntry(user_id)
-        self.cluster_queues[cluster_id].add(user_entry)
-    
+            self.cluster_queues[cluster_id] = ClusterQueue()
+        self.cluster_queues[cluster_id].add(user_id, joined_at)
+
     def get_remove(self, cluster_id, user_id):
         if cluster_id not in self.cluster_queues:
             print(f"cluster {cluster_id} not found.")
             return False
-        #even if don’t know the joined_at date, can still create a new UserEntry object with the same user_id to remove it from the set. This is cuz of overriden hash.
-        user_entry = UserEntry(user_id)
-        if user_entry in self.cluster_queues[cluster_id]:
-            self.cluster_queues[cluster_id].remove(user_entry)
-            return user_entry
-        else:   
+        #a dict lookup, no throwaway UserEntry is needed to find the user
+        user_entry = self.cluster_queues[cluster_id].remove(user_id)
+        if user_entry is None:
             print(f"user {user_id} not found in cluster {cluster_id}")
             return False
+        return user_entry
 
+    #a uniformly random user of the cluster
     def pop_random(self, cluster_id):
         if cluster_id not in self.cluster_queues or not self.cluster_queues[cluster_id]:
             print(f"Cluster {cluster_id} is empty or does not exist.")
             return None
-        return self.cluster_queues[cluster_id].pop()
+        return self.cluster_queues[cluster_id].pop_random()
+
+    #the user of the cluster who has been waiting longest
+    def pop_oldest(self, cluster_id):
+        if cluster_id not in self.cluster_queues or not self.cluster_queues[cluster_id]:
+            print(f"Cluster {cluster_id} is empty or does not exist.")
+            return None
+        return self.cluster_queues[cluster_id].pop_oldest()
 
     def get_cluster_size(self, cluster_id):
         if cluster_id not in self.cluster_queues:
@@ -53,12 +149,3 @@ class ClusterQueueManager:
 
     def get_all_clusters(self):
         return list(self.cluster_queues.keys())
-
-
-
-
-
-    
-
-
-
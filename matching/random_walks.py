@@ -0,0 +1,178 @@
+import os
+import numpy as np
+from billiard import Pool
+
+
+#node2vec second-order random walks generated straight from the csr adjacency built by build_like_adjacency.
+#the node2vec package precomputes a probability table for every (previous node, current node) pair, which grows with the sum of squared degrees, so a few very popular users blow up the memory. Here nothing per edge pair is stored and memory stays linear in the number of edges.
+#the node2vec step from current node v (previous node t) picks neighbour x with probability proportional to weight(v, x) * bias(x), where bias is 1/p for going back to t, 1 for a neighbour that t also links to, and 1/q otherwise. This is sampled on the fly by rejection:
+# - going back to t is split off as its own exactly known part (weight(v, t) / p), so the large 1/p doesn't inflate the envelope for every other neighbour
+# - for the rest a neighbour is proposed from the plain first-order (weight only) distribution and accepted with probability bias / max(1, 1/q). The edge lookup is skipped whenever the uniform draw already decides the outcome.
+#all walks of a round are advanced together with numpy, walkers whose proposal got rejected simply try again.
+class WalkGraph:
+    def __init__(self, adjacency):
+        adjacency = adjacency.tocsr(copy=True)
+        #sorted column indices make the encoded edge keys below globally sorted, which is what allows np.searchsorted for the "is there an edge" check
+        adjacency.sort_indices()
+
+        self.num_nodes = adjacency.shape[0]
+        self.indptr = adjacency.indptr.astype(np.int64)
+        self.indices = adjacency.indices
+        weights = adjacency.data.astype(np.float64)
+
+        #cumulative edge weights over the whole graph with a leading 0, row v owns the range [cum_weights[indptr[v]], cum_weights[indptr[v + 1]]). A uniform draw in that range picks an edge proportionally to its weight.
+        self.cum_weights = np.concatenate([[0.0], np.cumsum(weights)])
+        self.row_weights = self.cum_weights[self.indptr[1:]] - self.cum_weights[self.indptr[:-1]]
+
+        #every edge encoded as row * num_nodes + col, sorted thanks to sort_indices()
+        rows = np.repeat(np.arange(self.num_nodes, dtype=np.int64), np.diff(self.indptr))
+        self.edge_keys = rows * self.num_nodes + self.indices
+
+    #nodes with no outgoing weight are dead ends, walks stop there like in the node2vec package
+    def can_leave(self, nodes):
+        return self.row_weights[nodes] > 0
+
+    #first-order proposal: one neighbour per node in nodes, chosen proportionally to edge weight
+    def propose(self, nodes, rng):
+        low = self.cum_weights[self.indptr[nodes]]
+        draws = low + rng.random(len(nodes)) * self.row_weights[nodes]
+        edges = np.searchsorted(self.cum_weights, draws, side="right") - 1
+        #guard against floating point landing exactly on the upper bound
+        edges = np.clip(edges, self.indptr[nodes], self.indptr[nodes + 1] - 1)
+        return self.indices[edges]
+
+    #position of each (from, to) edge in the csr arrays, and whether it exists at all
+    def find_edges(self, from_nodes, to_nodes):
+        keys = from_nodes.astype(np.int64) * self.num_nodes + to_nodes
+        positions = np.searchsorted(self.edge_keys, keys)
+        positions = np.minimum(positions, len(self.edge_keys) - 1)
+        return positions, self.edge_keys[positions] == keys
+
+    def has_edge(self, from_nodes, to_nodes):
+        return self.find_edges(from_nodes, to_nodes)[1]
+
+    #weight of each (from, to) edge, 0 where there is no edge
+    def edge_weights(self, from_nodes, to_nodes):
+        positions, found = self.find_edges(from_nodes, to_nodes)
+        return np.where(found, self.cum_weights[positions + 1] - self.cum_weights[positions], 0.0)
+
+
+#yields one int32 block of walks per round (num_walks rounds), shape (len(start_nodes), walk_length). Entries are row/column positions of the adjacency (map them through node_ids to get user ids). A walk that hits a dead end is padded with -1.
+#start_nodes defaults to every node, like the node2vec package. They are shuffled every round.
+def iter_walk_blocks(adjacency, walk_length=40, num_walks=80, p=0.5, q=10, start_nodes=None, seed=None):
+    graph = adjacency if isinstance(adjacency, WalkGraph) else WalkGraph(adjacency)
+    rng = np.random.default_rng(seed)
+
+    if start_nodes is None:
+        start_nodes = np.arange(graph.num_nodes)
+    start_nodes = np.asarray(start_nodes, dtype=np.int64)
+
+    inv_p = 1.0 / p
+    inv_q = 1.0 / q
+    #envelope and lower bound of the bias for every neighbour other than the previous node
+    envelope = max(1.0, inv_q)
+    lower = min(1.0, inv_q)
+
+    for _ in range(num_walks):
+        starts = rng.permutation(start_nodes)
+        walks = np.full((len(starts), walk_length), -1, dtype=np.int32)
+        walks[:, 0] = starts
+
+        if walk_length > 1:
+            #the first step has no previous node, so it is first-order only
+            active = np.flatnonzero(graph.can_leave(starts))
+            walks[active, 1] = graph.propose(starts[active], rng)
+
+        for step in range(2, walk_length):
+            active = active[graph.can_leave(walks[active, step - 1])]
+            if not active.size:
+                break
+
+            current = walks[active, step - 1].astype(np.int64)
+            previous = walks[active, step - 2].astype(np.int64)
+            chosen = np.empty(len(active), dtype=np.int32)
+
+            #mass of the "go back" part versus the envelope mass of the proposal part
+            back_mass = graph.edge_weights(current, previous) * inv_p
+            back_share = back_mass / (back_mass + envelope * graph.row_weights[current])
+
+            #rejection sampling, only the walkers that were rejected try again
+            pending = np.arange(len(active))
+            while pending.size:
+                go_back = rng.random(len(pending)) < back_share[pending]
+                chosen[pending[go_back]] = previous[pending[go_back]]
+                pending = pending[~go_back]
+
+                proposals = graph.propose(current[pending], rng)
+                draws = rng.random(len(pending)) * envelope
+
+                #below the lower bound every neighbour is accepted, otherwise look the edge up
+                accepted = draws < lower
+                undecided = np.flatnonzero(~accepted)
+                linked = graph.has_edge(previous[pending[undecided]], proposals[undecided])
+                accepted[undecided] = draws[undecided] < np.where(linked, 1.0, inv_q)
+                #going back is already covered above
+                accepted &= proposals != previous[pending]
+
+                chosen[pending[accepted]] = proposals[accepted]
+                pending = pending[~accepted]
+
+            walks[active, step] = chosen
+
+        yield walks
+
+
+#generates the walk corpus in parallel and writes it to walk_dir as compact int32 .npy files (one per round), so the corpus never has to sit in RAM.
+#the num_walks rounds are split across workers processes, the same way the node2vec package split num_walks across its workers. billiard (celery's fork of multiprocessing) is used because, unlike multiprocessing, it may start child processes from inside a daemonic celery prefork worker.
+#returns the list of walk files written.
+def write_walk_files(adjacency, walk_dir, walk_length=40, num_walks=80, p=0.5, q=10, start_nodes=None, workers=None, seed=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, num_walks))
+
+    os.makedirs(walk_dir, exist_ok=True)
+
+    #one independent random stream per shard
+    shard_seeds = np.random.SeedSequence(seed).spawn(workers)
+    shards = [
+        (adjacency, walk_dir, shard_id, len(rounds), walk_length, p, q, start_nodes, shard_seeds[shard_id])
+        for shard_id, rounds in enumerate(np.array_split(np.arange(num_walks), workers))
+    ]
+
+    if workers == 1:
+        results = [write_walk_shard(shards[0])]
+    else:
+        with Pool(processes=workers) as pool:
+            #one job per shard rather than pool.map: billiard only acknowledges a job's results to the first worker that worked on it, and an exiting worker waits ~30 seconds for the acknowledgement of every result it produced. With a single map job spread over several workers the others would always hit that wait.
+            jobs = [pool.apply_async(write_walk_shard, (shard,)) for shard in shards]
+            results = [job.get() for job in jobs]
+            pool.close()
+            pool.join()
+
+    return [path for shard_files in results for path in shard_files]
+
+#runs in a pool worker: generates this shard's rounds and writes each block straight to disk
+def write_walk_shard(shard):
+    adjacency, walk_dir, shard_id, num_walks, walk_length, p, q, start_nodes, seed = shard
+
+    walk_files = []
+    blocks = iter_walk_blocks(adjacency, walk_length=walk_length, num_walks=num_walks, p=p, q=q, start_nodes=start_nodes, seed=seed)
+    for round_id, walks in enumerate(blocks):
+        path = os.path.join(walk_dir, f"walks_{shard_id:03d}_{round_id:03d}.npy")
+        np.save(path, walks)
+        walk_files.append(path)
+
+    return walk_files
+
+
+#streaming corpus for gensim Word2Vec: reads the walk files back (memory-mapped) and yields each walk as a list of user id strings. gensim iterates over it once to build the vocab and once per epoch, so only one walk file is being read at any time.
+class WalkCorpus:
+    def __init__(self, walk_files, node_ids):
+        self.walk_files = list(walk_files)
+        self.tokens = np.asarray(node_ids).astype(str)
+
+    def __iter__(self):
+        for path in self.walk_files:
+            walks = np.load(path, mmap_mode="r")
+            for walk in walks:
+                yield self.tokens[walk[walk >= 0]].tolist()
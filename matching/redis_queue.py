@@ -0,0 +1,253 @@
+import time
+import uuid
+
+
+#the matching queue in Redis, a sorted set of user ids scored by the time they joined, so the oldest users can be read in order without fetching the whole queue.
+#a matching tick never reads and later deletes users in two separate steps. It works on claimed users:
+# 1. claim_batch atomically moves up to limit of the oldest users from QUEUE_KEY to CLAIMED_KEY (keeping their join time as the score), so only this tick sees them. That's O(batch) traffic, whatever the length of the queue. Users without a live presence lease are dropped from the queue instead of claimed.
+# 2. commit_groups atomically removes each formed group from CLAIMED_KEY, but only if every one of its members is still there. A user who disconnected mid-tick has been removed from both sets by the consumer, so their group is dropped instead of being put into a room. Nothing is committed unless the tick still holds its lock, as once the lock has expired the next tick puts these users back and may claim them again.
+# 3. release_claims puts the claimed users who didn't end up in a committed group back into QUEUE_KEY with their original join time, so they keep their place.
+#all three are Lua scripts, which Redis runs atomically, so the consumer can't interleave with them.
+QUEUE_KEY = "queue_zset"
+CLAIMED_KEY = "queue_claimed"
+#user id -> time their presence lease runs out. QueueConsumer keeps renewing it while the websocket is open (see refresh_lease), if its process dies or its disconnect fails the lease runs out and sweep_expired removes the user.
+#queued users with no lease at all (queued before leases existed, or put back by deliver_groups after their connection had already left) have nothing to expire, claim_batch drops those.
+LEASES_KEY = "queue_leases"
+#user id -> channel name of the user's QueueConsumer, so room assignments can be sent straight to the connection (see matching/notify.py)
+CHANNELS_KEY = "queue_channels"
+#time the next event-driven matching run is scheduled for, expiring at that time, see schedule_matching
+TRIGGER_KEY = "matching_trigger"
+
+#KEYS: queue, claimed, leases, channels. ARGV: min score, max score, limit, now. Users whose lease is missing or ran out are removed (with their lease and channel) rather than claimed. Returns [user_id, joined_at, user_id, joined_at, ...] of the claimed users, oldest first
+CLAIM_SCRIPT = """
+local queued = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[2], 'WITHSCORES', 'LIMIT', 0, ARGV[3])
+local claimed = {}
+for i = 1, #queued, 2 do
+    redis.call('ZREM', KEYS[1], queued[i])
+    local lease = redis.call('ZSCORE', KEYS[3], queued[i])
+    if lease and tonumber(lease) > tonumber(ARGV[4]) then
+        redis.call('ZADD', KEYS[2], queued[i + 1], queued[i])
+        table.insert(claimed, queued[i])
+        table.insert(claimed, queued[i + 1])
+    else
+        redis.call('ZREM', KEYS[3], queued[i])
+        redis.call('HDEL', KEYS[4], queued[i])
+    end
+end
+return claimed
+"""
+
+#KEYS: claimed, lock. ARGV: lock token, then groups flattened as size, members..., size, members... Returns 1 for every committed group, 0 for every dropped one, and nothing if the lock isn't held with the token
+COMMIT_SCRIPT = """
+local results = {}
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return results
+end
+local i = 2
+while i <= #ARGV do
+    local size = tonumber(ARGV[i])
+    local present = true
+    for j = i + 1, i + size do
+        if not redis.call('ZSCORE', KEYS[1], ARGV[j]) then
+            present = false
+            break
+        end
+    end
+    if present then
+        for j = i + 1, i + size do
+            redis.call('ZREM', KEYS[1], ARGV[j])
+        end
+        table.insert(results, 1)
+    else
+        table.insert(results, 0)
+    end
+    i = i + size + 1
+end
+return results
+"""
+
+#KEYS: claimed, queue. ARGV: user ids. Users no longer claimed (committed, or gone) are skipped. Returns the number of users put back
+RELEASE_SCRIPT = """
+local released = 0
+for _, user_id in ipairs(ARGV) do
+    local joined_at = redis.call('ZSCORE', KEYS[1], user_id)
+    if joined_at then
+        redis.call('ZREM', KEYS[1], user_id)
+        redis.call('ZADD', KEYS[2], 'NX', joined_at, user_id)
+        released = released + 1
+    end
+end
+return released
+"""
+
+#KEYS: claimed, queue. Puts every claimed user back, keeping the earlier join time if a user is in both. Returns the number of users that were claimed
+RELEASE_ALL_SCRIPT = """
+local claimed = redis.call('ZCARD', KEYS[1])
+if claimed > 0 then
+    redis.call('ZUNIONSTORE', KEYS[2], 2, KEYS[2], KEYS[1], 'AGGREGATE', 'MIN')
+    redis.call('DEL', KEYS[1])
+end
+return claimed
+"""
+
+#KEYS: queue, trigger. ARGV: now, min queue size, debounce, max wait. Returns the countdown to schedule a run with, or nil if a run early enough is already pending or nobody is queued
+TRIGGER_SCRIPT = """
+local size = redis.call('ZCARD', KEYS[1])
+if size == 0 then
+    return nil
+end
+local delay = tonumber(ARGV[4])
+if size >= tonumber(ARGV[2]) then
+    delay = tonumber(ARGV[3])
+end
+local run_at = tonumber(ARGV[1]) + delay
+local pending = redis.call('GET', KEYS[2])
+if pending and tonumber(pending) <= run_at then
+    return nil
+end
+redis.call('SET', KEYS[2], tostring(run_at), 'PX', math.max(math.ceil(delay * 1000), 1))
+return tostring(delay)
+"""
+
+#KEYS: channels. ARGV: user id, channel name. Only deletes the entry if it still belongs to this connection, a newer connection of the same user (e.g. a second tab) keeps theirs
+UNREGISTER_CHANNEL_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+#KEYS: leases, queue, claimed, channels. ARGV: now. Removes every user whose lease ran out from all queue keys. Returns the number of users removed
+SWEEP_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, user_id in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], user_id)
+    redis.call('ZREM', KEYS[2], user_id)
+    redis.call('ZREM', KEYS[3], user_id)
+    redis.call('HDEL', KEYS[4], user_id)
+end
+return #expired
+"""
+
+#KEYS: lock. ARGV: token, ttl in ms. Extends the lock to expire no sooner than ttl from now, if it is still held with token. Returns 1 if it is, 0 if it expired or was taken by someone else
+EXTEND_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if redis.call('PTTL', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+#KEYS: lock. ARGV: token. Deletes the lock only if it is still held with token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+
+#joining keeps the original join time of a user who is already queued (e.g. a second tab), so reconnecting doesn't cost them their place.
+#these work with both the sync and the asyncio redis clients, with the async one the result has to be awaited.
+def join_queue(redis_client, user_id, joined_at=None):
+    return redis_client.zadd(QUEUE_KEY, {user_id: time.time() if joined_at is None else joined_at}, nx=True)
+
+#removes the user (and their lease) whether they are queued or claimed by a running tick, in one round trip
+def leave_queue(redis_client, user_id):
+    pipeline = redis_client.pipeline(transaction=True)
+    pipeline.zrem(QUEUE_KEY, user_id)
+    pipeline.zrem(CLAIMED_KEY, user_id)
+    pipeline.zrem(LEASES_KEY, user_id)
+    return pipeline.execute()
+
+#extends the user's presence lease to lease_seconds from now
+def refresh_lease(redis_client, user_id, lease_seconds, now=None):
+    if now is None:
+        now = time.time()
+    return redis_client.zadd(LEASES_KEY, {user_id: now + lease_seconds})
+
+#removes the users whose lease ran out from the queue, the claimed users and the channel registry, so a dead connection is never matched. A single cheap range query when nothing expired. Returns the number of users removed
+def sweep_expired(redis_client, now=None):
+    if now is None:
+        now = time.time()
+    return redis_client.register_script(SWEEP_SCRIPT)(keys=[LEASES_KEY, QUEUE_KEY, CLAIMED_KEY, CHANNELS_KEY], args=[now])
+
+def register_channel(redis_client, user_id, channel_name):
+    return redis_client.hset(CHANNELS_KEY, user_id, channel_name)
+
+def unregister_channel(redis_client, user_id, channel_name):
+    return redis_client.register_script(UNREGISTER_CHANNEL_SCRIPT)(keys=[CHANNELS_KEY], args=[user_id, channel_name])
+
+#{user_id: channel name} of the given users, in one HMGET. Users without an entry are left out.
+def channels_of(redis_client, user_ids):
+    if not user_ids:
+        return {}
+    channel_names = redis_client.hmget(CHANNELS_KEY, user_ids)
+    return {user_id: channel_name for user_id, channel_name in zip(user_ids, channel_names) if channel_name}
+
+def queue_size(redis_client):
+    return redis_client.zcard(QUEUE_KEY)
+
+
+#claims up to limit of the oldest users who have been waiting at least min_wait seconds. Users among them without a live lease are dropped from the queue, so fewer may be claimed. Returns [(user_id, joined_at)], oldest first
+def claim_batch(redis_client, limit, min_wait=0.0, now=None):
+    if now is None:
+        now = time.time()
+    claimed = redis_client.register_script(CLAIM_SCRIPT)(keys=[QUEUE_KEY, CLAIMED_KEY, LEASES_KEY, CHANNELS_KEY], args=["-inf", now - min_wait, limit, now])
+    return [(int(claimed[i]), float(claimed[i + 1])) for i in range(0, len(claimed), 2)]
+
+#groups is a list of lists of user ids, lock_key and lock_token the lock of the tick that claimed them. Returns the groups that were committed, in order
+def commit_groups(redis_client, groups, lock_key, lock_token):
+    if not groups:
+        return []
+    args = [lock_token]
+    for group in groups:
+        args.append(len(group))
+        args.extend(group)
+    results = redis_client.register_script(COMMIT_SCRIPT)(keys=[CLAIMED_KEY, lock_key], args=args)
+    return [group for group, committed in zip(groups, results) if int(committed)]
+
+def release_claims(redis_client, user_ids):
+    if not user_ids:
+        return 0
+    return redis_client.register_script(RELEASE_SCRIPT)(keys=[CLAIMED_KEY, QUEUE_KEY], args=list(user_ids))
+
+#forgets claimed users for good, e.g. queued ids that don't belong to any user
+def drop_claims(redis_client, user_ids):
+    if not user_ids:
+        return 0
+    return redis_client.zrem(CLAIMED_KEY, *user_ids)
+
+#puts back users still claimed by a tick that died before releasing them. Only safe while no other tick is running, i.e. under the matching lock.
+def release_stale_claims(redis_client):
+    return redis_client.register_script(RELEASE_ALL_SCRIPT)(keys=[CLAIMED_KEY, QUEUE_KEY])
+
+
+#event-driven matching: called whenever someone joins (and after every tick), decides whether a matching run should be scheduled and how soon.
+# - once at least min_queue_size users are queued, a run is due after debounce seconds, so a burst of joins is matched by one run instead of one each
+# - with fewer queued, a run is still due after max_wait seconds, so nobody waits longer than that for a first attempt
+# - with nobody queued, nothing is scheduled, so an idle queue isn't polled
+#only one run is pending at a time, unless a sooner one becomes due (e.g. the queue crossed min_queue_size while a max_wait run was pending). Returns the countdown in seconds for the run to schedule, or None.
+def schedule_matching(redis_client, min_queue_size, debounce, max_wait, now=None):
+    if now is None:
+        now = time.time()
+    return redis_client.register_script(TRIGGER_SCRIPT)(keys=[QUEUE_KEY, TRIGGER_KEY], args=[now, min_queue_size, debounce, max_wait])
+
+
+#locks with an owner: whoever takes the lock gets a random token, and only that token can extend or delete it. A run that outlived its lock then can't delete the lock of the run that took over.
+#returns the token, or None if the lock is held
+def acquire_lock(redis_client, key, ttl):
+    token = uuid.uuid4().hex
+    if redis_client.set(key, token, nx=True, ex=ttl):
+        return token
+    return None
+
+#makes the lock last at least ttl more seconds, never shortens it. Returns False if token no longer holds the lock
+def extend_lock(redis_client, key, token, ttl):
+    return bool(redis_client.register_script(EXTEND_LOCK_SCRIPT)(keys=[key], args=[token, int(ttl * 1000)]))
+
+def release_lock(redis_client, key, token):
+    return redis_client.register_script(RELEASE_LOCK_SCRIPT)(keys=[key], args=[token])
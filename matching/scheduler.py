@@ -0,0 +1,91 @@
+import os
+import time
+from typing import Dict, List
+from matching.queue_manager import UserEntry
+from matching.artifacts import resolve_version_dir
+from matching.matching import match_cluster_batch, group_leftovers
+
+
+#adaptive batch sizing for run_budgeted_matching. Keeps a running (exponentially weighted) estimate of how many seconds matching one user costs, per matching mode, and turns a time allowance into a batch size from it.
+#the estimate lives as long as the worker process, so each tick starts from what the previous ticks measured.
+class BatchSizer:
+    def __init__(self, initial_batch_size=50, min_batch_size=10, max_batch_size=5000, smoothing=0.3):
+        self.initial_batch_size = initial_batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.smoothing = smoothing
+        self.seconds_per_user = {}
+
+    #how many users fit into seconds. Until a mode has been measured it gets initial_batch_size.
+    def batch_size(self, mode, seconds):
+        cost = self.seconds_per_user.get(mode)
+        if cost is None:
+            return self.initial_batch_size
+        size = int(seconds / cost) if cost > 0 else self.max_batch_size
+        return max(self.min_batch_size, min(self.max_batch_size, size))
+
+    def observe(self, mode, num_users, seconds):
+        if num_users <= 0:
+            return
+        cost = seconds / num_users
+        previous = self.seconds_per_user.get(mode)
+        self.seconds_per_user[mode] = cost if previous is None else (1 - self.smoothing) * previous + self.smoothing * cost
+
+
+#the sizer of this process
+batch_sizer = BatchSizer()
+
+
+#keeps matching until every cluster queue is empty or time_budget seconds are used, instead of stopping after a fixed batch_size per cluster like run_batch_matching.
+#clusters are served round robin, each round every non-empty cluster gets an equal share of the remaining time and a batch sized from the observed cost per user to fit it, so a busy tick matches as many users as the budget allows and a quiet one returns as soon as the queues are empty.
+#the group formation of the "queue" mode is held to the same share (capped at group_time_budget). Returns the same {cluster_id: groups, "leftover": groups} dict as run_batch_matching, the leftover queue is grouped once at the end.
+#with group_leftover=False the leftover queue is left as it is and there is no "leftover" key, for callers that group the leftovers of several runs together (see match_cluster_task in tasks.py).
+def run_budgeted_matching(queue_manager, base_dir=None, time_budget=20.0, mode="annoy", group_engine="agglomerative", group_time_budget=None, sizer=None, group_leftover=True) -> Dict[str, List[List[UserEntry]]]:
+
+    if base_dir is None:
+        base_dir = os.path.join(os.path.dirname(__file__), "Annoy")
+    if sizer is None:
+        sizer = batch_sizer
+
+    #resolve the published version once, so every batch of this run is matched against the same build
+    base_dir = resolve_version_dir(base_dir)
+
+    deadline = time.perf_counter() + time_budget
+    res = {}
+    #clusters whose batch took nobody off the queue (e.g. their index is missing), retrying them would loop forever
+    stalled = set()
+
+    while True:
+        clusters = [cluster_id for cluster_id in queue_manager.get_all_clusters() if cluster_id != "leftover" and cluster_id not in stalled and queue_manager.get_cluster_size(cluster_id)]
+        remaining = deadline - time.perf_counter()
+        if not clusters or remaining <= 0:
+            break
+
+        for cluster_id in clusters:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            share = remaining / len(clusters)
+            batch_size = sizer.batch_size(mode, share)
+            batch_time_budget = share if group_time_budget is None else min(share, group_time_budget)
+
+            queued_before = queue_manager.get_cluster_size(cluster_id)
+            started = time.perf_counter()
+            groups = match_cluster_batch(cluster_id, queue_manager, base_dir, batch_size, mode, group_engine, batch_time_budget)
+            elapsed = time.perf_counter() - started
+
+            #users taken off the cluster queue in this batch, whether they got a group or went to leftover
+            taken = queued_before - queue_manager.get_cluster_size(cluster_id)
+            if taken <= 0:
+                stalled.add(cluster_id)
+                continue
+            sizer.observe(mode, taken, elapsed)
+            res.setdefault(cluster_id, []).extend(groups)
+
+    unmatched = sum(queue_manager.get_cluster_size(cluster_id) for cluster_id in queue_manager.get_all_clusters() if cluster_id != "leftover")
+    if unmatched:
+        print(f"time budget used up, {unmatched} users stay queued for the next tick")
+
+    if group_leftover:
+        res["leftover"] = group_leftovers(queue_manager)
+    return res
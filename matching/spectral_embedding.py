@@ -0,0 +1,40 @@
+import numpy as np
+from scipy.sparse import diags
+from sklearn.utils.extmath import randomized_svd
+
+
+#NetMF-style embedding: instead of sampling random walks and training skip-gram on them, factorise the matrix that skip-gram with negative sampling implicitly factorises (Qiu et al., "Network Embedding as Matrix Factorization").
+#for window T that matrix is log(max(vol(G) / (b * T) * sum_{r=1..T} (D^-1 A)^r D^-1, 1)), A being the adjacency, D the degrees and b the number of negative samples. Everything stays in scipy.sparse and a randomized SVD only needs a handful of sparse matrix products, so this costs seconds where node2vec costs minutes.
+#window=1 keeps the matrix exactly as sparse as the like graph, larger windows add (D^-1 A)^r terms whose fill-in grows with the square of popular users' degrees, so use them with care.
+#returns a float32 (num_nodes, embed_dimensions) array aligned with the rows of adjacency. If the graph has fewer nodes than embed_dimensions, the extra dimensions are left at 0 so the annoy index still gets vectors of the expected size.
+def spectral_embeddings(adjacency, embed_dimensions=128, window=1, negative=1.0, seed=None):
+    num_nodes = adjacency.shape[0]
+    vectors = np.zeros((num_nodes, embed_dimensions), dtype=np.float32)
+
+    #likes in either direction make two users related, the same way walks can travel along the reciprocal back-edges
+    symmetric = (adjacency + adjacency.T).tocsr()
+    degrees = np.asarray(symmetric.sum(axis=1)).ravel()
+    volume = degrees.sum()
+    inv_degrees = np.divide(1.0, degrees, out=np.zeros_like(degrees), where=degrees > 0)
+
+    transition = (diags(inv_degrees) @ symmetric).tocsr()
+    power = transition
+    proximity = transition.copy()
+    for _ in range(window - 1):
+        power = (power @ transition).tocsr()
+        proximity = proximity + power
+
+    proximity = (proximity @ diags(inv_degrees)).tocsr() * (volume / (negative * window))
+
+    #the truncated log keeps the matrix sparse: anything below 1 becomes an explicit 0 and is dropped
+    proximity.data = np.log(np.maximum(proximity.data, 1.0))
+    proximity.eliminate_zeros()
+
+    num_components = min(embed_dimensions, num_nodes - 1)
+    if num_components < 1 or proximity.nnz == 0:
+        return vectors
+
+    u, sigma, _ = randomized_svd(proximity, n_components=num_components, random_state=seed)
+    vectors[:, :num_components] = u * np.sqrt(sigma)
+
+    return vectors
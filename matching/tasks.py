@@ -1,36 +1,63 @@
-from celery import shared_task
+from celery import shared_task, chord
+from celery.signals import worker_process_init
 # from chat.utils import create_chat_room
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
-from users.models import AppUser
+from users.models import AppUser, Like
 import redis
 from django.conf import settings
 import logging
 import pandas as pd
+import numpy as np
 import os
-import json
-from users.models import Like
+from datetime import datetime, timedelta
+from django.utils import timezone
 
 
 #import all the necessary functions for the matching algo
-from matching.matching import match_in_cluster, run_batch_matching
+from matching.matching import route_users, index_is_ready, group_leftovers
+from matching.scheduler import run_budgeted_matching
 from matching.distribute_rooms import distribute_rooms
-from matching.queue_manager import ClusterQueueManager, UserEntry
-from matching.build_graph_annoy import create_graph_from_likes, create_node2vec_annoy
+from matching.queue_manager import ClusterQueueManager
+from matching.build_graph_annoy import create_node2vec_annoy, refresh_node2vec_annoy, load_build_state, save_build_state, compare_embedding_engines
+from matching.like_extraction import load_likes_df
+from matching.artifacts import resolve_version_dir
+from matching.index_registry import registry
+from matching.notify import notify_room_assignments
+from matching.matchable import matchable_of, set_matchable, rebuild_matchable, MATCHABLE_KEY
+from matching.redis_queue import claim_batch, commit_groups, release_claims, drop_claims, release_stale_claims, join_queue, schedule_matching, channels_of, sweep_expired, acquire_lock, extend_lock, release_lock
 
 
 logger = logging.getLogger(__name__)
 
+#every celery worker process loads the published indexes once when it starts, so the first run_matching_algo tick it picks up already finds them in memory. Later ticks only reload when a new version has been published.
+@worker_process_init.connect
+def warm_up_index_registry(**kwargs):
+    registry.max_bytes = settings.MATCHING_INDEX_CACHE_MB * 1024 * 1024
+    try:
+        loaded = registry.warm_up(os.path.join(settings.BASE_DIR, "matching", "Annoy"))
+        logger.info("Index registry warmed up with %d clusters.", loaded)
+    except Exception as error:
+        #a worker must still start without an index, run_matching_algo skips until one is built
+        logger.warning("Index registry warm-up failed: %s", error)
+
 #@shared_task decorator does not make the task available in all modules of project. 
 #it only registers the task with Celery's task registry.
+#settings.EMBEDDING_ENGINE picks the embedding backend (see EMBEDDING_ENGINES in build_graph_annoy.py). The spectral engine is cheap enough to simply rebuild everything on every run.
+#with the node2vec engine this by default does an incremental refresh: only users whose likes changed since the last build (Like.last_like_date newer than the saved watermark) get new walks, and the previous skip-gram model is warm-started. A full rebuild still runs when full=True, when there is no previous build, or when the last full build is older than EMBEDDING_FULL_REBUILD_HOURS, as the periodic fallback (e.g. unlikes don't move last_like_date, so they are only picked up by a full rebuild).
 @shared_task
-def build_graph_annoy():
+def build_graph_annoy(full=False):
+    base_dir = os.path.join(settings.BASE_DIR, "matching", "Annoy")
+    os.makedirs(base_dir, exist_ok=True)
+    state = load_build_state(base_dir)
+
+    #taken before reading the likes, so any like written while we build is picked up by the next run rather than lost
+    build_started = timezone.now()
+
     try:
         #retrieve the likes data from the database.
-        #note: may have to combine .iterator() + batching (stream and chunk) to balance speed and memory when user count gets into the millions as using df like this loads everything into memory.
-        likes_data = Like.objects.select_related("user_from", "user_to").all()
-
-        likes_df = pd.DataFrame.from_records(likes_data.values("user_from_id", "user_to_id", "like_count"))
+        #streamed in chunks through a server-side cursor straight into numpy arrays, so peak memory stays flat as the Like table grows.
+        likes_df = load_likes_df()
 
         if likes_df.empty:
             logger.info("No Like data found in database. Injecting dummy data for testing.")
@@ -42,13 +69,6 @@ def build_graph_annoy():
                 "like_count": [1, 3, 2]
             }
             likes_df = pd.DataFrame(dummy_data)
-        else:
-            #Rename columns if real data is used
-            likes_df.rename(columns={
-                "user_from_id": "user_from",
-                "user_to_id": "user_to"
-            }, inplace=True)
-
 
         logger.info("Like data retrieved successfully.")
 
@@ -56,20 +76,82 @@ def build_graph_annoy():
         logger.error("Error loading Like data: %s", error)
         return
 
-    #use the default base_dir
-    create_node2vec_annoy(likes_df, embed_dimensions=128, num_trees=10)
+    engine = settings.EMBEDDING_ENGINE
+    watermark = state.get("watermark")
+    last_full_build = state.get("last_full_build")
+    full_rebuild_due = (
+        full
+        or engine != "node2vec"
+        #the previous build must have produced a node2vec model to warm-start from
+        or state.get("engine", "node2vec") != "node2vec"
+        or watermark is None
+        or last_full_build is None
+        or build_started - datetime.fromisoformat(last_full_build) > timedelta(hours=settings.EMBEDDING_FULL_REBUILD_HOURS)
+    )
+
+    if not full_rebuild_due:
+        #both ends of a changed like are affected
+        changed_user_ids = set()
+        changed_likes = Like.objects.filter(last_like_date__gt=datetime.fromisoformat(watermark)).values_list("user_from_id", "user_to_id")
+        for user_from_id, user_to_id in changed_likes.iterator():
+            changed_user_ids.add(user_from_id)
+            changed_user_ids.add(user_to_id)
+
+        if not changed_user_ids:
+            logger.info("No likes changed since %s, embeddings are up to date.", watermark)
+            state["watermark"] = build_started.isoformat()
+            save_build_state(base_dir, state)
+            return
+
+        logger.info("Refreshing embeddings for %d changed users.", len(changed_user_ids))
+        if refresh_node2vec_annoy(likes_df, changed_user_ids, base_dir=base_dir, num_trees=10, users_per_cluster=settings.MATCHING_USERS_PER_CLUSTER):
+            state["watermark"] = build_started.isoformat()
+            save_build_state(base_dir, state)
+            return
+
+        logger.warning("Incremental refresh not possible, falling back to a full rebuild.")
+
+    create_node2vec_annoy(likes_df, base_dir=base_dir, embed_dimensions=128, num_trees=10, engine=engine, users_per_cluster=settings.MATCHING_USERS_PER_CLUSTER)
+
+    save_build_state(base_dir, {
+        "watermark": build_started.isoformat(),
+        "last_full_build": build_started.isoformat(),
+        "engine": engine,
+    })
+
+#comparison mode: runs every embedding engine on the current Like data and logs build time and held-out like recall for each, so the engines can be compared before switching EMBEDDING_ENGINE. Nothing is written to the Annoy folder.
+@shared_task
+def compare_embedding_engines_task():
+    likes_df = load_likes_df()
+    if likes_df.empty:
+        logger.info("No Like data found in database, nothing to compare.")
+        return {}
+
+    report = compare_embedding_engines(likes_df, embed_dimensions=128)
+    for engine, result in report.items():
+        logger.info(
+            "Embedding engine %s: built in %.1fs, held-out like recall@10 %.3f (%d users, %d held-out likes)",
+            engine, result["build_seconds"], result["recall_at_k"], result["num_users"], result["num_heldout_likes"],
+        )
+    return report
 
 
+#when multiple celery workers are used: added a lock (via SETNX) to prevent two Celery workers from running run_matching_algo() at the same time. Otherwise, risk double-matching or room assignment conflicts under concurrency.
+#with MATCHING_FANOUT the lock is held until the fan-out's finish_matching_fanout has run, so it always means a tick is in flight. Its TTL is then extended to cover the cluster tasks (see dispatch_matching_fanout).
+#the lock holds a token of the run that took it (see acquire_lock in matching/redis_queue.py), so a run that outlived its lock can't delete the lock of the next one
+MATCHING_LOCK_KEY = "run_matching_algo_lock"
+#seconds; adjust to max expected runtime
+MATCHING_LOCK_TTL = 60
+
 @shared_task
 def run_matching_algo():
 
     #check for Annoy directory and required files
-    base_dir = os.path.join(settings.BASE_DIR, "matching", "Annoy")
-    ann_file = os.path.join(base_dir, "cluster_global.ann")
-    json_file = os.path.join(base_dir, "global_map.json")
+    #resolved once here so the whole run uses the same published index version, a build finishing meanwhile is picked up by the next run
+    base_dir = resolve_version_dir(os.path.join(settings.BASE_DIR, "matching", "Annoy"))
 
-    #if ann file not found, skip the run_matcing_algo early
-    if not (os.path.exists(base_dir) and os.path.exists(ann_file) and os.path.exists(json_file)):
+    #if ann files not found, skip the run_matcing_algo early
+    if not (os.path.exists(base_dir) and index_is_ready(base_dir)):
         logger.warning(
             "run_matching_algo skipped: Annoy directory or required files missing."
         )
@@ -78,136 +160,312 @@ def run_matching_algo():
     #connect to Redis
     redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True)
 
-    #when multiple celery workers are used: added a lock (via SETNX) to prevent two Celery workers from running run_matching_algo() at the same time. Otherwise, risk double-matching or room assignment conflicts under concurrency.
-
-    lock_key = "run_matching_algo_lock"
-    lock_ttl = 60  # seconds; adjust to max expected runtime
-
     #NX = "Only set lock if Not eXists"
     #EX = set an expiration time for the lock
     # If the key did not exist, Redis executes the SET key value NX EX ttl command and returns the string reply "OK".
     # If the key already exists, the NX flag prevents the set, and Redis returns a nil reply (i.e. “no value”)
-    got_lock = redis_client.set(lock_key, "1", nx=True, ex=lock_ttl)
-    if not got_lock:
+    lock_token = acquire_lock(redis_client, MATCHING_LOCK_KEY, MATCHING_LOCK_TTL)
+    if lock_token is None:
         logger.info("Another worker is already running run_matching_algo; skipping this round.")
         return
-    
+
+    #set once the fan-out is dispatched, from then on finish_matching_fanout releases the claims and the lock
+    handed_off = False
+    retrieved = []
     try:
         logger.info("run_matching_algo started")
 
-        #get all user id's in queue in redis
-        # redis_client.smembers("queue") returns strings because Redis stores everything as strings by default, even if insert numbers.
-        try:
-            membersIdSet = redis_client.smembers("queue")
-        except Exception as error:
-            logger.error("Error fetching queue members: %s", error)
-            membersIdSet = set()
+        #users claimed by a tick that died before releasing them would otherwise never be matched. Nothing else is claiming while we hold the lock.
+        stale_claims = release_stale_claims(redis_client)
+        if stale_claims:
+            logger.warning("Put %d users claimed by an earlier run back into the queue.", stale_claims)
+
+        #users whose connection stopped renewing its presence lease (dead process, failed disconnect) are removed before claiming, so no group is built around them. Queued users with no lease at all are dropped by the claim itself.
+        swept = sweep_expired(redis_client)
+        if swept:
+            logger.info("Removed %d users with expired presence leases from the queue.", swept)
 
-        if not membersIdSet:
+        retrieved = claim_valid_users(redis_client)
+        if not retrieved:
             logger.debug("Queue is empty—nothing to match.")
             return
 
-        #ensuring user_ids are int
-        try:
-            user_ids = [int(member_id) for member_id in membersIdSet]
-        except ValueError as error:
-            logger.error("Non-integer ID in queue: %s", error)
-            user_ids = []
-
-        #to double check if these ids actually do exist.
-        #users is in QuerySet, not yet hit the database
-        users_queryset = AppUser.objects.filter(id__in=user_ids)
-
-        #convert to list, this is when Queryset hits the database due to both list and values_list
-        #flat true makes the tuples into plain list
-        retrieved_user_ids = list(users_queryset.values_list('id', flat=True))
-        logger.info("Found %d valid users in queue", len(retrieved_user_ids))
-
         #commented out to enable easier testing (using fewer users) in development mode. 
         #comment out in production mode!
-        if len(retrieved_user_ids) < 2:
+        if len(retrieved) < 2:
             logger.debug("Not enough users to match.")
             return
 
-
         #this automatically initialises "global" and "leftover" queues
         queue_manager = ClusterQueueManager()
 
-        for user_id in retrieved_user_ids:
-            queue_manager.add("global", int(user_id))
-        
+        #each user goes straight into their embedding cluster's queue, one table lookup per user
+        route_users(queue_manager, [user_id for user_id, _ in retrieved], base_dir, joined_at=[joined_at for _, joined_at in retrieved])
+
+        if settings.MATCHING_FANOUT:
+            dispatch_matching_fanout(redis_client, queue_manager, retrieved, base_dir, lock_token)
+            handed_off = True
+            return
+
         #run the batch matching algo
-        grouped_users = run_batch_matching(queue_manager)
+        #keeps matching in adaptively sized batches until the queues are empty or MATCHING_TICK_BUDGET seconds are used, users still queued then are released back below and matched on the next tick
+        grouped_users = run_budgeted_matching(
+            queue_manager,
+            base_dir=base_dir,
+            time_budget=settings.MATCHING_TICK_BUDGET,
+            mode=settings.MATCHING_MODE,
+            group_engine=settings.MATCHING_GROUP_ENGINE,
+            group_time_budget=settings.MATCHING_GROUP_TIME_BUDGET,
+        )
         logger.debug("Grouped users: %s", grouped_users)
-        
-        #distribute grouped users to rooms
-        #format of matched_groups
-        # matched_groups = [{"room_id": 123, "user_ids": [1,2,3,4]}, {"room_id": 555, "user_ids": [5,6,7,8]}]
-        matched_groups, users_in_matched_groups = distribute_rooms(grouped_users, redis_client)
-
-
-        #remember when this is returned, it is a tuple as two values are returned!
-        logger.info("Matched groups: %s", matched_groups)
-
-        # ##this needs amending for robustness
-        # removed_ids = redis_client.smembers("rooms")
-        # print(f"removed_ids: {removed_ids}")
-        # if removed_ids:
-        #     redis_client.srem("rooms", *removed_ids)
-
-
-        # get the channel layer
-        channel_layer = get_channel_layer()
-
-        success_matched_userIds = []
-
-        # matched_groups in this format:
-        #  Tuple[List[Dict[str, object]], List[int]]
-        # [
-        #     {"room_id": 5, "user_ids": [1, 2, 3, 4]},
-        #     {"room_id": 2, "user_ids": [5, 6, 7, 8]}
-        # ]
-
-
-        for group in matched_groups:
-            room_id = group["room_id"]
-            user_ids = group["user_ids"]
-
-            for user_id in user_ids:
-                try:
-                    async_to_sync(channel_layer.group_send)(
-                        f'user_queue_{user_id}',
-                        {
-                            #Note: When Celery task sends a message via the channel layer, it doesn't need direct access to the consumer or its methods. Instead, it uses the channel layer as an intermediary to broadcast messages to any consumers that are subscribed to the relevant group.
-                            "type": "send_room_id",
-                            "room_id": room_id,
-                        }
-                    )
-
-                    success_matched_userIds.append(user_id)
-
-                except Exception as error:
-                    logger.error("Error sending to user %d: %s", user_id, error)
-        #srem command removes one or more members from a set.
-        #*unpacks the elements of the collection, so instead of passing the collection as one argument, it passes each element of the collection as a separate argument
-        #here is to remove the successfully matched users from the Redis queue.
-        #only remove if its not empty:
-        if success_matched_userIds:
-            redis_client.srem("queue",*success_matched_userIds)
-            logger.info("Removed matched users from queue: %s", success_matched_userIds)
-            
+
+        deliver_groups(redis_client, grouped_users, dict(retrieved), lock_token)
+
     finally:
         #use finally as we NEED to delete the lock even if an error occurs. Finally executes no matter what.
-        #release the lock so others can pick up next time
-        redis_client.delete(lock_key)
-        logger.info("run_matching_algo completed, lock released.")
+        if not handed_off:
+            #everyone claimed but not committed (not grouped in time, or their group lost a member) goes back into the queue with their original join time
+            release_claims(redis_client, [user_id for user_id, _ in retrieved])
+            #release the lock so others can pick up next time
+            release_lock(redis_client, MATCHING_LOCK_KEY, lock_token)
+            logger.info("run_matching_algo completed, lock released.")
+            #users who joined while we ran, or weren't matched, get a follow-up run
+            request_matching(redis_client)
+
+
+#fan-out mode (settings.MATCHING_FANOUT): run_matching_algo only claims and routes the users, then a chord runs match_cluster_task for every cluster in parallel on whichever workers are free, each under a lock of its own cluster. Each of them commits and delivers its own groups straight away and returns the users it couldn't group, and finish_matching_fanout groups those together with the users that had no cluster, the only step that needs the results of all clusters.
+#the claimed users (with the join times they were claimed with), the index version and the lock token are passed along explicitly, so every subtask works on the same tick.
+#the global lock is extended to cover the cluster tasks even if they all run one after the other, and every cluster task extends it again when it starts, in case it waited in the broker. A task that finds the lock gone (the tick was taken over and its users put back) does nothing. One whose lock runs out while it matches commits nothing (see deliver_groups).
+def dispatch_matching_fanout(redis_client, queue_manager, retrieved, base_dir, lock_token):
+    cluster_tasks = []
+    for cluster_id in queue_manager.get_all_clusters():
+        if cluster_id == "leftover" or not queue_manager.get_cluster_size(cluster_id):
+            continue
+        users = [[user_entry.user_id, user_entry.joined_at] for user_entry in queue_manager.cluster_queues[cluster_id]]
+        cluster_tasks.append(match_cluster_task.s(cluster_id, users, base_dir, lock_token))
+
+    extend_lock(redis_client, MATCHING_LOCK_KEY, lock_token, MATCHING_LOCK_TTL + len(cluster_tasks) * settings.MATCHING_TICK_BUDGET)
+
+    leftover_users = [[user_entry.user_id, user_entry.joined_at] for user_entry in queue_manager.cluster_queues["leftover"]]
+    finish = finish_matching_fanout.s(leftover_users, [[user_id, joined_at] for user_id, joined_at in retrieved], lock_token)
+    logger.info("Dispatching matching of %d clusters.", len(cluster_tasks))
+    if cluster_tasks:
+        chord(cluster_tasks)(finish)
+    else:
+        #a chord needs at least one task in its header
+        finish.delay([])
+
+#matches one cluster's claimed users. Returns the users left over, as [user_id, joined_at] lists.
+@shared_task
+def match_cluster_task(cluster_id, users, base_dir, tick_lock_token):
+    redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+    #the users are only still claimed for this tick while it holds the global lock
+    if not extend_lock(redis_client, MATCHING_LOCK_KEY, tick_lock_token, MATCHING_LOCK_TTL + settings.MATCHING_TICK_BUDGET):
+        logger.warning("Matching lock lost before cluster %s was matched; skipping it.", cluster_id)
+        return []
+
+    #two ticks never match the same cluster at once, even if a tick outlives the global lock
+    lock_key = f"{MATCHING_LOCK_KEY}_{cluster_id}"
+    lock_token = acquire_lock(redis_client, lock_key, MATCHING_LOCK_TTL)
+    if lock_token is None:
+        logger.info("Cluster %s is already being matched; its users are released.", cluster_id)
+        return []
+
+    try:
+        queue_manager = ClusterQueueManager()
+        for user_id, joined_at in users:
+            queue_manager.add(cluster_id, user_id, joined_at)
+
+        grouped_users = run_budgeted_matching(
+            queue_manager,
+            base_dir=base_dir,
+            time_budget=settings.MATCHING_TICK_BUDGET,
+            mode=settings.MATCHING_MODE,
+            group_engine=settings.MATCHING_GROUP_ENGINE,
+            group_time_budget=settings.MATCHING_GROUP_TIME_BUDGET,
+            group_leftover=False,
+        )
+        deliver_groups(redis_client, grouped_users, {user_id: joined_at for user_id, joined_at in users}, tick_lock_token)
+
+        #users still in the cluster queue ran out of time, they are released by finish_matching_fanout and wait for the next tick
+        return [[user_entry.user_id, user_entry.joined_at] for user_entry in queue_manager.cluster_queues["leftover"]]
+    except Exception as error:
+        #a failed cluster must not keep the chord from finishing, its users are released with the rest
+        logger.error("Error matching cluster %s: %s", cluster_id, error)
+        return []
+    finally:
+        release_lock(redis_client, lock_key, lock_token)
+
+#chord callback: groups the leftovers of all clusters together, then releases everyone of the tick who is still claimed and the global lock.
+#tick_users are the [user_id, joined_at] the tick claimed, the join times everyone is ordered by and re-queued with.
+@shared_task
+def finish_matching_fanout(cluster_leftovers, leftover_users, tick_users, lock_token):
+    redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True)
 
+    #if the lock expired, the next tick has already put this tick's users back into the queue and may have claimed them again, so they are left alone
+    if not extend_lock(redis_client, MATCHING_LOCK_KEY, lock_token, MATCHING_LOCK_TTL):
+        logger.warning("Matching lock lost before the fan-out finished; its users were released by the next run.")
+        return
+
+    joined_at = {user_id: user_joined_at for user_id, user_joined_at in tick_users}
+    try:
+        queue_manager = ClusterQueueManager()
+        #oldest first across all clusters
+        leftover_user_ids = sorted({user_id for users in cluster_leftovers + [leftover_users] for user_id, _ in users}, key=joined_at.get)
+        for user_id in leftover_user_ids:
+            queue_manager.add("leftover", user_id, joined_at[user_id])
+
+        grouped_users = {"leftover": group_leftovers(queue_manager)}
+        deliver_groups(redis_client, grouped_users, joined_at, lock_token)
+    finally:
+        release_claims(redis_client, list(joined_at))
+        release_lock(redis_client, MATCHING_LOCK_KEY, lock_token)
+        logger.info("run_matching_algo fan-out completed, lock released.")
+        request_matching(redis_client)
+
+
+#schedules an event-driven run_matching_algo if one is due (see schedule_matching in matching/redis_queue.py). QueueConsumer does the same whenever a user joins. The celery beat schedule stays as a safety net.
+def request_matching(redis_client):
+    try:
+        countdown = schedule_matching(redis_client, settings.MATCHING_TRIGGER_QUEUE_SIZE, settings.MATCHING_TRIGGER_DEBOUNCE, settings.MATCHING_TRIGGER_MAX_WAIT)
+        if countdown is not None:
+            run_matching_algo.apply_async(countdown=float(countdown))
+    except Exception as error:
+        logger.error("Error scheduling a matching run: %s", error)
 
-            
 
+#rebuilds the matchable users bitmap from the database (see matching/matchable.py). Schedule it periodically in celery beat (e.g. hourly) as the repair for anything the AppUser signals missed, run_matching_algo also starts it when the bitmap is missing.
+@shared_task
+def rebuild_matchable_users_task():
+    redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True)
 
+    #streamed through a server-side cursor straight into a numpy array, 8 bytes per user
+    def read_user_ids():
+        user_ids = AppUser.objects.filter(is_active=True, is_verified=True).values_list('id', flat=True).iterator(chunk_size=10000)
+        return np.fromiter(user_ids, dtype=np.int64)
 
+    complete = rebuild_matchable(redis_client, read_user_ids)
+    if complete is None:
+        logger.info("Matchable users bitmap is already being rebuilt; skipping.")
+    elif not complete:
+        logger.warning("Matchable users bitmap rebuilt, but it took too long to keep every change made meanwhile.")
+    else:
+        logger.info("Matchable users bitmap rebuilt.")
 
 
+#claims the oldest queued users (see matching/redis_queue.py) and keeps the ones that are real users. They are moved out of the queue atomically, so only this run sees them, and only this batch is sent over the wire rather than the whole queue.
+#returns [(user_id, joined_at)], oldest first. If anything goes wrong after claiming, the claimed users are put back.
+def claim_valid_users(redis_client):
+    try:
+        claimed = claim_batch(redis_client, settings.MATCHING_CLAIM_LIMIT, min_wait=settings.MATCHING_MIN_WAIT)
+    except Exception as error:
+        logger.error("Error claiming queue members: %s", error)
+        return []
 
+    if not claimed:
+        return []
 
+    claimed_user_ids = [user_id for user_id, _ in claimed]
+    try:
+        #to double check these ids belong to users who may be matched, the whole batch is looked up in the matchable users bitmap (see matching/matchable.py) in one pipelined round trip
+        valid_user_ids = matchable_of(redis_client, claimed_user_ids)
+        bitmap_missing = valid_user_ids is None
+        if bitmap_missing:
+            #no bitmap yet, check them all in the database and have it built for the next ticks
+            logger.warning("Matchable users bitmap missing, checking the queue against the database.")
+            #at most one rebuild requested every few minutes, not one per tick while it runs
+            if redis_client.set(f"{MATCHABLE_KEY}:rebuild_requested", "1", nx=True, ex=300):
+                rebuild_matchable_users_task.delay()
+            unknown_user_ids = claimed_user_ids
+            valid_user_ids = set()
+        else:
+            unknown_user_ids = [user_id for user_id in claimed_user_ids if user_id not in valid_user_ids]
+
+        #only ids the bitmap doesn't have go to the database: normally just the few that really can't be matched, but also anyone the bitmap missed (e.g. a user whose signal couldn't reach Redis), who would otherwise be dropped from the queue
+        if unknown_user_ids:
+            #users is in QuerySet, not yet hit the database
+            users_queryset = AppUser.objects.filter(id__in=unknown_user_ids, is_active=True, is_verified=True)
+
+            #convert to list, this is when Queryset hits the database due to both list and values_list
+            #flat true makes the tuples into plain list
+            found_user_ids = set(users_queryset.values_list('id', flat=True))
+            #the bitmap missed them, fix their bits in one round trip (a missing bitmap is rebuilt anyway)
+            if found_user_ids and not bitmap_missing:
+                pipeline = redis_client.pipeline(transaction=False)
+                for user_id in found_user_ids:
+                    set_matchable(pipeline, user_id, True)
+                pipeline.execute()
+            valid_user_ids |= found_user_ids
+    except Exception:
+        release_claims(redis_client, claimed_user_ids)
+        raise
+
+    #keep the claim order, oldest first
+    retrieved = [(user_id, joined_at) for user_id, joined_at in claimed if user_id in valid_user_ids]
+    logger.info("Found %d valid users in queue", len(retrieved))
+
+    #ids without an active, verified user can never be matched, they are dropped from the queue
+    if len(retrieved) < len(claimed):
+        logger.warning("Dropping %d queued ids without a matchable user.", len(claimed) - len(retrieved))
+        drop_claims(redis_client, [user_id for user_id in claimed_user_ids if user_id not in valid_user_ids])
+
+    return retrieved
+
+#commits the groups formed from claimed users, puts the committed ones into rooms and tells their members. joined_at maps every user to their join time, users who can't be told go back into the queue with it.
+#lock_token is the token of the tick's MATCHING_LOCK_KEY, matching can take long enough for the lock to expire and nothing is committed then.
+#returns the matched groups.
+def deliver_groups(redis_client, grouped_users, joined_at, lock_token):
+    #only groups whose members are all still claimed (none disconnected meanwhile) are kept, atomically removing them from Redis, and only while the tick still holds the lock
+    committed = set(map(tuple, commit_groups(redis_client, [
+        [user_entry.user_id for user_entry in group]
+        for groups_in_cluster in grouped_users.values()
+        for group in groups_in_cluster
+    ], MATCHING_LOCK_KEY, lock_token)))
+    grouped_users = {
+        cluster_id: [group for group in groups_in_cluster if tuple(user_entry.user_id for user_entry in group) in committed]
+        for cluster_id, groups_in_cluster in grouped_users.items()
+    }
+
+    #distribute grouped users to rooms
+    #format of matched_groups
+    # matched_groups = [{"room_id": 123, "user_ids": [1,2,3,4]}, {"room_id": 555, "user_ids": [5,6,7,8]}]
+    matched_groups, users_in_matched_groups = distribute_rooms(grouped_users, redis_client)
+
+
+    #remember when this is returned, it is a tuple as two values are returned!
+    logger.info("Matched groups: %s", matched_groups)
+
+    # ##this needs amending for robustness
+    # removed_ids = redis_client.smembers("rooms")
+    # print(f"removed_ids: {removed_ids}")
+    # if removed_ids:
+    #     redis_client.srem("rooms", *removed_ids)
+
+
+    # get the channel layer
+    channel_layer = get_channel_layer()
+
+    # matched_groups in this format:
+    #  Tuple[List[Dict[str, object]], List[int]]
+    # [
+    #     {"room_id": 5, "user_ids": [1, 2, 3, 4]},
+    #     {"room_id": 2, "user_ids": [5, 6, 7, 8]}
+    # ]
+
+    #the channel of every matched user's connection, in one round trip, so they can be sent to directly rather than through their group
+    channels = channels_of(redis_client, users_in_matched_groups)
+
+    #all room assignments of the tick are sent concurrently in a single event loop (see matching/notify.py), one async_to_sync hop in total
+    success_matched_userIds, failed_sends = async_to_sync(notify_room_assignments)(channel_layer, matched_groups, settings.MATCHING_NOTIFY_CONCURRENCY, channels)
+    failed_user_ids = []
+    for user_id, error in failed_sends:
+        logger.error("Error sending to user %d: %s", user_id, error)
+        failed_user_ids.append(user_id)
+
+    #matched users already left the Redis queue when their group was committed. The ones who couldn't be told their room go back in with their original join time, like they used to stay in the queue. If their connection is gone its lease went with it, and the next claim drops them.
+    logger.info("Matched users removed from queue: %s", success_matched_userIds)
+    for user_id in failed_user_ids:
+        join_queue(redis_client, user_id, joined_at[user_id])
+
+    return matched_groups
@@ -10,6 +10,7 @@ from django.urls import re_path
 
 from chat.consumers import GroupConsumer
 from channels.db import database_sync_to_async
+from lyncup.token_auth import TokenAuthMiddleware
 
 
 #application is an ASGI applicatiomn that acts as the entry point for handling incoming socket requests.
@@ -17,7 +18,8 @@ from channels.db import database_sync_to_async
 application = ProtocolTypeRouter(
     {
         # "websocket": URLRouter([path("ws/chat/somegroup", GroupConsumer.as_asgi())])
-        "websocket": URLRouter([re_path(r"ws/chat/(?P<groupname>\w+)/$", GroupConsumer.as_asgi())])
+        #the consumer reads the user from scope["token_user"], which TokenAuthMiddleware sets like in lyncup/asgi.py
+        "websocket": TokenAuthMiddleware(URLRouter([re_path(r"ws/chat/(?P<groupname>\w+)/$", GroupConsumer.as_asgi())]))
     }
 )
 @pytest.mark.asyncio
@@ -0,0 +1,65 @@
+import pytest
+import numpy as np
+from django.db.models.query import QuerySet
+from users.models import AppUser, Like
+from matching.like_extraction import load_likes_df
+
+
+def create_likes():
+    users = [
+        AppUser.objects.create_user(
+            email=f"liker{i}@testing.com",
+            username=f"liker{i}",
+            password="testing",
+            firstname="Liker",
+            lastname=str(i),
+        )
+        for i in range(4)
+    ]
+    likes = [(0, 1, 3), (0, 2, 1), (1, 2, 5), (2, 3, 2), (3, 0, 7)]
+    for user_from, user_to, like_count in likes:
+        Like.objects.create(user_from=users[user_from], user_to=users[user_to], like_count=like_count)
+    return {(users[user_from].id, users[user_to].id, like_count) for user_from, user_to, like_count in likes}
+
+def rows_of(likes_df):
+    return set(zip(likes_df["user_from"].tolist(), likes_df["user_to"].tolist(), likes_df["like_count"].tolist()))
+
+#chunk_size smaller than the number of rows, so the rows are read over several chunks
+@pytest.mark.django_db
+def test_load_likes_df_in_chunks():
+    expected = create_likes()
+
+    likes_df = load_likes_df(chunk_size=2)
+
+    assert list(likes_df.columns) == ["user_from", "user_to", "like_count"]
+    assert likes_df["user_from"].dtype == np.int64
+    assert likes_df["user_to"].dtype == np.int64
+    assert likes_df["like_count"].dtype == np.int32
+    assert rows_of(likes_df) == expected
+
+@pytest.mark.django_db
+def test_load_likes_df_with_queryset():
+    expected = create_likes()
+    strong = {row for row in expected if row[2] >= 3}
+
+    likes_df = load_likes_df(Like.objects.filter(like_count__gte=3), chunk_size=2)
+
+    assert rows_of(likes_df) == strong
+
+#rows inserted between the count and the read: the preallocated arrays are too small and have to grow
+@pytest.mark.django_db
+def test_load_likes_df_grows_past_count(monkeypatch):
+    expected = create_likes()
+    monkeypatch.setattr(QuerySet, "count", lambda self: 1)
+
+    likes_df = load_likes_df(chunk_size=2)
+
+    assert len(likes_df) == len(expected)
+    assert rows_of(likes_df) == expected
+
+@pytest.mark.django_db
+def test_load_likes_df_empty():
+    likes_df = load_likes_df()
+
+    assert len(likes_df) == 0
+    assert list(likes_df.columns) == ["user_from", "user_to", "like_count"]
@@ -0,0 +1,37 @@
+import pytest
+from unittest.mock import Mock
+import users.signals as signals
+from users.models import AppUser
+
+
+#saving or deleting a user drops their cached websocket user and updates their matchable bit, once the transaction has committed
+@pytest.mark.django_db
+def test_user_signals(monkeypatch, django_capture_on_commit_callbacks):
+    invalidate = Mock()
+    update_matchable = Mock()
+    monkeypatch.setattr(signals, "invalidate_token_user", invalidate)
+    monkeypatch.setattr(signals, "update_matchable", update_matchable)
+
+    with django_capture_on_commit_callbacks(execute=False) as callbacks:
+        user = AppUser.objects.create_user(
+            email="signals@testing.com",
+            username="signals",
+            password="testing",
+            firstname="Signal",
+            lastname="User",
+        )
+    #nothing happens before the commit
+    invalidate.assert_not_called()
+    update_matchable.assert_not_called()
+    for callback in callbacks:
+        callback()
+    invalidate.assert_called_once_with(user.id)
+    update_matchable.assert_called_once_with(user.id, user.is_active and user.is_verified)
+
+    invalidate.reset_mock()
+    update_matchable.reset_mock()
+    user_id = user.id
+    with django_capture_on_commit_callbacks(execute=True):
+        user.delete()
+    invalidate.assert_called_once_with(user_id)
+    update_matchable.assert_called_once_with(user_id, False)
@@ -0,0 +1,78 @@
+#benchmark of the group-formation engines (matching/group_formation.py): quality and runtime of the agglomerative optimiser against the current greedy algorithm.
+#queued users are simulated as noisy members of planted friend circles in embedding space. For every queue size, the candidates are computed once (the same way match_queue_in_cluster does, or with an annoy index over the queue above --dense-limit users, as the exact similarity matrix grows with the square of the queue) and then every engine is timed on them.
+#quality is the average cosine similarity between two members of the same group. Users an engine leaves unassigned are grouped in random fours afterwards, just like the leftover queue in run_batch_matching, so they count against it.
+#run from the repository root:
+#   python tests/matching_algo_eval/benchmark_group_formation.py
+#   python tests/matching_algo_eval/benchmark_group_formation.py --sizes 100 1000 --time-budget 2
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from annoy import AnnoyIndex
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from matching.group_formation import GROUP_FORMATION_ENGINES, queue_candidates, grouping_similarity
+
+
+def simulated_queue(num_users, dimensions=32, circle_size=6, noise=0.8, seed=0):
+    rng = np.random.default_rng(seed)
+    num_circles = max(1, num_users // circle_size)
+    centres = rng.normal(size=(num_circles, dimensions))
+    vectors = centres[rng.integers(num_circles, size=num_users)] + noise * rng.normal(size=(num_users, dimensions))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+#approximate candidates for big queues: top_k annoy neighbours of every user, without the user itself
+def annoy_candidates(unit_vectors, top_k, num_trees=10):
+    annoy_index = AnnoyIndex(unit_vectors.shape[1], "angular")
+    for position, vector in enumerate(unit_vectors):
+        annoy_index.add_item(position, vector)
+    annoy_index.build(num_trees)
+
+    candidates = np.full((len(unit_vectors), top_k), -1, dtype=np.int64)
+    for position in range(len(unit_vectors)):
+        neighbours = [index for index in annoy_index.get_nns_by_item(position, top_k + 1) if index != position][:top_k]
+        candidates[position, :len(neighbours)] = neighbours
+    return candidates
+
+#leftovers in random fours, like run_batch_matching does with the leftover queue
+def with_leftover_groups(groups, unassigned, seed=0):
+    unassigned = np.random.default_rng(seed).permutation(unassigned).tolist()
+    return groups + [unassigned[start:start + 4] for start in range(0, len(unassigned), 4)]
+
+def mean_pair_similarity(unit_vectors, groups):
+    num_pairs = sum(len(group) * (len(group) - 1) // 2 for group in groups)
+    return grouping_similarity(unit_vectors, groups) / num_pairs if num_pairs else 0.0
+
+def run(sizes, time_budget, top_k, dense_limit):
+    print(f"{'users':>8} {'engine':>14} {'seconds':>9} {'pair sim':>9} {'grouped':>8} {'unassigned':>10}")
+    for num_users in sizes:
+        unit_vectors = simulated_queue(num_users)
+
+        started = time.perf_counter()
+        if num_users <= dense_limit:
+            candidates = queue_candidates(unit_vectors, top_k=top_k)
+        else:
+            candidates = annoy_candidates(unit_vectors, top_k)
+        print(f"{num_users:>8} {'(candidates)':>14} {time.perf_counter() - started:>9.3f}")
+
+        for engine, form_groups in GROUP_FORMATION_ENGINES.items():
+            started = time.perf_counter()
+            deadline = started + time_budget if time_budget else None
+            groups, unassigned = form_groups(unit_vectors, candidates, deadline)
+            seconds = time.perf_counter() - started
+
+            quality = mean_pair_similarity(unit_vectors, with_leftover_groups(groups, unassigned))
+            grouped = sum(len(group) for group in groups)
+            print(f"{num_users:>8} {engine:>14} {seconds:>9.3f} {quality:>9.4f} {grouped:>8} {len(unassigned):>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--time-budget", type=float, default=None, help="seconds per engine run, unlimited by default")
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--dense-limit", type=int, default=20000, help="largest queue whose candidates are computed exactly")
+    args = parser.parse_args()
+    run(args.sizes, args.time_budget, args.top_k, args.dense_limit)
@@ -0,0 +1,40 @@
+import os
+from matching.artifacts import new_version_dir, publish_version, resolve_version_dir, load_manifest, collect_old_versions
+
+'''
+Test versioned index artifacts
+'''
+def test_publish_swaps_current_version(tmp_path):
+    base_dir = str(tmp_path)
+
+    #nothing published yet: readers fall back to base_dir itself
+    assert resolve_version_dir(base_dir) == base_dir
+
+    first_dir = new_version_dir(base_dir)
+    publish_version(base_dir, first_dir, {"embed_dimensions": 8})
+    assert os.path.samefile(resolve_version_dir(base_dir), first_dir)
+
+    second_dir = new_version_dir(base_dir)
+    version = publish_version(base_dir, second_dir, {"embed_dimensions": 8})
+    assert os.path.samefile(resolve_version_dir(base_dir), second_dir)
+
+    manifest = load_manifest(resolve_version_dir(base_dir))
+    assert manifest["version"] == version
+    assert manifest["embed_dimensions"] == 8
+
+    #a version directory resolves to itself
+    assert resolve_version_dir(second_dir) == second_dir
+
+def test_collect_old_versions_keeps_current(tmp_path):
+    base_dir = str(tmp_path)
+
+    version_dirs = [new_version_dir(base_dir) for _ in range(5)]
+    #publish an older one, it must survive garbage collection
+    publish_version(base_dir, version_dirs[0], {})
+
+    removed = collect_old_versions(base_dir, keep=2)
+
+    assert len(removed) == 2
+    assert os.path.exists(version_dirs[0])
+    remaining = os.listdir(os.path.join(base_dir, "versions"))
+    assert len(remaining) == 3
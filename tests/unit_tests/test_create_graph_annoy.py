@@ -1,7 +1,13 @@
 import os
 import json
+import numpy as np
 import pandas as pd
-from matching.build_graph_annoy import create_graph_from_likes, create_node2vec_annoy
+import networkx as nx
+from matching.build_graph_annoy import create_graph_from_likes, create_node2vec_annoy, build_like_adjacency, refresh_node2vec_annoy, compare_embedding_engines
+from matching.artifacts import resolve_version_dir, load_manifest
+from matching.index_map import UserIndexMap, UserClusterTable
+from matching.matching import route_users, run_batch_matching, index_is_ready
+from matching.queue_manager import ClusterQueueManager
 
 def test_create_graph_from_likes():
     #create dummy dataframe
@@ -25,13 +31,45 @@ def test_create_graph_from_likes():
     assert graph.has_edge(2,1)
     assert graph[2][1]["weight"] == 5 * 0.5
 
-def test_create_node2vec_annoy():
+#the vectorised builder must give exactly the same graph as the original iterrows() loop, including duplicate rows, mutual likes and self-likes.
+def test_build_like_adjacency_matches_loop_version():
+    rng = np.random.default_rng(0)
+    likes_df = pd.DataFrame({
+        "user_from": rng.integers(1, 40, size=500),
+        "user_to": rng.integers(1, 40, size=500),
+        "like_count": rng.integers(0, 10, size=500),
+    })
+
+    #the old loop implementation, kept here as the reference
+    expected = nx.DiGraph()
+    all_edges = set(zip(likes_df.user_from, likes_df.user_to))
+    for i, row in likes_df.iterrows():
+        u, v, w = row.user_from, row.user_to, float(row.like_count)
+        if expected.has_edge(u, v):
+            expected[u][v]["weight"] += w
+        else:
+            expected.add_edge(u, v, weight=w)
+        if (v, u) not in all_edges:
+            if expected.has_edge(v, u):
+                expected[v][u]["weight"] += w * 0.5
+            else:
+                expected.add_edge(v, u, weight=w * 0.5)
 
-    base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Annoy")
+    graph = create_graph_from_likes(likes_df, reciprocal_weight=0.5)
+    assert set(graph.nodes()) == set(expected.nodes())
+    assert set(graph.edges()) == set(expected.edges())
+    for u, v, data in expected.edges(data=True):
+        assert graph[u][v]["weight"] == data["weight"]
+
+    #csr rows/columns follow the sorted user ids
+    adjacency, node_ids = build_like_adjacency(likes_df, reciprocal_weight=0.5)
+    assert list(node_ids) == sorted(expected.nodes())
+    assert adjacency.nnz == expected.number_of_edges()
 
-    #check if base dir folder exists, if not, create it.
-    if not os.path.exists(base_dir):
-        os.makedirs(base_dir, exist_ok=True)
+#builds into pytest's tmp_path, other tests call it with their own tmp_path to get a small index
+def test_create_node2vec_annoy(tmp_path):
+
+    base_dir = str(tmp_path)
 
     likes_data = {
         #columns: 
@@ -46,24 +84,105 @@ def test_create_node2vec_annoy():
     create_node2vec_annoy(likes_df, base_dir=base_dir, embed_dimensions=128, num_trees=10)
 
     #check that the function has successfully created the annoy file and global map file.
-    annoy_file = os.path.join(base_dir, "cluster_global.ann")
-    global_map = os.path.join(base_dir, "global_map.json")
-
-
+    annoy_file = os.path.join(resolve_version_dir(base_dir), "cluster_global.ann")
     assert os.path.exists(annoy_file)
-    assert os.path.exists(global_map)
+    assert UserIndexMap.exists(resolve_version_dir(base_dir), "global")
 
-    #check if all the keys are present
-    with open(global_map, "r") as f:
-        map_data = json.load(f)
-    assert "user_index_map" in map_data
-    assert "index_user_map" in map_data
-    assert "embed_dimensions" in map_data
+    #check every user got an index and the map translates both ways
+    index_map = UserIndexMap.load(resolve_version_dir(base_dir), "global")
+    assert len(index_map) == 4
+    for user_id in [1, 2, 3, 4]:
+        assert index_map.user_of(index_map.index_of(user_id)) == user_id
+    assert load_manifest(resolve_version_dir(base_dir))["embed_dimensions"] == 128
 
+#the incremental refresh warm-starts from the model saved by test_create_node2vec_annoy and must also add brand new users to the index
+def test_refresh_node2vec_annoy(tmp_path):
+    test_create_node2vec_annoy(tmp_path)
 
+    base_dir = str(tmp_path)
 
+    likes_data = {
+        "user_from": [1, 2, 3, 4, 5],
+        "user_to":   [2, 3, 1, 3, 1],
+        "like_count": [5, 10, 2, 5, 1]
+    }
+    likes_df = pd.DataFrame(likes_data)
 
+    #user 5 is new and liked user 1
+    assert refresh_node2vec_annoy(likes_df, {5, 1}, base_dir=base_dir, num_trees=10)
 
+    index_map = UserIndexMap.load(resolve_version_dir(base_dir), "global")
+    assert 5 in index_map
+    assert len(index_map) == 5
 
+    #without a previous model there is nothing to warm-start from
+    assert refresh_node2vec_annoy(likes_df, {5}, base_dir=os.path.join(base_dir, "missing")) is False
+
+#the spectral engine must write the same artifacts as node2vec
+def test_create_spectral_annoy(tmp_path):
+    likes_data = {
+        "user_from": [1, 2, 3, 4],
+        "user_to":   [2, 3, 1, 3],
+        "like_count": [5, 10, 2, 5]
+    }
+    likes_df = pd.DataFrame(likes_data)
 
-    
\ No newline at end of file
+    create_node2vec_annoy(likes_df, base_dir=str(tmp_path), embed_dimensions=16, num_trees=5, engine="spectral")
+
+    assert os.path.exists(os.path.join(resolve_version_dir(tmp_path), "cluster_global.ann"))
+    assert len(UserIndexMap.load(resolve_version_dir(tmp_path), "global")) == 4
+    assert load_manifest(resolve_version_dir(tmp_path))["embed_dimensions"] == 16
+
+#two communities that only like inside their own community: both engines should find held-out likes among the nearest users
+def test_compare_embedding_engines():
+    rng = np.random.default_rng(0)
+    user_from = rng.integers(0, 60, size=1500)
+    #users 0-29 like 0-29, users 30-59 like 30-59
+    user_to = (user_from // 30) * 30 + rng.integers(0, 30, size=1500)
+    keep = user_from != user_to
+    likes_df = pd.DataFrame({"user_from": user_from[keep] + 1, "user_to": user_to[keep] + 1, "like_count": 1})
+
+    report = compare_embedding_engines(likes_df, embed_dimensions=16, top_k=10, workers=1)
+
+    for engine in ("node2vec", "spectral"):
+        assert report[engine]["build_seconds"] > 0
+        assert report[engine]["num_heldout_likes"] > 0
+        #random neighbours would only hit about 10 / 59 of the time
+        assert report[engine]["recall_at_k"] > 0.25
+
+#two separate friend circles must end up in two clusters, each with its own index, and queued users must be routed to their circle's cluster
+def test_create_clustered_annoy(tmp_path):
+    user_from, user_to = [], []
+    for circle in [range(1, 11), range(11, 21)]:
+        for a in circle:
+            for b in circle:
+                if a != b:
+                    user_from.append(a)
+                    user_to.append(b)
+    likes_df = pd.DataFrame({"user_from": user_from, "user_to": user_to, "like_count": [1] * len(user_from)})
+
+    create_node2vec_annoy(likes_df, base_dir=str(tmp_path), embed_dimensions=8, num_trees=5, engine="spectral", users_per_cluster=10)
+
+    version_dir = resolve_version_dir(tmp_path)
+    cluster_ids = load_manifest(version_dir)["clusters"]
+    assert len(cluster_ids) == 2
+    assert index_is_ready(version_dir)
+
+    table = UserClusterTable.load(version_dir, cluster_ids)
+    first_circle = {table.cluster_of(user_id) for user_id in range(1, 11)}
+    second_circle = {table.cluster_of(user_id) for user_id in range(11, 21)}
+    assert len(first_circle) == 1 and len(second_circle) == 1
+    assert first_circle != second_circle
+    assert table.cluster_of(999) is None
+
+    queue_manager = ClusterQueueManager()
+    route_users(queue_manager, [1, 2, 3, 4, 11, 12, 13, 14, 999], version_dir)
+    assert queue_manager.get_cluster_size(first_circle.pop()) == 4
+    assert queue_manager.get_cluster_size(second_circle.pop()) == 4
+    assert queue_manager.get_cluster_size("leftover") == 1
+
+    #every circle forms its group inside its own cluster
+    res = run_batch_matching(queue_manager, base_dir=str(tmp_path))
+    for cluster_id in cluster_ids:
+        assert len(res[cluster_id]) == 1
+        assert len(res[cluster_id][0]) == 4
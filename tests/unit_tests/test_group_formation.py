@@ -0,0 +1,67 @@
+import time
+import numpy as np
+from matching.group_formation import greedy_groups, agglomerative_groups, queue_candidates, grouping_similarity
+
+
+#num_groups planted groups of 4 users scattered around their own random direction
+def planted_users(num_groups=25, dimensions=16, noise=0.5, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(num_groups, dimensions))
+    vectors = np.repeat(centres, 4, axis=0) + noise * rng.normal(size=(num_groups * 4, dimensions))
+    #shuffled, so queue order says nothing about the groups
+    order = rng.permutation(len(vectors))
+    vectors = vectors[order]
+    unit_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return unit_vectors, order // 4
+
+def assert_partition(groups, unassigned, num_users):
+    for group in groups:
+        assert 3 <= len(group) <= 4
+    users = [user for group in groups for user in group] + list(unassigned)
+    assert sorted(users) == list(range(num_users))
+
+def test_agglomerative_recovers_planted_groups():
+    unit_vectors, planted = planted_users()
+    candidates = queue_candidates(unit_vectors, top_k=50)
+
+    groups, unassigned = agglomerative_groups(unit_vectors, candidates)
+    assert_partition(groups, unassigned, len(unit_vectors))
+    assert not unassigned
+    for group in groups:
+        assert len(set(planted[group].tolist())) == 1
+
+    greedy, greedy_unassigned = greedy_groups(unit_vectors, candidates)
+    assert_partition(greedy, greedy_unassigned, len(unit_vectors))
+    assert grouping_similarity(unit_vectors, groups) >= grouping_similarity(unit_vectors, greedy)
+
+#sizes that don't split into fours still end up in groups of 3 to 4, and an expired deadline still gives a valid answer
+def test_agglomerative_group_sizes_and_deadline():
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(103, 8))
+    unit_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    candidates = queue_candidates(unit_vectors, top_k=20)
+
+    groups, unassigned = agglomerative_groups(unit_vectors, candidates)
+    assert_partition(groups, unassigned, 103)
+    assert len(unassigned) <= 2
+
+    groups, unassigned = agglomerative_groups(unit_vectors, candidates, deadline=time.perf_counter() - 1)
+    assert_partition(groups, unassigned, 103)
+
+    assert agglomerative_groups(unit_vectors[:2], candidates[:2, :1]) == ([], [0, 1])
+
+#the deadline bounds the candidate search and every engine step, not only the engine's main loops
+def test_deadline_bounds_candidates_and_completion():
+    rng = np.random.default_rng(2)
+    vectors = rng.normal(size=(20000, 16))
+    unit_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    #rows not reached before the deadline are left without candidates
+    assert (queue_candidates(unit_vectors, top_k=20, deadline=time.perf_counter() - 1) == -1).all()
+
+    started = time.perf_counter()
+    deadline = started + 0.2
+    candidates = queue_candidates(unit_vectors, top_k=20, deadline=deadline)
+    groups, unassigned = agglomerative_groups(unit_vectors, candidates, deadline)
+    assert time.perf_counter() - started < 0.6
+    assert_partition(groups, unassigned, 20000)
@@ -0,0 +1,46 @@
+import json
+import numpy as np
+from matching.index_map import UserIndexMap, UserClusterTable
+
+
+def test_user_index_map_roundtrip(tmp_path):
+    #user_list[i] is the user at annoy index i, deliberately unsorted
+    user_list = [42, 7, 1000, 3]
+    UserIndexMap.from_user_list(user_list).save(str(tmp_path), "global")
+
+    index_map = UserIndexMap.load(str(tmp_path), "global")
+    assert len(index_map) == 4
+    assert index_map.index_of(1000) == 2
+    assert index_map.index_of(8) is None
+    assert 7 in index_map and 8 not in index_map
+    assert index_map.indices_of([3, 42, 5, 2000]).tolist() == [3, 0, -1, -1]
+    assert index_map.user_of(1) == 7
+    assert index_map.users_of([2, 0]).tolist() == [1000, 42]
+
+#index versions built before the binary format only have the json map
+def test_user_index_map_legacy_json(tmp_path):
+    map_data = {
+        "user_index_map": {"42": 0, "7": 1},
+        "index_user_map": {"0": "42", "1": "7"},
+        "embed_dimensions": 8,
+    }
+    with open(tmp_path / "global_map.json", "w") as f:
+        json.dump(map_data, f)
+
+    assert UserIndexMap.exists(str(tmp_path), "global")
+    index_map = UserIndexMap.load(str(tmp_path), "global")
+    assert index_map.index_of(7) == 1
+    assert np.array_equal(index_map.users_of([0, 1]), [42, 7])
+
+def test_user_cluster_table(tmp_path):
+    UserClusterTable.from_labels([5, 2, 9], [1, 0, 1], ["0", "1"]).save(str(tmp_path))
+
+    table = UserClusterTable.load(str(tmp_path), ["0", "1"])
+    assert table.cluster_of(5) == "1"
+    assert table.cluster_of(2) == "0"
+    assert table.cluster_of(3) is None
+    assert table.cluster_of(100) is None
+    assert table.codes_of([9, 3, 100, -1]).tolist() == [1, -1, -1, -1]
+
+    #versions built before clustering have no table
+    assert UserClusterTable.load(str(tmp_path / "missing"), ["global"]) is None
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+from matching.build_graph_annoy import create_node2vec_annoy
+from matching.artifacts import resolve_version_dir
+from matching.index_registry import IndexRegistry
+from matching.matching import candidate_indices
+
+
+def build_index(base_dir, users_per_cluster=20000):
+    user_from, user_to = [], []
+    for circle in [range(1, 11), range(11, 21)]:
+        for a in circle:
+            for b in circle:
+                if a != b:
+                    user_from.append(a)
+                    user_to.append(b)
+    likes_df = pd.DataFrame({"user_from": user_from, "user_to": user_to, "like_count": [1] * len(user_from)})
+    create_node2vec_annoy(likes_df, base_dir=base_dir, embed_dimensions=8, num_trees=5, engine="spectral", users_per_cluster=users_per_cluster)
+    return resolve_version_dir(base_dir)
+
+#a cluster is loaded once per version and reloaded only after a new version was published
+def test_registry_caches_per_version(tmp_path):
+    registry = IndexRegistry()
+    version_dir = build_index(str(tmp_path))
+
+    cluster = registry.get(version_dir, "global")
+    assert cluster.embed_dimensions == 8
+    assert cluster.index_map.index_of(5) is not None
+    assert registry.get(version_dir, "global") is cluster
+    assert registry.get(version_dir, "missing") is None
+
+    new_version_dir = build_index(str(tmp_path))
+    new_cluster = registry.get(new_version_dir, "global")
+    assert new_cluster is not cluster
+    #the old version's index has been dropped
+    assert list(registry.clusters) == [(new_version_dir, "global")]
+
+#over budget the least recently used clusters are unloaded first
+def test_registry_memory_budget(tmp_path):
+    version_dir = build_index(str(tmp_path), users_per_cluster=10)
+
+    registry = IndexRegistry()
+    assert registry.warm_up(str(tmp_path)) == 2
+    assert len(registry.clusters) == 2
+
+    registry = IndexRegistry(max_bytes=1)
+    registry.get(version_dir, "0")
+    registry.get(version_dir, "1")
+    assert list(registry.clusters) == [(version_dir, "1")]
+
+#the precomputed neighbour lists hold every other user of the cluster by cosine similarity of their vectors, closest first, without the user itself
+def test_precomputed_neighbour_lists(tmp_path):
+    version_dir = build_index(str(tmp_path))
+    cluster = IndexRegistry().get(version_dir, "global")
+
+    assert cluster.neighbours.shape == (20, 50)
+    assert cluster.neighbours.dtype == np.int32
+    vectors = np.array([cluster.annoy_index.get_item_vector(user_index) for user_index in range(20)])
+    unit_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    for user_index in range(20):
+        row = cluster.neighbours[user_index]
+        #only 19 other users, the rest is padding
+        assert (row[19:] == -1).all()
+        assert sorted(row[:19].tolist()) == [index for index in range(20) if index != user_index]
+        similarities = unit_vectors[row[:19]] @ unit_vectors[user_index]
+        assert (np.diff(similarities) <= 1e-5).all()
+        assert candidate_indices(cluster, user_index, 50) == row[:19].tolist()
+
+    #asking for more candidates than were precomputed falls back to annoy
+    assert len(candidate_indices(cluster, 0, 60)) == 20
+
+#the stored vectors are the ones in the annoy index, by annoy index
+def test_stored_vectors(tmp_path):
+    version_dir = build_index(str(tmp_path))
+    cluster = IndexRegistry().get(version_dir, "global")
+
+    assert cluster.vectors.shape == (20, 8)
+    assert cluster.vectors.dtype == np.float32
+    for user_index in range(20):
+        assert np.allclose(cluster.vectors[user_index], cluster.annoy_index.get_item_vector(user_index), atol=1e-6)
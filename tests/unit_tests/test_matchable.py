@@ -0,0 +1,74 @@
+from unittest.mock import Mock
+from matching.matchable import build_bitmap, matchable_of, set_matchable, rebuild_matchable, MATCHABLE_KEY, REBUILDING_KEY, CHANGES_KEY, REBUILD_TTL, SET_MATCHABLE_SCRIPT, FINISH_REBUILD_SCRIPT
+
+'''
+Test matchable users bitmap
+'''
+#Redis numbers the bits of a bitmap from the most significant bit of the first byte, GETBIT on the built bytes must find exactly the given ids
+def test_build_bitmap_bit_order():
+    user_ids = [0, 3, 9, 17]
+    bitmap = build_bitmap(user_ids)
+
+    assert len(bitmap) == 3
+    bits = [(bitmap[offset >> 3] >> (7 - (offset & 7))) & 1 for offset in range(len(bitmap) * 8)]
+    assert [offset for offset, bit in enumerate(bits) if bit] == user_ids
+    assert build_bitmap([]) == b""
+
+def test_matchable_of():
+    #mock pipeline, EXISTS first then one GETBIT per user
+    test_redis = Mock()
+    pipeline = test_redis.pipeline.return_value
+    pipeline.execute.return_value = [1, 1, 0, 1]
+
+    assert matchable_of(test_redis, [4, 5, 6]) == {4, 6}
+    pipeline.exists.assert_called_once_with(MATCHABLE_KEY)
+    assert pipeline.getbit.call_count == 3
+    #one round trip for the whole batch
+    pipeline.execute.assert_called_once()
+
+    #no bitmap built yet
+    pipeline.execute.return_value = [0, 0, 0, 0]
+    assert matchable_of(test_redis, [4, 5, 6]) is None
+
+#every change is sent to the script that also logs it while a rebuild runs
+def test_set_matchable():
+    test_redis = Mock()
+    script = test_redis.register_script.return_value
+
+    set_matchable(test_redis, 7, False)
+    test_redis.register_script.assert_called_once_with(SET_MATCHABLE_SCRIPT)
+    script.assert_called_once_with(keys=[MATCHABLE_KEY, REBUILDING_KEY, CHANGES_KEY], args=[7, 0])
+
+#the database is only read once changes are being logged, and the bitmap is replaced by the rebuild holding the lock
+def test_rebuild_matchable():
+    test_redis = Mock()
+    test_redis.set.return_value = True
+    script = test_redis.register_script.return_value
+    script.return_value = 1
+
+    def read_user_ids():
+        test_redis.set.assert_called_once()
+        test_redis.delete.assert_called_once_with(CHANGES_KEY)
+        return [0, 3]
+
+    assert rebuild_matchable(test_redis, read_user_ids) is True
+    key, token = test_redis.set.call_args.args
+    assert key == REBUILDING_KEY
+    assert test_redis.set.call_args.kwargs == {"nx": True, "ex": REBUILD_TTL}
+    test_redis.register_script.assert_called_once_with(FINISH_REBUILD_SCRIPT)
+    script.assert_called_once_with(keys=[MATCHABLE_KEY, REBUILDING_KEY, CHANGES_KEY], args=[build_bitmap([0, 3]), token])
+
+    #the rebuild outlived its lock
+    script.return_value = 0
+    assert rebuild_matchable(test_redis, lambda: []) is False
+    assert script.call_args.kwargs["args"][0] == b"\x00"
+
+#another rebuild is running, nothing is read or written
+def test_rebuild_matchable_already_running():
+    test_redis = Mock()
+    test_redis.set.return_value = None
+    read_user_ids = Mock()
+
+    assert rebuild_matchable(test_redis, read_user_ids) is None
+    read_user_ids.assert_not_called()
+    test_redis.register_script.assert_not_called()
@@ -0,0 +1,112 @@
+from unittest.mock import Mock
+from django.conf import settings
+import matching.tasks as tasks
+from matching.tasks import dispatch_matching_fanout, match_cluster_task, finish_matching_fanout, MATCHING_LOCK_KEY, MATCHING_LOCK_TTL
+from matching.queue_manager import ClusterQueueManager
+from matching.redis_queue import EXTEND_LOCK_SCRIPT, RELEASE_LOCK_SCRIPT, RELEASE_SCRIPT, CLAIMED_KEY, QUEUE_KEY
+from test_index_registry import build_index
+
+'''
+Test the fan-out matching tasks
+'''
+#mock redis like in test_redis_queue.py. Every registered script is a mock of its own, extending the tick's lock replies lock_held
+def mock_redis(monkeypatch, lock_held=1):
+    test_redis = Mock()
+    test_redis.set.return_value = True
+    scripts = {}
+
+    def register_script(source):
+        if source not in scripts:
+            scripts[source] = Mock(return_value=lock_held if source == EXTEND_LOCK_SCRIPT else 1)
+        return scripts[source]
+
+    test_redis.register_script.side_effect = register_script
+    monkeypatch.setattr(tasks.redis, "from_url", lambda *args, **kwargs: test_redis)
+    return test_redis, scripts
+
+def test_dispatch_matching_fanout(monkeypatch):
+    test_redis, scripts = mock_redis(monkeypatch)
+    test_chord = Mock()
+    monkeypatch.setattr(tasks, "chord", test_chord)
+
+    queue_manager = ClusterQueueManager()
+    queue_manager.add("0", 1, 10.0)
+    queue_manager.add("0", 2, 20.0)
+    queue_manager.add("1", 3, 30.0)
+    queue_manager.add("leftover", 4, 40.0)
+    retrieved = [(1, 10.0), (2, 20.0), (3, 30.0), (4, 40.0)]
+
+    dispatch_matching_fanout(test_redis, queue_manager, retrieved, "base", "token")
+
+    #one task per non-empty cluster, each with its users' claim times and the tick's lock token
+    header = test_chord.call_args.args[0]
+    assert sorted(task.args for task in header) == [("0", [[1, 10.0], [2, 20.0]], "base", "token"), ("1", [[3, 30.0]], "base", "token")]
+    callback = test_chord.return_value.call_args.args[0]
+    assert callback.args == ([[4, 40.0]], [[1, 10.0], [2, 20.0], [3, 30.0], [4, 40.0]], "token")
+
+    #the lock covers both clusters running one after the other
+    scripts[EXTEND_LOCK_SCRIPT].assert_called_once_with(keys=[MATCHING_LOCK_KEY], args=["token", int((MATCHING_LOCK_TTL + 2 * settings.MATCHING_TICK_BUDGET) * 1000)])
+
+#groups are delivered with the users' claim times, users without a group are returned with them
+def test_match_cluster_task(monkeypatch, tmp_path):
+    base_dir = build_index(str(tmp_path))
+    test_redis, scripts = mock_redis(monkeypatch)
+    delivered = []
+    monkeypatch.setattr(tasks, "deliver_groups", lambda redis_client, grouped_users, joined_at, lock_token: delivered.append((grouped_users, joined_at, lock_token)))
+
+    users = [[user_id, float(user_id)] for user_id in [1, 2, 3, 4, 11, 12, 13, 14, 999]]
+    leftovers = match_cluster_task("global", users, base_dir, "token")
+
+    assert leftovers == [[999, 999.0]]
+    #committed under the tick's lock, not the cluster's
+    grouped_users, joined_at, lock_token = delivered[0]
+    assert lock_token == "token"
+    assert sorted(sorted(entry.user_id for entry in group) for group in grouped_users["global"]) == [[1, 2, 3, 4], [11, 12, 13, 14]]
+    assert joined_at == {user_id: joined for user_id, joined in users}
+
+    #the cluster lock is released with the token it was taken with
+    cluster_lock_token = test_redis.set.call_args.args[1]
+    scripts[RELEASE_LOCK_SCRIPT].assert_called_once_with(keys=[f"{MATCHING_LOCK_KEY}_global"], args=[cluster_lock_token])
+
+#a cluster task of a tick that lost its lock leaves the users alone
+def test_match_cluster_task_lock_lost(monkeypatch):
+    test_redis, scripts = mock_redis(monkeypatch, lock_held=0)
+    budgeted = Mock()
+    monkeypatch.setattr(tasks, "run_budgeted_matching", budgeted)
+
+    assert match_cluster_task("global", [[1, 10.0]], "base", "token") == []
+    budgeted.assert_not_called()
+    test_redis.set.assert_not_called()
+
+def test_finish_matching_fanout(monkeypatch):
+    test_redis, scripts = mock_redis(monkeypatch)
+    monkeypatch.setattr(tasks, "request_matching", Mock())
+    delivered = []
+    monkeypatch.setattr(tasks, "deliver_groups", lambda redis_client, grouped_users, joined_at, lock_token: delivered.append((grouped_users, joined_at, lock_token)))
+
+    tick_users = [[5, 30.0], [6, 10.0], [7, 20.0], [8, 5.0]]
+    finish_matching_fanout([[[5, 30.0]], [[6, 10.0]]], [[7, 20.0]], tick_users, "token")
+
+    grouped_users, joined_at, lock_token = delivered[0]
+    assert lock_token == "token"
+    group = grouped_users["leftover"][0]
+    assert sorted(entry.user_id for entry in group) == [5, 6, 7]
+    assert all(entry.joined_at == joined_at[entry.user_id] for entry in group)
+    assert joined_at == {5: 30.0, 6: 10.0, 7: 20.0, 8: 5.0}
+
+    #everyone of the tick still claimed is released, then the lock, by its owner
+    scripts[RELEASE_SCRIPT].assert_called_once_with(keys=[CLAIMED_KEY, QUEUE_KEY], args=[5, 6, 7, 8])
+    scripts[RELEASE_LOCK_SCRIPT].assert_called_once_with(keys=[MATCHING_LOCK_KEY], args=["token"])
+
+#the lock expired and the next tick took over: its claims and its lock are not touched
+def test_finish_matching_fanout_lock_lost(monkeypatch):
+    test_redis, scripts = mock_redis(monkeypatch, lock_held=0)
+    deliver = Mock()
+    monkeypatch.setattr(tasks, "deliver_groups", deliver)
+
+    finish_matching_fanout([[[5, 30.0]]], [], [[5, 30.0]], "token")
+
+    deliver.assert_not_called()
+    assert RELEASE_SCRIPT not in scripts
+    assert RELEASE_LOCK_SCRIPT not in scripts
+    test_redis.delete.assert_not_called()
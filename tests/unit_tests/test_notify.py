@@ -0,0 +1,50 @@
+import asyncio
+from matching.notify import notify_room_assignments
+
+'''
+Test room assignment notifications
+'''
+#a fake channel layer that records what was sent, fails for one user, and tracks how many sends run at once
+class FakeChannelLayer:
+    def __init__(self, failing_group):
+        self.failing_group = failing_group
+        self.sent = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def group_send(self, group, message):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if group == self.failing_group:
+            raise ConnectionError("channel layer down")
+        self.sent.append((group, message["room_id"]))
+
+def test_notify_room_assignments():
+    channel_layer = FakeChannelLayer("user_queue_3")
+    matched_groups = [{"room_id": 5, "user_ids": [1, 2, 3, 4]}, {"room_id": 6, "user_ids": [5, 6, 7]}]
+
+    succeeded, failed = asyncio.run(notify_room_assignments(channel_layer, matched_groups, concurrency=2))
+
+    #the failing user doesn't stop the others
+    assert succeeded == [1, 2, 4, 5, 6, 7]
+    assert [user_id for user_id, _ in failed] == [3]
+    assert ("user_queue_5", 6) in channel_layer.sent
+    #sends overlap, but never more than the limit
+    assert channel_layer.max_in_flight == 2
+
+#users with a registered channel are sent to directly, the rest through their group
+def test_notify_room_assignments_direct_channels():
+    class DirectChannelLayer(FakeChannelLayer):
+        async def send(self, channel_name, message):
+            self.sent.append((channel_name, message["room_id"]))
+
+    channel_layer = DirectChannelLayer(None)
+    matched_groups = [{"room_id": 5, "user_ids": [1, 2, 3]}]
+
+    succeeded, failed = asyncio.run(notify_room_assignments(channel_layer, matched_groups, channels={1: "specific.abc!1", 3: "specific.abc!3"}))
+
+    assert succeeded == [1, 2, 3]
+    assert not failed
+    assert sorted(channel_layer.sent) == [("specific.abc!1", 5), ("specific.abc!3", 5), ("user_queue_2", 5)]
@@ -34,6 +34,40 @@ def test_pop_random():
     #after this the cluster should be empty
     assert queue_manager.get_cluster_size("test_cluster") == 0
 
+def test_pop_oldest_serves_longest_waiting_first():
+    queue_manager = ClusterQueueManager()
+    for user_id, joined_at in [(5, 100.0), (3, 101.0), (9, 102.0)]:
+        queue_manager.add("test_cluster", user_id, joined_at)
+
+    #re-adding a queued user keeps their place in the queue
+    queue_manager.add("test_cluster", 5, 200.0)
+    assert queue_manager.get_cluster_size("test_cluster") == 3
 
-    
+    oldest = queue_manager.pop_oldest("test_cluster")
+    assert oldest.user_id == 5
+    assert oldest.joined_at == 100.0
+    assert [queue_manager.pop_oldest("test_cluster").user_id for _ in range(2)] == [3, 9]
+    assert queue_manager.pop_oldest("test_cluster") is None
+
+def test_removals_and_compaction_keep_order():
+    queue_manager = ClusterQueueManager()
+    for user_id in range(200):
+        queue_manager.add("test_cluster", user_id, float(user_id))
+
+    #removing the even users leaves enough dead slots to trigger compaction
+    for user_id in range(0, 200, 2):
+        assert queue_manager.get_remove("test_cluster", user_id).user_id == user_id
+    queue = queue_manager.cluster_queues["test_cluster"]
+    assert 1 in queue and 2 not in queue
+    assert [entry.user_id for entry in queue] == list(range(1, 200, 2))
+
+    #random pops drain every remaining user exactly once
+    popped = [queue_manager.pop_random("test_cluster").user_id for _ in range(100)]
+    assert sorted(popped) == list(range(1, 200, 2))
+    assert queue_manager.get_cluster_size("test_cluster") == 0
+    assert len(queue.user_ids) < 200
 
+def test_user_entry_has_no_dict():
+    user_entry = UserEntry(1, 10.0)
+    assert not hasattr(user_entry, "__dict__")
+    assert user_entry == UserEntry(1)
@@ -0,0 +1,74 @@
+import os
+import numpy as np
+from matching.matching import queue_candidates, match_queue_in_cluster, match_in_cluster, run_batch_matching
+from matching.queue_manager import ClusterQueueManager
+from test_index_registry import build_index
+
+
+#blocked candidates must equal a brute force ranking of the full similarity matrix
+def test_queue_candidates_match_brute_force():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(37, 8)).astype(np.float32)
+
+    candidates = queue_candidates(vectors, top_k=5, block_size=8)
+
+    unit_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    similarities = unit_vectors @ unit_vectors.T
+    np.fill_diagonal(similarities, -np.inf)
+    expected = np.argsort(-similarities, axis=1, kind="stable")[:, :5]
+    assert np.array_equal(candidates, expected)
+
+    #fewer queued users than top_k leaves padding
+    small = queue_candidates(vectors[:3], top_k=5)
+    assert (small[:, 2:] == -1).all()
+    assert (queue_candidates(vectors[:1], top_k=5) == -1).all()
+
+#queued users of the same friend circle are grouped together, users missing from the index go to leftover
+def test_match_queue_in_cluster(tmp_path):
+    build_index(str(tmp_path))
+
+    queue_manager = ClusterQueueManager()
+    for user_id in [1, 2, 3, 4, 11, 12, 13, 14, 999]:
+        queue_manager.add("global", user_id)
+
+    groups = match_queue_in_cluster("global", queue_manager, str(tmp_path))
+
+    assert len(groups) == 2
+    for group in groups:
+        user_ids = {entry.user_id for entry in group}
+        assert user_ids in ({1, 2, 3, 4}, {11, 12, 13, 14})
+    assert queue_manager.get_cluster_size("global") == 0
+    assert [entry.user_id for entry in queue_manager.cluster_queues["leftover"]] == [999]
+
+    queue_manager.add("global", 5)
+    queue_manager.add("global", 6)
+    res = run_batch_matching(queue_manager, base_dir=str(tmp_path), mode="queue")
+    #too few for a group, both end up in the leftover matching together with 999
+    assert res["global"] == []
+    assert sorted(entry.user_id for entry in res["leftover"][0]) == [5, 6, 999]
+
+#users pushed to the leftover queue keep the time they joined, so they aren't treated as newly queued
+def test_leftovers_keep_joined_at(tmp_path):
+    build_index(str(tmp_path))
+
+    for match in (match_queue_in_cluster, match_in_cluster):
+        queue_manager = ClusterQueueManager()
+        queue_manager.add("global", 999, 10.0)
+        queue_manager.add("global", 5, 20.0)
+        queue_manager.add("global", 6, 30.0)
+
+        assert match("global", queue_manager, str(tmp_path)) == []
+        leftover = {entry.user_id: entry.joined_at for entry in queue_manager.cluster_queues["leftover"]}
+        assert leftover == {999: 10.0, 5: 20.0, 6: 30.0}
+
+#versions built before the vectors file read the vectors from annoy, with the same result
+def test_match_queue_in_cluster_without_vectors_file(tmp_path):
+    version_dir = build_index(str(tmp_path))
+    os.remove(os.path.join(version_dir, "global_vectors.npy"))
+
+    queue_manager = ClusterQueueManager()
+    for user_id in [1, 2, 3, 4, 11, 12, 13, 14]:
+        queue_manager.add("global", user_id)
+
+    groups = match_queue_in_cluster("global", queue_manager, str(tmp_path))
+    assert sorted(sorted(entry.user_id for entry in group) for group in groups) == [[1, 2, 3, 4], [11, 12, 13, 14]]
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+from collections import Counter
+from matching.build_graph_annoy import build_like_adjacency
+from matching.random_walks import iter_walk_blocks, write_walk_files, WalkCorpus
+
+'''
+Test the built-in node2vec walk generator
+'''
+def make_likes_df():
+    likes_data = {
+        "user_from": [1, 1, 2, 2, 3, 4, 5, 5, 6],
+        "user_to":   [2, 3, 3, 4, 1, 5, 6, 1, 4],
+        "like_count": [5, 1, 2, 7, 3, 1, 4, 2, 6]
+    }
+    return pd.DataFrame(likes_data)
+
+#exact node2vec transition probabilities from current given previous, same rule as the node2vec package
+def exact_transition(dense, previous, current, p, q):
+    weights = dense[current].copy()
+    for x in np.flatnonzero(weights):
+        if x == previous:
+            weights[x] /= p
+        elif dense[previous, x] == 0:
+            weights[x] /= q
+    return weights / weights.sum()
+
+#with the production settings the empirical second-order transitions must match the exact node2vec probabilities
+def test_walk_distribution_matches_node2vec():
+    p, q = 0.5, 10
+    adjacency, node_ids = build_like_adjacency(make_likes_df())
+    dense = adjacency.toarray()
+
+    transitions = Counter()
+    totals = Counter()
+    first_steps = Counter()
+    for walks in iter_walk_blocks(adjacency, walk_length=40, num_walks=80, p=p, q=q, seed=1):
+        assert walks.shape == (len(node_ids), 40)
+        #every node has an outgoing edge here so no walk is cut short
+        assert (walks >= 0).all()
+        for walk in walks:
+            first_steps[(walk[0], walk[1])] += 1
+            for previous, current, nxt in zip(walk, walk[1:], walk[2:]):
+                transitions[(previous, current, nxt)] += 1
+                totals[(previous, current)] += 1
+
+    for (previous, current), total in totals.items():
+        if total < 500:
+            continue
+        expected = exact_transition(dense, previous, current, p, q)
+        for nxt in range(len(node_ids)):
+            observed = transitions[(previous, current, nxt)] / total
+            assert abs(observed - expected[nxt]) < 0.05
+
+    #first step is proportional to edge weight only
+    for start in range(len(node_ids)):
+        expected = dense[start] / dense[start].sum()
+        for nxt in range(len(node_ids)):
+            assert abs(first_steps[(start, nxt)] / 80 - expected[nxt]) < 0.2
+
+def test_walks_from_start_nodes():
+    adjacency, node_ids = build_like_adjacency(make_likes_df())
+    blocks = list(iter_walk_blocks(adjacency, walk_length=5, num_walks=3, start_nodes=[0, 4], seed=0))
+    assert len(blocks) == 3
+    for walks in blocks:
+        assert sorted(walks[:, 0].tolist()) == [0, 4]
+
+#walks sharded across 2 processes, written as int32 files and read back as word2vec sentences
+def test_write_walk_files_and_corpus(tmp_path):
+    adjacency, node_ids = build_like_adjacency(make_likes_df())
+    walk_files = write_walk_files(adjacency, str(tmp_path), walk_length=5, num_walks=4, workers=2, seed=0)
+
+    assert len(walk_files) == 4
+    for path in walk_files:
+        walks = np.load(path)
+        assert walks.dtype == np.int32
+        assert walks.shape == (len(node_ids), 5)
+
+    corpus = WalkCorpus(walk_files, node_ids)
+    sentences = list(corpus)
+    assert len(sentences) == 4 * len(node_ids)
+    assert all(token in {"1", "2", "3", "4", "5", "6"} for sentence in sentences for token in sentence)
+    #gensim iterates over the corpus several times
+    assert list(corpus) == sentences
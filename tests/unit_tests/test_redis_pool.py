@@ -0,0 +1,49 @@
+import asyncio
+import weakref
+import lyncup.redis_pool as redis_pool
+from lyncup.redis_pool import get_redis, get_sync_redis
+
+'''
+Test the shared Redis clients
+'''
+#creating a client or a pool doesn't connect, so these run without a Redis server
+
+def fresh_clients(monkeypatch):
+    monkeypatch.setattr(redis_pool, "clients", weakref.WeakKeyDictionary())
+
+async def get_twice():
+    return get_redis(), get_redis()
+
+#consumers on the same loop share one client, each loop gets its own
+def test_one_client_per_loop(monkeypatch):
+    fresh_clients(monkeypatch)
+
+    first, again = asyncio.run(get_twice())
+    assert first is again
+
+    other, _ = asyncio.run(get_twice())
+    assert other is not first
+    assert other.connection_pool is not first.connection_pool
+
+def test_pool_configured_from_settings(monkeypatch, settings):
+    fresh_clients(monkeypatch)
+    settings.REDIS_URL = "redis://example:6390/0"
+    settings.REDIS_POOL_MAX_CONNECTIONS = 7
+    settings.REDIS_POOL_TIMEOUT = 2.5
+    settings.REDIS_HEALTH_CHECK_INTERVAL = 12
+
+    client, _ = asyncio.run(get_twice())
+    pool = client.connection_pool
+
+    assert isinstance(pool, redis_pool.redis.BlockingConnectionPool)
+    assert pool.max_connections == 7
+    assert pool.timeout == 2.5
+    assert pool.connection_kwargs["host"] == "example"
+    assert pool.connection_kwargs["port"] == 6390
+    assert pool.connection_kwargs["health_check_interval"] == 12
+    assert pool.connection_kwargs["decode_responses"] is True
+
+def test_sync_client_created_once(monkeypatch):
+    monkeypatch.setattr(redis_pool, "sync_client", None)
+    client = get_sync_redis()
+    assert get_sync_redis() is client
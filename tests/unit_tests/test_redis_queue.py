@@ -0,0 +1,70 @@
+from unittest.mock import Mock
+from matching.redis_queue import claim_batch, commit_groups, release_claims, schedule_matching, refresh_lease, sweep_expired, QUEUE_KEY, CLAIMED_KEY, TRIGGER_KEY, LEASES_KEY, CHANNELS_KEY, CLAIM_SCRIPT, COMMIT_SCRIPT
+
+'''
+Test Redis queue helpers
+'''
+#the Lua scripts themselves need a real Redis, these tests check what is sent to them and how their replies are read, with a mock redis like in test_run_full_matching_algo.py
+
+def mock_redis(script_reply):
+    test_redis = Mock()
+    script = Mock(return_value=script_reply)
+    test_redis.register_script.return_value = script
+    return test_redis, script
+
+def test_claim_batch_parses_oldest_first():
+    #with decode_responses=True redis returns members and scores as strings
+    test_redis, script = mock_redis(["7", "100.5", "3", "101"])
+    claimed = claim_batch(test_redis, 2, min_wait=5.0, now=200.0)
+
+    assert claimed == [(7, 100.5), (3, 101.0)]
+    test_redis.register_script.assert_called_once_with(CLAIM_SCRIPT)
+    script.assert_called_once_with(keys=[QUEUE_KEY, CLAIMED_KEY, LEASES_KEY, CHANNELS_KEY], args=["-inf", 195.0, 2, 200.0])
+
+def test_commit_groups_keeps_only_committed():
+    #the second group lost a member, the script reports 0 for it
+    test_redis, script = mock_redis([1, 0, 1])
+    groups = [[1, 2, 3], [4, 5, 6, 7], [8, 9, 10]]
+
+    assert commit_groups(test_redis, groups, "lock", "token") == [[1, 2, 3], [8, 9, 10]]
+    test_redis.register_script.assert_called_once_with(COMMIT_SCRIPT)
+    #the lock token goes first, then the groups flattened as size, members...
+    script.assert_called_once_with(keys=[CLAIMED_KEY, "lock"], args=["token", 3, 1, 2, 3, 4, 4, 5, 6, 7, 3, 8, 9, 10])
+
+#the script replies nothing when the tick no longer holds the lock
+def test_commit_groups_lock_lost():
+    test_redis, script = mock_redis([])
+    assert commit_groups(test_redis, [[1, 2, 3]], "lock", "token") == []
+
+def test_nothing_to_send():
+    test_redis, script = mock_redis(None)
+    assert commit_groups(test_redis, [], "lock", "token") == []
+    assert release_claims(test_redis, []) == 0
+    script.assert_not_called()
+
+def test_schedule_matching_args():
+    test_redis, script = mock_redis("2")
+    assert schedule_matching(test_redis, 4, 2.0, 15.0, now=100.0) == "2"
+    script.assert_called_once_with(keys=[QUEUE_KEY, TRIGGER_KEY], args=[100.0, 4, 2.0, 15.0])
+
+def test_leases():
+    test_redis, script = mock_redis(2)
+    refresh_lease(test_redis, 7, 30, now=100.0)
+    test_redis.zadd.assert_called_once_with(LEASES_KEY, {7: 130.0})
+
+    #everything whose lease ran out by now is swept from every queue key
+    assert sweep_expired(test_redis, now=200.0) == 2
+    script.assert_called_once_with(keys=[LEASES_KEY, QUEUE_KEY, CLAIMED_KEY, CHANNELS_KEY], args=[200.0])
+
+#queued users without a live lease (e.g. put back after their connection left, or queued before leases) have no lease to expire and are never swept. The claim checks every member's lease against now and only returns the leased ones, the rest are removed from the queue
+def test_claim_batch_drops_unleased():
+    test_redis, script = mock_redis(["3", "101"])
+    assert claim_batch(test_redis, 3, now=200.0) == [(3, 101.0)]
+
+    keys, args = script.call_args.kwargs["keys"], script.call_args.kwargs["args"]
+    assert keys[2:] == [LEASES_KEY, CHANNELS_KEY]
+    assert args[3] == 200.0
+
+    #nobody leased, nothing claimed
+    test_redis, script = mock_redis([])
+    assert claim_batch(test_redis, 3, now=200.0) == []
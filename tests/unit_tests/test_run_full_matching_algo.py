@@ -7,6 +7,8 @@ from matching.distribute_rooms import distribute_rooms
 from annoy import AnnoyIndex
 from test_create_graph_annoy import test_create_node2vec_annoy
 from matching.build_graph_annoy import create_graph_from_likes, create_node2vec_annoy
+from matching.artifacts import resolve_version_dir
+from matching.index_map import UserIndexMap
 import pandas as pd
 from typing import Dict, Tuple, List
 import pytest
@@ -31,19 +33,41 @@ def test_redis():
     #no matter what argument is passed to smembers, return {"123"}, just a mock.
     #note: mocks don’t work like real dictionaries or databases. They don't validate keys! Instead, they simulate behaviour without checking what keys exist. Took me a while to realise.
     #{"123"} is only used inside distribute_rooms to check which room ids are already taken
+
+    #room ids are reserved with one INCRBY per tick, pretend "last_room_id" was 100 before
+    test_redis.incrby.side_effect = lambda key, amount: 100 + amount
     return test_redis
 
+#the index built from the big csv (1 million likes by 10,000 users), built once into a temporary folder for all tests of this module that need it
+@pytest.fixture(scope="module")
+def big_data_base_dir(tmp_path_factory):
+    #get the csv
+    current_folder = os.path.dirname(os.path.abspath(__file__))
+    likes_data_path = os.path.join(current_folder, "likes_df.csv")
+    assert os.path.exists(likes_data_path)
+    likes_df = pd.read_csv(likes_data_path)
+
+    # #uncomment for fast testing alternative, can just use 10% of the data, if not wanting to wait
+    # likes_df = likes_df.iloc[:int(0.10*len(likes_df))]
+
+    print(f"the size of likes_df is {len(likes_df)}")
+
+    base_dir = str(tmp_path_factory.mktemp("Annoy"))
+
+    #create the Annoy and user index map files with the big data csv
+    create_node2vec_annoy(likes_df, base_dir=base_dir, embed_dimensions=128, num_trees=10)
+    return base_dir
+
 
-def test_match_in_cluster():
+def test_match_in_cluster(tmp_path):
     #make sure all the necessary Annoy and map files are in place
-    test_create_node2vec_annoy()
+    test_create_node2vec_annoy(tmp_path)
 
-    base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Annoy")
+    base_dir = str(tmp_path)
     #check that the function has successfully created the annoy file and global map file.
-    annoy_file = os.path.join(base_dir, "cluster_global.ann")
-    global_map = os.path.join(base_dir, "global_map.json")
+    annoy_file = os.path.join(resolve_version_dir(base_dir), "cluster_global.ann")
     assert os.path.exists(annoy_file)
-    assert os.path.exists(global_map)
+    assert UserIndexMap.exists(resolve_version_dir(base_dir), "global")
 
     queue_manager = ClusterQueueManager()
 
@@ -63,29 +87,14 @@ def test_match_in_cluster():
 
 #batch matching tries to match those in each cluster, in our case here, only the global cluster, then match the leftover members.
 #now that test_match_in_cluster() has passed and works with small dummy data, we now want to test the run_batch_matching function AND test it with a HUGE dataset, with 1 million "like" interactions between 10,000 users. We'll also stress test it with a high user number load.
-def test_run_batch_matching_with_big_data():
+def test_run_batch_matching_with_big_data(big_data_base_dir):
 
-    #get the csv
-    current_folder = os.path.dirname(os.path.abspath(__file__))
-    likes_data_path = os.path.join(current_folder, "likes_df.csv")
-    assert os.path.exists(likes_data_path)
-    likes_df = pd.read_csv(likes_data_path)
-
-    # #uncomment for fast testing alternative, can just use 10% of the data, if not wanting to wait
-    # likes_df = likes_df.iloc[:int(0.10*len(likes_df))]
-
-    print(f"the size of likes_df is {len(likes_df)}")
-
-    base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Annoy")
-
-    #create the Annoy and json map file with the big data csv
-    create_node2vec_annoy(likes_df, base_dir=base_dir, embed_dimensions=128, num_trees=10)
+    base_dir = big_data_base_dir
 
     #check that the function has successfully created the annoy file and global map file.
-    annoy_file = os.path.join(base_dir, "cluster_global.ann")
-    global_map = os.path.join(base_dir, "global_map.json")
+    annoy_file = os.path.join(resolve_version_dir(base_dir), "cluster_global.ann")
     assert os.path.exists(annoy_file)
-    assert os.path.exists(global_map)
+    assert UserIndexMap.exists(resolve_version_dir(base_dir), "global")
 
     queue_manager = ClusterQueueManager()
 
@@ -150,25 +159,37 @@ def test_distribute_rooms_with_mock_and_small_data(test_redis):
     assert 1 in users_in_matched_groups
     assert 2 in users_in_matched_groups
 
-    #check that necessary functions have been called
-    test_redis.smembers.assert_called_once_with("rooms")
-    test_redis.sadd.assert_called_once()
+    #check that the room id was reserved with a single INCRBY for the whole tick, not one INCR per group
+    test_redis.incrby.assert_called_once_with("last_room_id", 1)
+    test_redis.incr.assert_not_called()
+    assert group["room_id"] == 101
+    print(f"room id is: {group['room_id']}")
+
+#several groups still cost one INCRBY, and get consecutive room ids
+def test_distribute_rooms_reserves_ids_in_one_call(test_redis):
+    grouped_users = {
+        "0": [[UserEntry(1), UserEntry(2), UserEntry(3)], [UserEntry(4), UserEntry(5), UserEntry(6)]],
+        "leftover": [[UserEntry(7), UserEntry(8), UserEntry(9)]],
+    }
+    matched_groups, users_in_matched_groups = distribute_rooms(grouped_users, test_redis)
 
-    #get the first positional arguments tuple from the last called of test_redis.sadd()
-    #e.g. redis_client.sadd("rooms", str(random_roomId))
+    test_redis.incrby.assert_called_once_with("last_room_id", 3)
+    assert [group["room_id"] for group in matched_groups] == [101, 102, 103]
+    assert users_in_matched_groups == list(range(1, 10))
 
-    assert test_redis.sadd.call_args[0][0] == "rooms"
-    print(f"room id is: {test_redis.sadd.call_args[0][1]}")
+    #nothing to distribute, no Redis call at all
+    test_redis.incrby.reset_mock()
+    assert distribute_rooms({"global": [], "leftover": []}, test_redis) == ([], [])
+    test_redis.incrby.assert_not_called()
 
 #here, we will stress test with a high user load in the queue and using the Annoy file created with 1 million user interactions by 10,000 users.
-def test_distribute_rooms_with_mock_and_big_data(test_redis):
+def test_distribute_rooms_with_mock_and_big_data(test_redis, big_data_base_dir):
     #get the annoy related files
-    base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Annoy")
+    base_dir = big_data_base_dir
     #check that the function has successfully created the annoy file and global map file.
-    annoy_file = os.path.join(base_dir, "cluster_global.ann")
-    global_map = os.path.join(base_dir, "global_map.json")
+    annoy_file = os.path.join(resolve_version_dir(base_dir), "cluster_global.ann")
     assert os.path.exists(annoy_file), f"missing Annoy file at {annoy_file}"
-    assert os.path.exists(global_map), f"missing global map file at {global_map}"
+    assert UserIndexMap.exists(resolve_version_dir(base_dir), "global"), "missing global user index map"
 
     queue_manager = ClusterQueueManager()
 
@@ -198,10 +219,9 @@ def test_distribute_rooms_with_mock_and_big_data(test_redis):
 
     assert set(users_in_matched_groups) == all_user_ids_from_res, "collected all_user_ids_from_res does not match users_in_matched_groups from distribute_rooms"
 
-    #check redis.sadd was called at least once per group created
-    output_calls = len(matched_groups)
-    redis_calls = test_redis.sadd.call_count
-    assert output_calls >= redis_calls, "output_calls >= redis_calls NOT TRUE"
+    #check the room ids of the whole tick were reserved with at most one Redis call
+    assert test_redis.incrby.call_count <= 1, "room ids must be reserved with a single INCRBY"
+    assert len({group["room_id"] for group in matched_groups}) == len(matched_groups), "room ids must be unique"
 
     #check if the outputs are in the form of: Tuple[List[Dict[str, object]], List[int]]
     #first element: check matched_groups is a list of dicts 
@@ -0,0 +1,66 @@
+from matching.scheduler import BatchSizer, run_budgeted_matching
+from matching.queue_manager import ClusterQueueManager
+from test_index_registry import build_index
+
+
+def test_batch_sizer():
+    sizer = BatchSizer(initial_batch_size=50, min_batch_size=10, max_batch_size=1000, smoothing=0.5)
+    assert sizer.batch_size("queue", 1.0) == 50
+
+    #1ms per user: a second fits 1000 users, half a second 500
+    sizer.observe("queue", 100, 0.1)
+    assert sizer.batch_size("queue", 0.5) == 500
+    assert sizer.batch_size("queue", 100.0) == 1000
+    assert sizer.batch_size("queue", 0.0) == 10
+
+    #smoothed towards the new measurement
+    sizer.observe("queue", 100, 0.3)
+    assert sizer.batch_size("queue", 1.0) == 500
+    #other modes are measured separately
+    assert sizer.batch_size("annoy", 1.0) == 50
+
+#small batches are repeated until the queue is empty, not just once per tick
+def test_run_budgeted_matching_empties_queue(tmp_path):
+    build_index(str(tmp_path))
+
+    for mode in ["annoy", "queue"]:
+        queue_manager = ClusterQueueManager()
+        queued = list(range(1, 21))
+        for user_id in queued:
+            queue_manager.add("global", user_id)
+
+        res = run_budgeted_matching(queue_manager, base_dir=str(tmp_path), time_budget=30.0, mode=mode, sizer=BatchSizer(initial_batch_size=4, min_batch_size=4, max_batch_size=4))
+
+        matched = [entry.user_id for groups in res.values() for group in groups for entry in group]
+        assert sorted(matched) == queued
+        assert len(res["global"]) >= 3
+        assert queue_manager.get_cluster_size("global") == 0
+
+#out of time, nobody is taken off the queue. A cluster without an index doesn't make it loop forever.
+def test_run_budgeted_matching_budget_and_missing_cluster(tmp_path):
+    build_index(str(tmp_path))
+
+    queue_manager = ClusterQueueManager()
+    for user_id in range(1, 9):
+        queue_manager.add("global", user_id)
+    res = run_budgeted_matching(queue_manager, base_dir=str(tmp_path), time_budget=0.0)
+    assert res == {"leftover": []}
+    assert queue_manager.get_cluster_size("global") == 8
+
+    queue_manager = ClusterQueueManager()
+    queue_manager.add("missing", 1)
+    res = run_budgeted_matching(queue_manager, base_dir=str(tmp_path), time_budget=5.0)
+    assert queue_manager.get_cluster_size("missing") == 1
+
+#the fan-out tasks group the leftovers of all clusters together, so each cluster's run leaves its leftover queue alone
+def test_run_budgeted_matching_without_leftover_pass(tmp_path):
+    build_index(str(tmp_path))
+
+    queue_manager = ClusterQueueManager()
+    for user_id in range(1, 21):
+        queue_manager.add("global", user_id)
+    queue_manager.add("leftover", 999)
+
+    res = run_budgeted_matching(queue_manager, base_dir=str(tmp_path), time_budget=30.0, mode="queue", group_leftover=False)
+    assert "leftover" not in res
+    assert 999 in queue_manager.cluster_queues["leftover"]
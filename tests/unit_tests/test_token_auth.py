@@ -0,0 +1,121 @@
+import time
+import pytest
+import jwt
+from unittest.mock import Mock, AsyncMock
+from django.conf import settings
+import lyncup.token_auth as token_auth
+from lyncup.token_auth import TokenAuthMiddleware, TokenUser, get_token_user, invalidate_token_user, token_user_key
+
+'''
+Test websocket token authentication
+'''
+#the middleware's Redis and database lookups are replaced by mocks, like the mock redis in test_run_full_matching_algo.py
+
+def make_token_user(user_id=5):
+    return TokenUser(id=user_id, firstname="Harry", lastname="Potter", is_verified=True, is_active=True)
+
+def mock_redis(monkeypatch, cached=None, error=None):
+    test_redis = Mock()
+    test_redis.get = AsyncMock(return_value=cached, side_effect=error)
+    test_redis.set = AsyncMock()
+    monkeypatch.setattr(token_auth, "get_redis", lambda: test_redis)
+    return test_redis
+
+def mock_load_token_user(monkeypatch, user):
+    load = AsyncMock(return_value=user)
+    monkeypatch.setattr(token_auth, "load_token_user", load)
+    return load
+
+#runs the middleware on a websocket scope with the given query string, returns the scope the inner application was called with
+async def scope_after_middleware(query_string):
+    scopes = []
+
+    async def inner(scope, receive, send):
+        scopes.append(scope)
+
+    await TokenAuthMiddleware(inner)({"type": "websocket", "query_string": query_string}, None, None)
+    return scopes[0]
+
+@pytest.mark.asyncio
+async def test_unusable_tokens(monkeypatch):
+    get_user = AsyncMock()
+    monkeypatch.setattr(token_auth, "get_token_user", get_user)
+    expired = jwt.encode({"user_id": 5, "exp": int(time.time()) - 60}, settings.SECRET_KEY, algorithm="HS256")
+
+    for query_string in [b"", b"token=TellThemHowImDefyingGravity", f"token={expired}".encode()]:
+        scope = await scope_after_middleware(query_string)
+        assert scope["token_user"] is None
+        assert "user_id" not in scope
+    get_user.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_valid_token(monkeypatch):
+    user = make_token_user()
+    monkeypatch.setattr(token_auth, "get_token_user", AsyncMock(return_value=user))
+    token = jwt.encode({"user_id": 5}, settings.SECRET_KEY, algorithm="HS256")
+
+    scope = await scope_after_middleware(f"token={token}".encode())
+    assert scope["token_user"] is user
+    assert scope["user_id"] == 5
+
+#a cached user is served from Redis without touching the database
+@pytest.mark.asyncio
+async def test_cache_hit(monkeypatch):
+    test_redis = mock_redis(monkeypatch, cached=make_token_user().to_json())
+    load = mock_load_token_user(monkeypatch, None)
+
+    user = await get_token_user(5)
+
+    assert (user.id, user.firstname, user.lastname, user.is_verified, user.is_active) == (5, "Harry", "Potter", True, True)
+    test_redis.get.assert_awaited_once_with(token_user_key(5))
+    load.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_cache_miss(monkeypatch):
+    test_redis = mock_redis(monkeypatch)
+    user = make_token_user()
+    load = mock_load_token_user(monkeypatch, user)
+
+    assert await get_token_user(5) is user
+    load.assert_awaited_once_with(5)
+    test_redis.set.assert_awaited_once_with(token_user_key(5), user.to_json(), ex=settings.TOKEN_USER_CACHE_SECONDS)
+
+    #users that don't exist aren't cached
+    test_redis.set.reset_mock()
+    mock_load_token_user(monkeypatch, None)
+    assert await get_token_user(6) is None
+    test_redis.set.assert_not_awaited()
+
+#with Redis down the user is still loaded from the database
+@pytest.mark.asyncio
+async def test_redis_error_falls_back_to_database(monkeypatch):
+    test_redis = mock_redis(monkeypatch, error=ConnectionError("redis is down"))
+    user = make_token_user()
+    load = mock_load_token_user(monkeypatch, user)
+
+    assert await get_token_user(5) is user
+    load.assert_awaited_once_with(5)
+    test_redis.set.assert_not_awaited()
+
+def test_invalidate_token_user(monkeypatch):
+    test_redis = Mock()
+    monkeypatch.setattr(token_auth, "get_sync_redis", lambda: test_redis)
+
+    invalidate_token_user(5)
+    test_redis.delete.assert_called_once_with(token_user_key(5))
+
+    #a failed delete is only logged, the entry expires by itself
+    test_redis.delete.side_effect = ConnectionError("redis is down")
+    invalidate_token_user(5)
+
+#only the chat and queue routes decode tokens, only the direct message route loads the session user
+def test_asgi_routes_authenticate_separately():
+    from channels.sessions import CookieMiddleware
+    from lyncup.asgi import combined_websocket_urlpatterns
+
+    def consumer_of(path):
+        return next(route.callback for route in combined_websocket_urlpatterns if route.pattern.match(path))
+
+    assert isinstance(consumer_of("ws/chat/5/"), TokenAuthMiddleware)
+    assert isinstance(consumer_of("ws/queue/"), TokenAuthMiddleware)
+    assert isinstance(consumer_of("ws/directmessage/5/"), CookieMiddleware)
@@ -0,0 +1,35 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from lyncup.redis_pool import get_sync_redis
+from lyncup.token_auth import invalidate_token_user
+from matching.matchable import is_matchable, set_matchable
+from .models import AppUser
+
+
+#the websocket auth middleware caches a few fields of each user (see lyncup/token_auth.py), a saved or deleted user must not be served from that cache.
+#deleted once the transaction commits, otherwise a connect in between could cache the old row again.
+@receiver(post_save, sender=AppUser)
+@receiver(post_delete, sender=AppUser)
+def invalidate_cached_token_user(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: invalidate_token_user(user_id))
+
+
+#keeps the matchable users bitmap (see matching/matchable.py) in step with the user's is_active and is_verified. A failed update is repaired by the next rebuild_matchable_users_task.
+def update_matchable(user_id, matchable):
+    try:
+        set_matchable(get_sync_redis(), user_id, matchable)
+    except Exception as error:
+        print(error)
+
+@receiver(post_save, sender=AppUser)
+def update_matchable_on_save(sender, instance, **kwargs):
+    user_id = instance.pk
+    matchable = is_matchable(instance)
+    transaction.on_commit(lambda: update_matchable(user_id, matchable))
+
+@receiver(post_delete, sender=AppUser)
+def update_matchable_on_delete(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: update_matchable(user_id, False))